@@ -0,0 +1,74 @@
+import hashlib
+import os
+import threading
+from typing import Optional
+
+from cachetools import TTLCache
+
+from routing import normalize_question
+
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'True').lower() in ('true', '1', 't')
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', '3600'))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '256'))
+
+
+class AnswerCache:
+    """
+    Caches Dorian's answers by normalized question, the library context
+    sent with it, the last exchange of the conversation and a library version.
+
+    Follow-ups such as "¿Por qué?" mean something else after every answer,
+    so the caller passes a digest of the last question and answer; questions
+    answered from library data pass none and are reused across conversations
+    and repeats in the same one.
+
+    The version is bumped on every change to the books, so an answer is never
+    reused after the library it was based on changed; reading progress is
+    part of the library context itself.
+    Entries expire after a TTL and the least recently used go first when full.
+    """
+
+    def __init__(self, ttl: int = ANSWER_CACHE_TTL, maxsize: int = ANSWER_CACHE_SIZE, enabled: bool = ANSWER_CACHE_ENABLED):
+        self.enabled = enabled
+        self.library_version = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def bump_library_version(self):
+        with self._lock:
+            self.library_version += 1
+
+    def key(self, question: str, context_data: Optional[str], last_exchange: str = '') -> str:
+        digest = hashlib.sha256()
+        for part in (normalize_question(question), context_data or '', last_exchange, str(self.library_version)):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            answer = self._cache.get(key)
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return answer
+
+    def put(self, key: str, answer: str):
+        if answer:
+            with self._lock:
+                self._cache[key] = answer
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._cache),
+                "library_version": self.library_version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
@@ -1,9 +1,12 @@
 from fastapi import HTTPException, Depends, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import os
+import hashlib
+import time
 import httpx
 import asyncio
 from typing import Optional
+from cachetools import TLRUCache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,27 +16,102 @@ GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 # Your allowed email address
 ALLOWED_EMAIL = os.getenv('ALLOWED_EMAIL')
 
+GOOGLE_USERINFO_URL = "https://www.googleapis.com/oauth2/v2/userinfo"
+GOOGLE_TOKENINFO_URL = "https://oauth2.googleapis.com/tokeninfo"
+
+# Verified tokens are reused for at most this many seconds, and never past their expiry
+AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', '300'))
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '256'))
+
 security = HTTPBearer()
 
+# Shared HTTP client so calls to Google reuse pooled keep-alive connections
+_http_client: Optional[httpx.AsyncClient] = None
+
+# sha256(token) -> (user_info, monotonic expiry time)
+_token_cache = TLRUCache(
+    maxsize=AUTH_CACHE_SIZE,
+    ttu=lambda key, value, now: value[1],
+    timer=time.monotonic
+)
+_token_cache_stats = {"hits": 0, "misses": 0}
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        )
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+def token_cache_stats() -> dict:
+    hits = _token_cache_stats["hits"]
+    misses = _token_cache_stats["misses"]
+    return {
+        "entries": len(_token_cache),
+        "max_entries": AUTH_CACHE_SIZE,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+    }
+
+async def get_user_info(access_token: str) -> Optional[dict]:
+    """
+    Return the Google user info for an access token, or None if the token is invalid.
+    Valid tokens are cached by hash until AUTH_CACHE_TTL or the token's own expiry, whichever comes first.
+    """
+    key = hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+    cached = _token_cache.get(key)
+    if cached is not None:
+        _token_cache_stats["hits"] += 1
+        return cached[0]
+    _token_cache_stats["misses"] += 1
+
+    client = get_http_client()
+    # Ask for the remaining lifetime alongside the user info, over the same pooled connection
+    userinfo_response, tokeninfo_response = await asyncio.gather(
+        client.get(GOOGLE_USERINFO_URL, headers={"Authorization": f"Bearer {access_token}"}),
+        client.get(GOOGLE_TOKENINFO_URL, params={"access_token": access_token})
+    )
+
+    if userinfo_response.status_code != 200:
+        return None
+    user_info = userinfo_response.json()
+
+    ttl = AUTH_CACHE_TTL
+    if tokeninfo_response.status_code == 200:
+        try:
+            ttl = min(ttl, int(tokeninfo_response.json().get('expires_in', 0)))
+        except (TypeError, ValueError):
+            ttl = 0
+    else:
+        # Without a known expiry, don't trust the token beyond this request
+        ttl = 0
+
+    if ttl > 0:
+        _token_cache[key] = (user_info, time.monotonic() + ttl)
+
+    return user_info
+
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     try:
         # Get the access token from the Authorization header
         access_token = credentials.credentials
         
         # Use the access token to get user info from Google's userinfo API
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://www.googleapis.com/oauth2/v2/userinfo",
-                headers={"Authorization": f"Bearer {access_token}"}
+        user_info = await get_user_info(access_token)
+        if user_info is None:
+            raise HTTPException(
+                status_code=401,
+                detail="Invalid access token"
             )
-            
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=401,
-                    detail="Invalid access token"
-                )
-            
-            user_info = response.json()
         
         # Check if the email matches the allowed email
         if user_info.get('email') != ALLOWED_EMAIL:
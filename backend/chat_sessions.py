@@ -0,0 +1,368 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Optional
+
+from google.genai import types
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from gemini import estimate_tokens
+from models import ChatSession
+
+logger = logging.getLogger(__name__)
+
+# Resident chats are dropped from memory when any of these limits is exceeded;
+# their history stays in the database and is loaded again on the next turn
+CHAT_SESSION_MAX = int(os.getenv('CHAT_SESSION_MAX', '100'))
+CHAT_SESSION_MAX_BYTES = int(os.getenv('CHAT_SESSION_MAX_MB', '32')) * 1024 * 1024
+CHAT_SESSION_IDLE_TTL = int(os.getenv('CHAT_SESSION_IDLE_TTL', '1800'))
+
+# Attempts at saving a turn when other instances keep saving the same session first
+CHAT_SAVE_ATTEMPTS = 3
+
+# Once a session's history grows past this many (estimated) tokens, older turns are
+# folded into a summary; the most recent turns are always kept verbatim
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv('CHAT_HISTORY_TOKEN_BUDGET', '6000'))
+CHAT_KEEP_RECENT_TURNS = int(os.getenv('CHAT_KEEP_RECENT_TURNS', '3'))
+
+SUMMARY_INSTRUCTION = """You summarize conversations between a reader and Dorian, a book assistant. You must:
+1. Keep every book title, author, character and opinion that was discussed
+2. Keep the reader's preferences, questions still open and anything Dorian promised
+3. Write in the same language as the conversation
+4. Be concise and return only the summary"""
+
+SUMMARY_PREFIX = "Summary of our earlier conversation:"
+SUMMARY_ACK = "Understood, I'll keep that in mind."
+
+
+def serialize_history(history: List[types.Content]) -> str:
+    return json.dumps([content.model_dump(mode='json', exclude_none=True) for content in history], ensure_ascii=False)
+
+
+def deserialize_history(data: str) -> List[types.Content]:
+    return [types.Content.model_validate(content) for content in json.loads(data)]
+
+
+def chat_history(chat) -> List[types.Content]:
+    # AsyncChat keeps its history privately and has no public getter in this SDK version
+    return list(chat._curated_history)
+
+
+def last_exchange_digest(chat) -> str:
+    """SHA-256 of a chat's last question and answer, which is what a follow-up question refers to"""
+    history = chat_history(chat)
+    start = max((i for i, content in enumerate(history) if content.role == 'user'), default=len(history))
+    digest = hashlib.sha256()
+    for content in history[start:]:
+        digest.update(f"{content.role}\0{content_text(content)}\0".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def record_exchange(chat, question: str, answer: str):
+    """Add a question and an answer produced elsewhere (e.g. from a cache) to a chat's history"""
+    chat._curated_history.extend([
+        types.Content(role='user', parts=[types.Part(text=question)]),
+        types.Content(role='model', parts=[types.Part(text=answer)])
+    ])
+
+
+def content_text(content: types.Content) -> str:
+    return ''.join(part.text for part in content.parts or [] if part.text)
+
+
+def history_tokens(history: List[types.Content]) -> int:
+    return sum(estimate_tokens(content_text(content)) for content in history)
+
+
+def replace_last_user_message(history: List[types.Content], text: str) -> List[types.Content]:
+    """
+    Replace the last user turn with `text`.
+    Used to keep only the bare question once library context sent with it has been answered.
+    """
+    for i in range(len(history) - 1, -1, -1):
+        if history[i].role == 'user':
+            if content_text(history[i]) != text:
+                history = history[:i] + [types.Content(role='user', parts=[types.Part(text=text)])] + history[i + 1:]
+            break
+    return history
+
+
+class ResidentChat:
+    def __init__(self, chat, version: int, size: int):
+        self.chat = chat
+        self.version = version
+        self.size = size
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()  # One turn at a time per session
+
+
+class ChatSessionManager:
+    """
+    Keeps recently used chats in memory and every chat's history in the database.
+
+    Each finished turn is written through to the ChatSession table, so
+    evicting a chat only frees memory and another instance can continue the
+    conversation. Resident chats are evicted least recently used first when
+    there are too many, they use too much memory, or they have been idle for
+    too long. A chat whose stored version is newer than the resident copy
+    (updated by another instance) is reloaded, and a turn is only saved over
+    the version it started from; if another instance saved first, the turn is
+    added after the stored history instead of overwriting it.
+    """
+
+    def __init__(
+        self,
+        gemini,
+        engine,
+        model: str,
+        system_instruction: str,
+        max_sessions: int = CHAT_SESSION_MAX,
+        max_bytes: int = CHAT_SESSION_MAX_BYTES,
+        idle_ttl: int = CHAT_SESSION_IDLE_TTL,
+        token_budget: int = CHAT_HISTORY_TOKEN_BUDGET,
+        keep_recent_turns: int = CHAT_KEEP_RECENT_TURNS
+    ):
+        self.gemini = gemini
+        self.engine = engine
+        self.model = model
+        self.system_instruction = system_instruction
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.token_budget = token_budget
+        self.keep_recent_turns = keep_recent_turns
+        self.chats: "OrderedDict[str, ResidentChat]" = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.compactions = 0
+        self._lock = threading.Lock()
+
+    def _create_chat(self, history: Optional[List[types.Content]] = None):
+        return self.gemini.client.aio.chats.create(
+            model=self.model,
+            config=types.GenerateContentConfig(
+                system_instruction=self.system_instruction
+            ),
+            history=history or []
+        )
+
+    def _stored_version(self, session_id: str) -> Optional[int]:
+        with Session(self.engine) as session:
+            return session.exec(
+                select(ChatSession.version).where(ChatSession.session_id == session_id)
+            ).first()
+
+    def _load(self, session_id: str) -> Optional[ChatSession]:
+        with Session(self.engine) as session:
+            return session.get(ChatSession, session_id)
+
+    def _store(self, session_id: str, history: str, expected_version: int) -> Optional[int]:
+        """
+        Save a history over the stored version it was based on (0 for a new
+        session). Returns the new version, or None if another instance saved
+        the session first.
+        """
+        with Session(self.engine) as session:
+            if expected_version == 0:
+                session.add(ChatSession(session_id=session_id, history=history, version=1))
+                try:
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
+                    return None
+                return 1
+            result = session.execute(
+                update(ChatSession)
+                .where(ChatSession.session_id == session_id, ChatSession.version == expected_version)
+                .values(history=history, version=expected_version + 1, updated_at=datetime.now())
+            )
+            session.commit()
+            return expected_version + 1 if result.rowcount == 1 else None
+
+    async def get_resident(self, session_id: str) -> ResidentChat:
+        """Return the chat for a session, loading its history from the database if needed"""
+        self.evict_idle()
+        resident = self.chats.get(session_id)
+        stored_version = await asyncio.to_thread(self._stored_version, session_id)
+
+        if resident is not None and (stored_version is None or stored_version <= resident.version):
+            with self._lock:
+                self.chats.move_to_end(session_id)
+            resident.last_used = time.monotonic()
+            self.hits += 1
+            return resident
+
+        stored = await asyncio.to_thread(self._load, session_id) if stored_version is not None else None
+        if stored is not None:
+            chat = self._create_chat(deserialize_history(stored.history))
+            version, size = stored.version, len(stored.history)
+            self.loads += 1
+            logger.debug(f"Loaded chat {session_id} (version {version}) from the database")
+        else:
+            chat = self._create_chat()
+            version, size = 0, 0
+
+        if resident is not None:
+            # Reuse the per-session lock so concurrent turns stay serialized
+            resident.chat = chat
+            resident.version = version
+            self._resize(resident, size)
+            resident.last_used = time.monotonic()
+            return resident
+
+        with self._lock:
+            if session_id in self.chats:
+                # Another request loaded the same session while this one waited on the database
+                return self.chats[session_id]
+            resident = ResidentChat(chat, version, size)
+            self.chats[session_id] = resident
+            self._size += size
+            self._evict(keep=session_id)
+        return resident
+
+    @asynccontextmanager
+    async def turn(self, session_id: str, question: Optional[str] = None):
+        """
+        Hold a session for one question and answer.
+
+        Turns on the same session run one at a time. When the block exits
+        normally and the chat recorded a new turn, the message sent is
+        replaced by `question` (dropping any library context sent with it),
+        the history is compacted to the token budget and then saved; this
+        runs shielded, so a client going away can't leave it half done. A
+        block that raises, or is abandoned when a stream is closed, leaves
+        the chat as it was before the turn, matching the stored history.
+        """
+        resident = await self.get_resident(session_id)
+        async with resident.lock:
+            before = chat_history(resident.chat)
+            try:
+                yield resident.chat
+            except BaseException:
+                if len(chat_history(resident.chat)) != len(before):
+                    resident.chat = self._create_chat(before)
+                raise
+            finally:
+                resident.last_used = time.monotonic()
+            history = chat_history(resident.chat)
+            if len(history) != len(before):
+                await asyncio.shield(self._finish_turn(session_id, resident, history, len(before), question))
+
+    async def _finish_turn(self, session_id: str, resident: ResidentChat, history: List[types.Content],
+                           turn_start: int, question: Optional[str]):
+        if question is not None:
+            history = replace_last_user_message(history, question)
+        turn = history[turn_start:]
+        for _ in range(CHAT_SAVE_ATTEMPTS):
+            resident.chat = self._create_chat(await self.compact(history))
+            if await self.save_chat(session_id, resident):
+                return
+            # Another instance saved a turn of this session meanwhile: add this one after it
+            stored = await asyncio.to_thread(self._load, session_id)
+            resident.version = stored.version if stored is not None else 0
+            history = (deserialize_history(stored.history) if stored is not None else []) + turn
+        logger.warning(f"Could not save chat {session_id}, other instances kept saving it first")
+
+    async def compact(self, history: List[types.Content]) -> List[types.Content]:
+        """Fold older turns into a rolling summary while the history is over budget"""
+        if history_tokens(history) <= self.token_budget:
+            return history
+
+        # Keep whole recent turns, starting at a user message
+        split = max(len(history) - self.keep_recent_turns * 2, 0)
+        while split > 0 and history[split].role != 'user':
+            split -= 1
+        if split <= 2:
+            # Nothing older than the recent turns besides a previous summary
+            return history
+        older, recent = history[:split], history[split:]
+
+        try:
+            summary = await self._summarize(older)
+        except Exception as e:
+            logger.warning(f"Could not summarize chat history, keeping it as is: {e}")
+            return history
+
+        self.compactions += 1
+        compacted = [
+            types.Content(role='user', parts=[types.Part(text=f"{SUMMARY_PREFIX}\n{summary}")]),
+            types.Content(role='model', parts=[types.Part(text=SUMMARY_ACK)])
+        ] + recent
+        logger.debug(f"Compacted chat history from ~{history_tokens(history)} to ~{history_tokens(compacted)} tokens")
+        return compacted
+
+    async def _summarize(self, history: List[types.Content]) -> str:
+        # A previous summary is part of the transcript, so the summary rolls forward
+        transcript = '\n\n'.join(f"{content.role}: {content_text(content)}" for content in history)
+        response = await self.gemini.generate_content(
+            config=types.GenerateContentConfig(
+                system_instruction=SUMMARY_INSTRUCTION
+            ),
+            contents=transcript
+        )
+        return response.text.strip()
+
+    async def save_chat(self, session_id: str, resident: ResidentChat) -> bool:
+        """
+        Write a chat's history through to the database, unless the stored version
+        is newer than the one the chat was loaded at; returns whether it was saved
+        """
+        history = serialize_history(chat_history(resident.chat))
+        version = await asyncio.to_thread(self._store, session_id, history, resident.version)
+        if version is None:
+            return False
+        resident.version = version
+        self._resize(resident, len(history))
+        with self._lock:
+            self._evict(keep=session_id)
+        return True
+
+    def _resize(self, resident: ResidentChat, size: int):
+        with self._lock:
+            self._size += size - resident.size
+            resident.size = size
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        with self._lock:
+            for session_id in [k for k, v in self.chats.items() if v.last_used < cutoff and not v.lock.locked()]:
+                self._drop(session_id)
+
+    def _evict(self, keep: Optional[str] = None):
+        for session_id in list(self.chats):
+            if len(self.chats) <= self.max_sessions and self._size <= self.max_bytes:
+                break
+            if session_id == keep or self.chats[session_id].lock.locked():
+                continue
+            self._drop(session_id)
+
+    def _drop(self, session_id: str):
+        resident = self.chats.pop(session_id)
+        self._size -= resident.size
+        self.evictions += 1
+        logger.debug(f"Evicted chat {session_id} from memory")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "resident": len(self.chats),
+                "resident_bytes": self._size,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "compactions": self.compactions,
+                "token_budget": self.token_budget
+            }
@@ -0,0 +1,318 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STORAGE_URL_PREFIX = "https://storage.cloud.google.com/"
+DEFAULT_BUCKET = os.getenv('STORAGE_BUCKET', 'intellibook_static')
+
+# "gcs" for Google Cloud Storage, "local" for the filesystem fake used in benchmarks
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'gcs')
+STORAGE_LOCAL_ROOT = os.getenv('STORAGE_LOCAL_ROOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_storage'))
+# Keep-alive connections kept open to the storage API
+STORAGE_POOL_SIZE = int(os.getenv('STORAGE_POOL_SIZE', '16'))
+# A cached signed URL is handed out only while it has at least this long left
+SIGNED_URL_MIN_REMAINING = int(os.getenv('SIGNED_URL_MIN_REMAINING_SECONDS', '3600'))
+SIGNED_URL_CACHE_SIZE = int(os.getenv('SIGNED_URL_CACHE_SIZE', '512'))
+# Uploads are streamed in chunks of this size; a multiple of 256 KB as resumable uploads require
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_MB', '2')) * 1024 * 1024
+
+
+def parse_storage_url(url: str) -> Tuple[str, str]:
+    """Split a https://storage.cloud.google.com/<bucket>/<path> URL into (bucket, path)"""
+    parts = url.replace(STORAGE_URL_PREFIX, "").split("/", 1)
+    bucket_name = parts[0]
+    blob_path = parts[1] if len(parts) > 1 else ""
+    return bucket_name, blob_path
+
+
+def storage_url(bucket_name: str, blob_path: str) -> str:
+    return f"{STORAGE_URL_PREFIX}{bucket_name}/{blob_path}"
+
+
+def create_gcs_client():
+    """Create a storage client whose HTTP session keeps a pool of keep-alive connections"""
+    import google.auth
+    import requests
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import storage
+
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=STORAGE_POOL_SIZE,
+        pool_maxsize=STORAGE_POOL_SIZE
+    )
+    session.mount("https://", adapter)
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
+def create_local_client():
+    return LocalStorageClient(STORAGE_LOCAL_ROOT)
+
+
+_client_factories: Dict[str, Callable] = {
+    'gcs': create_gcs_client,
+    'local': create_local_client,
+}
+
+_client = None
+_buckets: Dict[str, object] = {}
+_lock = threading.Lock()
+
+
+def get_storage_client():
+    """Return the process-wide storage client, creating it on first use"""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                factory = _client_factories.get(STORAGE_BACKEND)
+                if factory is None:
+                    raise ValueError(f"Invalid STORAGE_BACKEND: {STORAGE_BACKEND}")
+                _client = factory()
+                logger.info(f"Created {STORAGE_BACKEND} storage client")
+    return _client
+
+
+def get_bucket(bucket_name: str = DEFAULT_BUCKET):
+    """Return a cached bucket handle"""
+    bucket = _buckets.get(bucket_name)
+    if bucket is None:
+        client = get_storage_client()
+        with _lock:
+            bucket = _buckets.get(bucket_name)
+            if bucket is None:
+                bucket = client.bucket(bucket_name)
+                _buckets[bucket_name] = bucket
+    return bucket
+
+
+def blob_from_url(url: str):
+    """Return a blob handle for a storage URL without fetching its metadata"""
+    bucket_name, blob_path = parse_storage_url(url)
+    return get_bucket(bucket_name).blob(blob_path)
+
+
+def set_storage_client(client):
+    """Replace the storage client, e.g. with a LocalStorageClient for benchmarks"""
+    global _client
+    with _lock:
+        _client = client
+        _buckets.clear()
+
+
+class SignedUrlCache:
+    """
+    Reuses signed URLs per (bucket, blob, method) until they get close to expiry.
+
+    Handing out the same URL lets browsers and CDNs cache what it points to,
+    and skips signing (and any credential refresh) on repeated calls.
+    """
+
+    def __init__(self, min_remaining: int, max_entries: int):
+        self.min_remaining = min_remaining
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, Tuple[str, float]]" = OrderedDict()  # key -> (url, expiry)
+        self._lock = threading.Lock()
+
+    def get_url(self, blob, expiration: timedelta, method: str = "GET") -> Tuple[str, float]:
+        """Return (signed URL, expiry timestamp) for a blob"""
+        key = (blob.bucket.name, blob.name, method)
+        now = time.time()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[1] - now >= self.min_remaining:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        url = blob.generate_signed_url(version="v4", expiration=expiration, method=method)
+        entry = (url, now + expiration.total_seconds())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, url: Optional[str]):
+        """Forget every signed URL for the blob behind a storage URL"""
+        if not url:
+            return
+        bucket_name, blob_path = parse_storage_url(url)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == bucket_name and k[1] == blob_path]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+signed_url_cache = SignedUrlCache(SIGNED_URL_MIN_REMAINING, SIGNED_URL_CACHE_SIZE)
+
+
+class HashingReader:
+    """
+    Wraps a binary file and computes the SHA-256 and size of the data read through it.
+
+    Uploads may seek back to resend a chunk; bytes already hashed are not
+    hashed again, so the digest stays that of the file.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.start = stream.tell()
+        self.size = 0  # Bytes hashed so far, from the starting position
+        self._digest = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        position = self.stream.tell() - self.start
+        data = self.stream.read(size)
+        if position <= self.size < position + len(data):
+            new = data[self.size - position:]
+            self._digest.update(new)
+            self.size += len(new)
+        return data
+
+    def tell(self) -> int:
+        return self.stream.tell() - self.start
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            offset += self.start
+        return self.stream.seek(offset, whence) - self.start
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+
+def upload_stream(blob, stream, size: Optional[int] = None, **kwargs):
+    """
+    Upload a binary stream to a blob holding at most one chunk in memory.
+    Anything larger than a chunk goes as a resumable upload, one chunk per request.
+    """
+    if size is not None and size <= UPLOAD_CHUNK_SIZE:
+        blob.upload_from_file(stream, size=size, **kwargs)
+    else:
+        blob.chunk_size = UPLOAD_CHUNK_SIZE
+        blob.upload_from_file(stream, **kwargs)
+
+
+def hash_blob(blob) -> Tuple[str, int]:
+    """SHA-256 and size of a stored blob, read back one chunk at a time"""
+    digest = hashlib.sha256()
+    size = 0
+    with blob.open('rb', chunk_size=UPLOAD_CHUNK_SIZE) as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class LocalStorageClient:
+    """
+    Filesystem stand-in for google.cloud.storage.Client.
+
+    Implements the subset of the bucket/blob API the app uses, so storage
+    paths can be benchmarked without network access.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def bucket(self, bucket_name: str) -> "LocalBucket":
+        return LocalBucket(self, bucket_name)
+
+
+class LocalBucket:
+    def __init__(self, client: LocalStorageClient, name: str):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+
+    def blob(self, blob_name: str) -> "LocalBlob":
+        return LocalBlob(self, blob_name)
+
+    def get_blob(self, blob_name: str) -> Optional["LocalBlob"]:
+        blob = LocalBlob(self, blob_name)
+        return blob if blob.exists() else None
+
+    def copy_blob(self, blob: "LocalBlob", destination_bucket: "LocalBucket", new_name: str) -> "LocalBlob":
+        new_blob = destination_bucket.blob(new_name)
+        os.makedirs(os.path.dirname(new_blob.path), exist_ok=True)
+        shutil.copyfile(blob.path, new_blob.path)
+        return new_blob
+
+
+class LocalBlob:
+    def __init__(self, bucket: LocalBucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, name)
+
+    def exists(self, **kwargs) -> bool:
+        return os.path.isfile(self.path)
+
+    @property
+    def generation(self) -> Optional[int]:
+        return os.stat(self.path).st_mtime_ns if self.exists() else None
+
+    @property
+    def etag(self) -> Optional[str]:
+        generation = self.generation
+        return hashlib.md5(str(generation).encode()).hexdigest() if generation else None
+
+    @property
+    def size(self) -> Optional[int]:
+        return os.path.getsize(self.path) if self.exists() else None
+
+    def reload(self, **kwargs):
+        if not self.exists():
+            raise FileNotFoundError(self.path)
+
+    def upload_from_filename(self, filename: str, **kwargs):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+    def upload_from_file(self, file_obj, size: Optional[int] = None, **kwargs):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as f:
+            if size is None:
+                shutil.copyfileobj(file_obj, f, UPLOAD_CHUNK_SIZE)
+            else:
+                f.write(file_obj.read(size))
+
+    def open(self, mode: str = 'rb', **kwargs):
+        return open(self.path, mode)
+
+    def download_to_filename(self, filename: str, **kwargs):
+        shutil.copyfile(self.path, filename)
+
+    def delete(self, **kwargs):
+        os.remove(self.path)
+
+    def generate_signed_url(self, expiration=None, method: str = "GET", **kwargs) -> str:
+        if isinstance(expiration, timedelta):
+            expires = int(time.time() + expiration.total_seconds())
+        else:
+            expires = int(expiration or 0)
+        return f"file://{self.path}?method={method}&expires={expires}"
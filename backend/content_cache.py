@@ -0,0 +1,347 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Separator placed between pages/chapters in the full text
+SECTION_SEPARATOR = '\n\n'
+
+
+def file_fingerprint(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return a SHA-256 based fingerprint of a local file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+class ContentEntry:
+    """
+    A cached book text together with its manifest.
+
+    The manifest lists every section (PDF page or EPUB chapter) with its
+    character offset and length in the full text, plus the matching byte
+    range in the UTF-8 file so a slice can be read without loading the book.
+    """
+
+    def __init__(self, text_path: str, manifest: dict):
+        self.text_path = text_path
+        self.manifest = manifest
+        self._starts = [section['offset'] for section in manifest['sections']]
+
+    @property
+    def total_length(self) -> int:
+        return self.manifest['total_length']
+
+    def public_manifest(self) -> dict:
+        """Manifest without the internal byte offsets"""
+        return {
+            "kind": self.manifest['kind'],
+            "total_length": self.manifest['total_length'],
+            "sections": [
+                {
+                    "index": section['index'],
+                    "title": section.get('title'),
+                    "offset": section['offset'],
+                    "length": section['length']
+                }
+                for section in self.manifest['sections']
+            ]
+        }
+
+    def read_all(self) -> str:
+        with open(self.text_path, 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    def read_section(self, index: int) -> str:
+        section = self.manifest['sections'][index]
+        return self._read_bytes(section['byte_offset'], section['byte_length'])
+
+    def read_range(self, offset: int, length: int) -> str:
+        """Return the text between two character offsets of the full text"""
+        sections = self.manifest['sections']
+        offset = max(0, min(offset, self.total_length))
+        end = max(offset, min(offset + length, self.total_length))
+        if not sections or end == offset:
+            return ''
+
+        first = sections[max(bisect_right(self._starts, offset) - 1, 0)]
+        last = sections[max(bisect_left(self._starts, end) - 1, 0)]
+
+        byte_start = first['byte_offset']
+        byte_end = last['byte_offset'] + last['byte_length']
+        text = self._read_bytes(byte_start, byte_end - byte_start)
+        return text[offset - first['offset']:end - first['offset']]
+
+    def iter_sections(self):
+        """Yield (index, text) for every section, one at a time"""
+        with open(self.text_path, 'rb') as f:
+            for section in self.manifest['sections']:
+                f.seek(section['byte_offset'])
+                yield section['index'], f.read(section['byte_length']).decode('utf-8')
+
+    def _read_bytes(self, start: int, length: int) -> str:
+        with open(self.text_path, 'rb') as f:
+            f.seek(start)
+            return f.read(length).decode('utf-8')
+
+
+class ContentCache:
+    """
+    Disk-backed LRU cache for extracted ebook text.
+
+    Entries are stored as a text file and a JSON manifest per (book_id,
+    fingerprint) pair, so a new upload of the same book never collides with
+    an old entry. Recency is kept in memory and rebuilt from file
+    modification times on startup. The entry being written is never evicted
+    by its own insertion, so a single book larger than the cap is still
+    served and is dropped on the next insertion.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # key -> size, oldest first
+        self._size = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                # Leftover from an interrupted write
+                os.remove(path)
+                continue
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            text_path = os.path.join(self.directory, f"{key}.txt")
+            if not os.path.exists(text_path):
+                os.remove(path)
+                continue
+            size = os.path.getsize(path) + os.path.getsize(text_path)
+            entries.append((os.path.getmtime(path), key, size))
+
+        # Text files without a manifest come from an older layout or a crash
+        for name in os.listdir(self.directory):
+            if name.endswith('.txt') and not os.path.exists(os.path.join(self.directory, name[:-4] + '.json')):
+                os.remove(os.path.join(self.directory, name))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+        logger.info(f"Content cache loaded {len(self._entries)} entries ({self._size} bytes) from {self.directory}")
+        self._evict()
+
+    @staticmethod
+    def _key(book_id: int, fingerprint: str) -> str:
+        safe_fingerprint = ''.join(c for c in fingerprint if c.isalnum())
+        return f"{book_id}_{safe_fingerprint}"
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, key)
+        return f"{base}.txt", f"{base}.json"
+
+    def get(self, book_id: int, fingerprint: str) -> Optional[ContentEntry]:
+        key = self._key(book_id, fingerprint)
+        text_path, manifest_path = self._paths(key)
+
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            os.utime(manifest_path)  # Keep recency across restarts
+        except FileNotFoundError:
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return ContentEntry(text_path, manifest)
+
+    def entry_paths(self, book_id: int, fingerprint: str) -> Tuple[str, str]:
+        """Return the (text, manifest) paths an entry is stored at"""
+        return self._paths(self._key(book_id, fingerprint))
+
+    def writer(self, book_id: int, fingerprint: str, kind: str) -> "ContentWriter":
+        """Start writing an entry section by section"""
+        key = self._key(book_id, fingerprint)
+        text_path, manifest_path = self._paths(key)
+        return ContentWriter(text_path, manifest_path, kind, on_commit=lambda size: self._register(key, size))
+
+    def register(self, book_id: int, fingerprint: str) -> ContentEntry:
+        """
+        Add an entry written at entry_paths() by another process.
+        Raises FileNotFoundError if the files are missing.
+        """
+        key = self._key(book_id, fingerprint)
+        text_path, manifest_path = self._paths(key)
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        self._register(key, os.path.getsize(text_path) + os.path.getsize(manifest_path))
+        return ContentEntry(text_path, manifest)
+
+    def put(self, book_id: int, fingerprint: str, sections: Iterable[Tuple[Optional[str], str]], kind: str) -> ContentEntry:
+        """
+        Store a book from an iterable of (title, text) sections.
+
+        Sections are written to disk as they arrive, so the whole book is
+        never held in memory at once.
+        """
+        writer = self.writer(book_id, fingerprint, kind)
+        try:
+            for title, text in sections:
+                writer.write(title, text)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def _register(self, key: str, size: int):
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = size
+            self._size += size
+            self._evict(keep=key)
+
+    def invalidate(self, book_id: int):
+        """Remove every cached entry for a book, whatever its fingerprint"""
+        prefix = f"{book_id}_"
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._forget(key)
+                self._remove_files(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+    def _forget(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self, keep: Optional[str] = None):
+        for key in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self._forget(key)
+            self.evictions += 1
+            self._remove_files(key)
+            logger.debug(f"Evicted {key} from content cache")
+
+    def _remove_files(self, key: str):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ContentWriter:
+    """
+    Incremental writer for a cache entry.
+
+    Text goes to temporary files which only become visible on commit(), so
+    readers never see a partial entry and an aborted extraction leaves
+    nothing behind.
+    """
+
+    def __init__(self, text_path: str, manifest_path: str, kind: str, on_commit: Optional[Callable[[int], None]] = None):
+        self._text_path = text_path
+        self._manifest_path = manifest_path
+        self._on_commit = on_commit
+        self._suffix = f".{os.getpid()}.{threading.get_ident()}.{id(self)}.tmp"
+        self._kind = kind
+        self._sections = []
+        self._char_offset = 0
+        self._byte_offset = 0
+        self._file = open(text_path + self._suffix, 'wb')
+
+    def write(self, title: Optional[str], text: str) -> dict:
+        """Append a section and return its manifest record"""
+        if self._sections:
+            separator = SECTION_SEPARATOR.encode('utf-8')
+            self._file.write(separator)
+            self._char_offset += len(SECTION_SEPARATOR)
+            self._byte_offset += len(separator)
+
+        data = text.encode('utf-8', errors='replace')
+        self._file.write(data)
+        section = {
+            "index": len(self._sections),
+            "title": title,
+            "offset": self._char_offset,
+            "length": len(text),
+            "byte_offset": self._byte_offset,
+            "byte_length": len(data)
+        }
+        self._sections.append(section)
+        self._char_offset += len(text)
+        self._byte_offset += len(data)
+        return section
+
+    @property
+    def total_length(self) -> int:
+        return self._char_offset
+
+    def commit(self, **fields) -> ContentEntry:
+        """Make the entry visible; extra fields, e.g. an index, are stored in its manifest"""
+        manifest = {
+            "kind": self._kind,
+            "total_length": self._char_offset,
+            "sections": self._sections,
+            **fields
+        }
+        try:
+            self._file.close()
+            with open(self._manifest_path + self._suffix, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+            os.replace(self._text_path + self._suffix, self._text_path)
+            os.replace(self._manifest_path + self._suffix, self._manifest_path)
+        except BaseException:
+            self.abort()
+            raise
+
+        if self._on_commit is not None:
+            self._on_commit(os.path.getsize(self._text_path) + os.path.getsize(self._manifest_path))
+        return ContentEntry(self._text_path, manifest)
+
+    def abort(self):
+        self._file.close()
+        for path in (self._text_path + self._suffix, self._manifest_path + self._suffix):
+            if os.path.exists(path):
+                os.remove(path)
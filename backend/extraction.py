@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+import ebooklib
+from bs4 import BeautifulSoup
+from ebooklib import epub
+from PyPDF2 import PdfReader
+
+from content_cache import SECTION_SEPARATOR, ContentWriter
+
+logger = logging.getLogger(__name__)
+
+# Largest paragraph group returned as one section of a plain text book
+TEXT_SECTION_CHARS = 50000
+
+
+def iter_epub_sections(epub_path):
+    """Yield (title, text) for every document item of an EPUB"""
+    book = epub.read_epub(epub_path)
+    for item in book.get_items():
+        if item.get_type() == ebooklib.ITEM_DOCUMENT:
+            soup = BeautifulSoup(item.get_content(), 'html.parser')
+            heading = soup.find(['h1', 'h2', 'h3', 'title'])
+            title = heading.get_text(strip=True) if heading else None
+            yield title or None, soup.get_text()
+
+
+def iter_pdf_sections(pdf_path):
+    """Yield (title, text) for every page of a PDF"""
+    # Pass a file object so PyPDF2 reads pages on demand instead of copying the whole file into memory
+    with open(pdf_path, 'rb') as f:
+        reader = PdfReader(f)
+        for page in reader.pages:
+            yield None, page.extract_text() or ''
+
+
+def iter_text_sections(text_path):
+    """
+    Yield (title, text) blocks of a plain text file.
+    Blocks are split on blank lines, so joining them with SECTION_SEPARATOR
+    gives back the original text.
+    """
+    with open(text_path, 'r', encoding='utf-8', errors='ignore') as f:
+        content = f.read()
+
+    block = []
+    block_length = 0
+    for paragraph in content.split(SECTION_SEPARATOR):
+        if block and block_length + len(paragraph) > TEXT_SECTION_CHARS:
+            yield None, SECTION_SEPARATOR.join(block)
+            block = []
+            block_length = 0
+        block.append(paragraph)
+        block_length += len(paragraph) + len(SECTION_SEPARATOR)
+    yield None, SECTION_SEPARATOR.join(block)
+
+
+def iter_ebook_sections(file_path):
+    """Return the section kind and a (title, text) iterator based on the file extension"""
+    extension = os.path.splitext(file_path)[1].lower()[1:]  # Remove the dot
+
+    if extension == 'pdf':
+        logger.debug("Extracting text from PDF")
+        return 'page', iter_pdf_sections(file_path)
+    elif extension == 'epub':
+        logger.debug("Extracting text from EPUB")
+        return 'chapter', iter_epub_sections(file_path)
+    else:
+        logger.debug("Reading plain text file")
+        return 'block', iter_text_sections(file_path)
+
+
+def extract_text_from_epub(epub_path):
+    return SECTION_SEPARATOR.join(text for _, text in iter_epub_sections(epub_path))
+
+
+def extract_text_from_pdf(pdf_path):
+    return SECTION_SEPARATOR.join(text for _, text in iter_pdf_sections(pdf_path))
+
+
+def extract_to_files(file_path: str, text_path: str, manifest_path: str) -> int:
+    """
+    Extract an ebook into a content cache entry at the given paths.
+    Runs inside an extraction worker process; returns the text length.
+    """
+    kind, sections = iter_ebook_sections(file_path)
+    writer = ContentWriter(text_path, manifest_path, kind)
+    try:
+        for title, text in sections:
+            writer.write(title, text)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit().total_length
+
+
+class ExtractionQueueFull(Exception):
+    """Raised when too many extractions are already waiting for a slot"""
+
+
+class ExtractionPool:
+    """
+    Process pool for CPU-bound ebook parsing.
+
+    At most max_concurrent extractions hold a slot at a time, which bounds
+    the memory spent on downloaded files and parser state; up to max_queue
+    more may wait for a slot before new requests are rejected.
+    """
+
+    def __init__(self, workers: int, max_concurrent: int, max_queue: int):
+        self.workers = workers
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._waiting = 0
+        self._running = 0
+        self._semaphore = None
+        self._executor = None
+
+    def start(self):
+        """
+        Fork the worker processes now. Call it before the app starts any thread:
+        a thread holding a lock while the process forks leaves that lock held
+        forever in the child.
+        """
+        if self._executor is not None:
+            return
+        # Fork rather than spawn or forkserver: those re-import __main__ in every worker,
+        # which re-runs the whole app setup when the server is started with `python main.py`
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('fork')
+        )
+        # A fork-based pool starts all its workers on the first task and never forks again
+        self._executor.submit(os.getpid).result()
+        logger.info(f"Started {self.workers} extraction workers")
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            logger.warning("Extraction pool started after the app, its workers may inherit held locks")
+            self.start()
+        return self._executor
+
+    async def acquire(self):
+        """Wait for an extraction slot, or raise ExtractionQueueFull"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise ExtractionQueueFull()
+
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        self._running += 1
+
+    def release(self):
+        self._running -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run(self, func, *args):
+        """Run func(*args) in a worker process and await its result"""
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._get_executor(), func, *args)
+        except Exception:
+            self.failed += 1
+            raise
+        self.completed += 1
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "running": self._running,
+            "waiting": self._waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,132 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, List, Optional
+
+from sqlalchemy import delete, func, or_, update
+from sqlmodel import Session, select
+
+from models import StoredFile
+
+logger = logging.getLogger(__name__)
+
+# A file that was just stored or reused isn't deleted for this long, even
+# with no references, so the book about to point at it can still do so
+STORED_FILE_LEASE = timedelta(hours=int(os.getenv('STORED_FILE_LEASE_HOURS', '24')))
+
+
+def content_filename(sha256: str, filename: str) -> str:
+    """Name of a file stored by content; the extension is kept since extraction and players go by it"""
+    return sha256 + os.path.splitext(filename or '')[1].lower()
+
+
+def sha256_from_filename(filename: str) -> Optional[str]:
+    """The SHA-256 a content-addressed file name starts with, or None for other names"""
+    name = os.path.splitext(os.path.basename(filename or ''))[0]
+    if len(name) == 64 and all(c in '0123456789abcdef' for c in name):
+        return name
+    return None
+
+
+class StoredFiles:
+    """
+    Reference counts of content-addressed files.
+
+    A file is registered once it's in storage and counted once for every
+    book field pointing at it. References change in the same transaction as
+    the books. Storing or reusing a file takes a lease on it in the same
+    statement that checks it's there, and a file is only deleted once it has
+    no references and its lease has run out: a book about to point at a file
+    never finds it gone, and files no book ended up using are collected
+    later. Files stored before content addressing have no row and are never
+    counted.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.reused = 0  # Uploads skipped because the content was already stored
+        self._lock = threading.Lock()
+
+    def reserve(self, location: str) -> bool:
+        """Take a lease on a stored file; False if it isn't stored and has to be uploaded"""
+        with Session(self.engine) as session:
+            result = session.execute(
+                update(StoredFile).where(StoredFile.location == location)
+                .values(reserved_until=datetime.now() + STORED_FILE_LEASE)
+            )
+            session.commit()
+        if result.rowcount != 1:
+            return False
+        with self._lock:
+            self.reused += 1
+        return True
+
+    def register(self, location: str, sha256: str, size: Optional[int] = None):
+        """Record a file that is now in storage, leased until a book uses it"""
+        with Session(self.engine) as session:
+            session.add(StoredFile(
+                location=location, sha256=sha256, size=size, reserved_until=datetime.now() + STORED_FILE_LEASE
+            ))
+            try:
+                session.commit()
+                return
+            except Exception:
+                # Registered by a concurrent upload of the same content
+                session.rollback()
+        self.reserve(location)
+
+    def change_refs(self, session: Session, added: Iterable[str], removed: Iterable[str]):
+        """Count new references and drop old ones inside the caller's transaction"""
+        for location in added:
+            session.execute(
+                update(StoredFile).where(StoredFile.location == location).values(refcount=StoredFile.refcount + 1)
+            )
+        for location in removed:
+            session.execute(
+                update(StoredFile)
+                .where(StoredFile.location == location, StoredFile.refcount > 0)
+                .values(refcount=StoredFile.refcount - 1)
+            )
+
+    def collect(self, delete_file: Callable[[str], bool]) -> List[str]:
+        """
+        Delete the files no book uses whose lease has run out. Each row is
+        deleted first, which holds off a concurrent reserve until the commit,
+        and brought back if delete_file fails. Returns the deleted files.
+        """
+        def collectable():
+            return (
+                StoredFile.refcount <= 0,
+                or_(StoredFile.reserved_until.is_(None), StoredFile.reserved_until < datetime.now())
+            )
+
+        with Session(self.engine) as session:
+            candidates = session.exec(select(StoredFile.location).where(*collectable())).all()
+
+        deleted = []
+        for location in candidates:
+            with Session(self.engine) as session:
+                result = session.execute(delete(StoredFile).where(StoredFile.location == location, *collectable()))
+                if result.rowcount != 1:
+                    # Reserved or used again since it was selected
+                    session.rollback()
+                    continue
+                if not delete_file(location):
+                    session.rollback()
+                    continue
+                session.commit()
+                deleted.append(location)
+        return deleted
+
+    def stats(self) -> dict:
+        with Session(self.engine) as session:
+            files, total_bytes, references = session.exec(
+                select(func.count(), func.coalesce(func.sum(StoredFile.size), 0), func.coalesce(func.sum(StoredFile.refcount), 0))
+            ).one()
+        return {
+            "files": int(files),
+            "bytes": int(total_bytes),
+            "references": int(references),
+            "reused_uploads": self.reused
+        }
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.0-flash')
+# Requests per minute allowed across the whole process, and how many may go out back to back
+GEMINI_RPM = float(os.getenv('GEMINI_RPM', '15'))
+GEMINI_BURST = int(os.getenv('GEMINI_BURST', '3'))
+GEMINI_MAX_CONCURRENT = int(os.getenv('GEMINI_MAX_CONCURRENT', '4'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '4'))
+GEMINI_BACKOFF_BASE = float(os.getenv('GEMINI_BACKOFF_BASE', '1.0'))
+GEMINI_BACKOFF_MAX = float(os.getenv('GEMINI_BACKOFF_MAX', '30.0'))
+
+RETRYABLE_STATUS_CODES = {429, 500, 503}
+
+# Rough estimate, good enough for budgeting prompts without a count_tokens call
+CHARS_PER_TOKEN = 4
+
+# Number of recent calls kept for latency percentiles
+STATS_WINDOW = 200
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+def is_retryable(error: Exception) -> bool:
+    """True for rate limiting and transient server errors"""
+    code = getattr(error, 'code', None)
+    if code in RETRYABLE_STATUS_CODES:
+        return True
+    message = str(error)
+    return "429" in message or "RESOURCE_EXHAUSTED" in message or "UNAVAILABLE" in message
+
+
+class TokenBucket:
+    """
+    Async token bucket.
+
+    Tokens refill continuously at `rate` per second up to `capacity`;
+    acquire() waits until one is available. Waiters are served in order.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class CallStats:
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self._waits = deque(maxlen=STATS_WINDOW)
+        self._latencies = deque(maxlen=STATS_WINDOW)
+        self._prompt_tokens = deque(maxlen=STATS_WINDOW)
+
+    def record(self, wait: float, latency: Optional[float]):
+        self._waits.append(wait)
+        if latency is not None:
+            self._latencies.append(latency)
+
+    def record_usage(self, usage_metadata):
+        """Keep the prompt size reported by the API for a finished request"""
+        prompt_tokens = getattr(usage_metadata, 'prompt_token_count', None)
+        if prompt_tokens is not None:
+            self._prompt_tokens.append(prompt_tokens)
+
+    @staticmethod
+    def _summary(values) -> dict:
+        if not values:
+            return {"avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        ordered = sorted(values)
+        return {
+            "avg": sum(ordered) / len(ordered),
+            "p50": ordered[len(ordered) // 2],
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            "max": ordered[-1]
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "errors": self.errors,
+            "queue_wait_seconds": self._summary(self._waits),
+            "latency_seconds": self._summary(self._latencies),
+            "prompt_tokens": self._summary(self._prompt_tokens)
+        }
+
+
+class GeminiClient:
+    """
+    Wrapper around the async genai client.
+
+    Every request first takes a concurrency slot and a rate limiter token,
+    then retries rate limiting and transient errors with jittered
+    exponential backoff. Queue wait and latency are recorded per operation.
+    """
+
+    def __init__(
+        self,
+        client,
+        rpm: float = GEMINI_RPM,
+        burst: int = GEMINI_BURST,
+        max_concurrent: int = GEMINI_MAX_CONCURRENT,
+        max_retries: int = GEMINI_MAX_RETRIES
+    ):
+        self.client = client
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rpm / 60.0, burst)
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._stats: Dict[str, CallStats] = {}
+        self._in_flight = 0
+
+    def _operation_stats(self, operation: str) -> CallStats:
+        if operation not in self._stats:
+            self._stats[operation] = CallStats()
+        return self._stats[operation]
+
+    @asynccontextmanager
+    async def slot(self, operation: str):
+        """
+        Hold a concurrency slot and a rate limiter token for one request.
+        Yields the time spent waiting for them.
+        """
+        stats = self._operation_stats(operation)
+        queued = time.monotonic()
+        async with self._semaphore:
+            await self._bucket.acquire()
+            wait = time.monotonic() - queued
+            stats.calls += 1
+            self._in_flight += 1
+            started = time.monotonic()
+            try:
+                yield wait
+            except BaseException:
+                stats.record(wait, None)
+                raise
+            else:
+                stats.record(wait, time.monotonic() - started)
+            finally:
+                self._in_flight -= 1
+
+    async def call(self, operation: str, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Run an async genai call under the limiter, retrying retryable errors"""
+        stats = self._operation_stats(operation)
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.slot(operation):
+                    result = await func(*args, **kwargs)
+                stats.record_usage(getattr(result, 'usage_metadata', None))
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    stats.errors += 1
+                    raise
+                # Full jitter keeps concurrent retries from lining up again
+                delay = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+                stats.retries += 1
+                logger.warning(f"Gemini {operation} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def generate_content(self, **kwargs):
+        kwargs.setdefault('model', GEMINI_MODEL)
+        return await self.call("generate_content", self.client.aio.models.generate_content, **kwargs)
+
+    async def send_message(self, chat, message, **kwargs):
+        # AsyncChat only records the turn in its history on success, so retrying is safe
+        return await self.call("chat", chat.send_message, message, **kwargs)
+
+    async def stream_message(self, chat, message, **kwargs):
+        """
+        Yield response chunks of a chat turn as they arrive.
+
+        The concurrency slot is held until the stream ends. A failure is only
+        retried before the first chunk, since nothing has reached the caller yet.
+        """
+        stats = self._operation_stats("chat_stream")
+        for attempt in range(self.max_retries + 1):
+            started = False
+            usage_metadata = None
+            try:
+                async with self.slot("chat_stream"):
+                    stream = await chat.send_message_stream(message, **kwargs)
+                    async for chunk in stream:
+                        started = True
+                        # The final chunk carries the usage for the whole request
+                        usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata
+                        yield chunk
+                stats.record_usage(usage_metadata)
+                return
+            except Exception as e:
+                if started or attempt >= self.max_retries or not is_retryable(e):
+                    stats.errors += 1
+                    raise
+                delay = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+                stats.retries += 1
+                logger.warning(f"Gemini chat_stream failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def upload_file(self, path: str):
+        return await self.call("files", self.client.aio.files.upload, file=path)
+
+    async def delete_file(self, name: str):
+        return await self.call("files", self.client.aio.files.delete, name=name)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self._in_flight,
+            "operations": {name: stats.to_dict() for name, stats in self._stats.items()}
+        }
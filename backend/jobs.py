@@ -0,0 +1,219 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import func, update
+from sqlmodel import Session, select
+
+from models import Job
+
+logger = logging.getLogger(__name__)
+
+# Jobs run at the same time in this process
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# A failed attempt is retried after this many seconds, doubled on every further failure
+JOB_RETRY_BASE = float(os.getenv('JOB_RETRY_BASE_SECONDS', '10'))
+# Idle workers look for due jobs (e.g. retries) this often even when nothing was enqueued
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '5'))
+# A job still marked running after this long belonged to a process that died;
+# running jobs are touched a few times within this period so they never look stale
+JOB_STALE_AFTER = int(os.getenv('JOB_STALE_AFTER_SECONDS', '900'))
+# Idle workers look for stale jobs this often
+JOB_RECOVER_INTERVAL = float(os.getenv('JOB_RECOVER_INTERVAL_SECONDS', '60'))
+
+MAX_ERROR_CHARS = 2000
+
+
+class JobRun:
+    """A claimed job as seen by its handler"""
+
+    def __init__(self, queue: "JobQueue", job: Job):
+        self.queue = queue
+        self.id = job.id
+        self.kind = job.kind
+        self.book_id = job.book_id
+        self.attempts = job.attempts
+        self.payload = json.loads(job.payload or '{}')
+
+    async def stage(self, name: str):
+        """Record the stage about to run, together with the payload so far"""
+        await asyncio.to_thread(self.queue._set, self.id, stage=name, payload=json.dumps(self.payload))
+
+
+Handler = Callable[[JobRun], Awaitable[None]]
+
+
+class JobQueue:
+    """
+    Job queue stored in the Job table, processed by a pool of asyncio workers.
+
+    Handlers are registered per job kind and run in stages. The payload is
+    saved at every stage, so a retried job can skip work that already
+    finished. A failed attempt is retried with exponential backoff until
+    max_attempts, then the job is marked failed with the error. Jobs are
+    claimed with a conditional UPDATE, so several workers, or instances
+    sharing the database, never run the same job twice. Jobs left running by
+    a process that died are queued again by the idle workers of any instance.
+    """
+
+    def __init__(self, engine, workers: int = JOB_WORKERS, poll_interval: float = JOB_POLL_INTERVAL):
+        self.engine = engine
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.handlers: Dict[str, Handler] = {}
+        self._tasks = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._recovered_at = 0.0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    def register(self, kind: str, handler: Handler):
+        self.handlers[kind] = handler
+
+    def _insert(self, kind: str, book_id: Optional[int], payload: dict, max_attempts: int) -> Job:
+        with Session(self.engine) as session:
+            job = Job(kind=kind, book_id=book_id, payload=json.dumps(payload), max_attempts=max_attempts)
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+            return job
+
+    async def enqueue(self, kind: str, book_id: Optional[int] = None, payload: Optional[dict] = None,
+                      max_attempts: int = JOB_MAX_ATTEMPTS) -> Job:
+        job = await asyncio.to_thread(self._insert, kind, book_id, payload or {}, max_attempts)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with Session(self.engine) as session:
+            return session.get(Job, job_id)
+
+    def _set(self, job_id: int, **values):
+        with Session(self.engine) as session:
+            session.execute(update(Job).where(Job.id == job_id).values(updated_at=datetime.now(), **values))
+            session.commit()
+
+    def _claim(self) -> Optional[Job]:
+        """Take the oldest due job, or return None if there is none"""
+        with Session(self.engine) as session:
+            candidates = session.exec(
+                select(Job.id)
+                .where(Job.status == "queued", Job.run_after <= datetime.now())
+                .order_by(Job.id)
+                .limit(self.workers)
+            ).all()
+            for job_id in candidates:
+                claimed = session.execute(
+                    update(Job)
+                    .where(Job.id == job_id, Job.status == "queued")
+                    .values(status="running", attempts=Job.attempts + 1, updated_at=datetime.now())
+                )
+                session.commit()
+                if claimed.rowcount == 1:
+                    return session.get(Job, job_id)
+        return None
+
+    def recover(self):
+        """Queue again jobs left running by a process that stopped without finishing them"""
+        with Session(self.engine) as session:
+            result = session.execute(
+                update(Job)
+                .where(Job.status == "running", Job.updated_at < datetime.now() - timedelta(seconds=JOB_STALE_AFTER))
+                .values(status="queued", updated_at=datetime.now())
+            )
+            session.commit()
+            if result.rowcount:
+                logger.warning(f"Requeued {result.rowcount} stale jobs")
+
+    async def _heartbeat(self, job_id: int):
+        while True:
+            await asyncio.sleep(JOB_STALE_AFTER / 3)
+            await asyncio.to_thread(self._set, job_id)
+
+    async def _run(self, job: Job):
+        run = JobRun(self, job)
+        handler = self.handlers.get(job.kind)
+        heartbeat = asyncio.create_task(self._heartbeat(job.id))
+        try:
+            if handler is None:
+                raise ValueError(f"No handler for job kind {job.kind}")
+            await handler(run)
+        except asyncio.CancelledError:
+            # Shutting down: give the attempt back, the job starts again on the next start
+            await asyncio.shield(asyncio.to_thread(
+                self._set, job.id, status="queued", attempts=job.attempts - 1, payload=json.dumps(run.payload)
+            ))
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:MAX_ERROR_CHARS]
+            if job.attempts < job.max_attempts:
+                delay = JOB_RETRY_BASE * 2 ** (job.attempts - 1)
+                logger.warning(f"Job {job.id} ({job.kind}) failed, retrying in {delay:.0f}s: {error}")
+                self.retried += 1
+                await asyncio.to_thread(
+                    self._set, job.id, status="queued", error=error, payload=json.dumps(run.payload),
+                    run_after=datetime.now() + timedelta(seconds=delay)
+                )
+            else:
+                logger.error(f"Job {job.id} ({job.kind}) failed after {job.attempts} attempts: {error}")
+                self.failed += 1
+                await asyncio.to_thread(self._set, job.id, status="failed", error=error, payload=json.dumps(run.payload))
+            return
+        finally:
+            heartbeat.cancel()
+
+        self.completed += 1
+        logger.info(f"Job {job.id} ({job.kind}) done")
+        await asyncio.to_thread(self._set, job.id, status="done", stage=None, error=None, payload=json.dumps(run.payload))
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await asyncio.to_thread(self._claim)
+            except Exception as e:
+                logger.error(f"Error claiming a job: {e}")
+                job = None
+            if job is not None:
+                await self._run(job)
+                continue
+            if time.monotonic() - self._recovered_at >= JOB_RECOVER_INTERVAL:
+                self._recovered_at = time.monotonic()
+                try:
+                    await asyncio.to_thread(self.recover)
+                except Exception as e:
+                    logger.error(f"Error requeuing stale jobs: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        with Session(self.engine) as session:
+            counts = dict(session.exec(select(Job.status, func.count()).group_by(Job.status)).all())
+        return {
+            "workers": self.workers,
+            "by_status": counts,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed
+        }
@@ -0,0 +1,198 @@
+import os
+import re
+import unicodedata
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from gemini import estimate_tokens
+from models import Book, ReadingProgress
+
+# Upper bound for the library data sent with a question
+LIBRARY_CONTEXT_TOKEN_BUDGET = int(os.getenv('LIBRARY_CONTEXT_TOKEN_BUDGET', '2000'))
+
+MAX_NOTES_CHARS = 120
+
+# Status of a book being read: the app writes "Reading", the model's own values are in Spanish
+READING_STATUSES = {"Reading", "Leyendo"}
+
+Row = Tuple[Book, Optional[ReadingProgress]]
+
+
+def normalize(text: Optional[str]) -> str:
+    """Lowercase and strip accents, so "Cien años" matches "cien anos" """
+    if not text:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def words(text: Optional[str]) -> set:
+    return {word for word in re.findall(r'\w+', normalize(text)) if len(word) > 2}
+
+
+def format_seconds(seconds: Optional[int]) -> Optional[str]:
+    if seconds is None:
+        return None
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def format_page(progress: ReadingProgress) -> Optional[str]:
+    if progress.current_page is None:
+        return None
+    if progress.total_pages:
+        return f"{progress.current_page}/{progress.total_pages}"
+    return str(progress.current_page)
+
+
+def format_notes(notes: Optional[str]) -> Optional[str]:
+    if not notes:
+        return None
+    notes = ' '.join(notes.split())
+    return notes if len(notes) <= MAX_NOTES_CHARS else notes[:MAX_NOTES_CHARS - 1] + '…'
+
+
+def with_progress(getter: Callable[[ReadingProgress], object]) -> Callable[[Book, Optional[ReadingProgress]], object]:
+    return lambda book, progress: getter(progress) if progress is not None else None
+
+
+# Column name -> value for a (book, progress) row
+COLUMNS: Dict[str, Callable[[Book, Optional[ReadingProgress]], object]] = {
+    "title": lambda book, progress: book.title,
+    "author": lambda book, progress: book.author,
+    "year": lambda book, progress: book.publish_year,
+    "status": lambda book, progress: book.status,
+    "started": lambda book, progress: book.start_date,
+    "finished": lambda book, progress: book.finish_date,
+    "progress": with_progress(lambda progress: f"{progress.progress_percentage:.0f}%"),
+    "page": with_progress(format_page),
+    "chapter": with_progress(lambda progress: progress.current_chapter),
+    "audio_position": with_progress(lambda progress: format_seconds(progress.audiobook_position)),
+    "last_read": with_progress(lambda progress: progress.last_read_date.date() if progress.last_read_date else None),
+    "notes": with_progress(lambda progress: format_notes(progress.notes)),
+}
+
+BOOK_FIELDS = ["title", "author", "year", "status", "started", "finished"]
+PROGRESS_FIELDS = ["title", "status", "progress", "page", "chapter", "audio_position", "last_read", "notes"]
+
+
+def fields_for(analysis: Dict) -> List[str]:
+    """Columns needed to answer a question, based on its analysis"""
+    required = analysis.get("required_data") or []
+    wants_books = "books" in required or analysis.get("query_type") == "single_book" or not required
+    wants_progress = "reading_progress" in required or analysis.get("query_type") in ("single_book", "reading_progress")
+
+    fields = []
+    for name in (BOOK_FIELDS if wants_books else []) + (PROGRESS_FIELDS if wants_progress else []):
+        if name not in fields:
+            fields.append(name)
+    return fields
+
+
+def title_words(text: Optional[str]) -> List[str]:
+    return re.findall(r'\w+', normalize(text))
+
+
+def main_title(text: Optional[str]) -> str:
+    """A title without its subtitle: "Dune: Deluxe Edition" -> "Dune" """
+    return re.split(r'[:(\[—–]| - ', text or '', maxsplit=1)[0]
+
+
+def titles_match(title: Optional[str], wanted: Optional[str]) -> bool:
+    """
+    True if two titles name the same book, comparing whole words and ignoring
+    case, accents and punctuation: the same words, the same main title once a
+    subtitle is left out, or the first words of the other title when there are
+    at least two of them ("Harry Potter"). A single word only matches a whole
+    main title, so "It" doesn't match "Written in My Own Heart's Blood".
+    """
+    title_list, wanted_list = title_words(title), title_words(wanted)
+    if not title_list or not wanted_list:
+        return False
+    if title_words(main_title(title)) == title_words(main_title(wanted)):
+        return True
+    shorter, longer = sorted((title_list, wanted_list), key=len)
+    return len(shorter) > 1 and longer[:len(shorter)] == shorter
+
+
+def closest_title(books: List[Tuple[int, str]], wanted: str) -> Optional[Tuple[int, str]]:
+    """
+    The (id, title) matching a wanted title, preferring an exact match and then
+    the closest length, e.g. a volume over its saga
+    """
+    matches = [book for book in books if titles_match(book[1], wanted)]
+    wanted_list = title_words(wanted)
+    return min(
+        matches,
+        key=lambda book: (title_words(book[1]) != wanted_list, abs(len(book[1]) - len(wanted)))
+    ) if matches else None
+
+
+def title_matches(book: Book, book_title: Optional[str]) -> bool:
+    return titles_match(book.title, book_title)
+
+
+def rank_rows(rows: List[Row], analysis: Dict, question: str = '') -> List[Row]:
+    """Order rows by how likely they are to matter for the question"""
+    book_title = analysis.get("book_title")
+    question_words = words(question) | words(book_title)
+    wants_progress = "reading_progress" in (analysis.get("required_data") or [])
+
+    def score(row: Row):
+        book, progress = row
+        value = 0
+        if title_matches(book, book_title):
+            value += 100
+        value += 10 * len(question_words & (words(book.title) | words(book.author)))
+        if progress is not None and wants_progress:
+            value += 5
+        if book.status in READING_STATUSES:
+            value += 3
+        last_read = progress.last_read_date if progress is not None and progress.last_read_date else datetime.min
+        return value, last_read
+
+    return sorted(rows, key=score, reverse=True)
+
+
+def format_cell(value) -> str:
+    if value is None or value == '':
+        return '-'
+    return str(value).replace('|', '/').replace('\n', ' ')
+
+
+def build_library_context(rows: List[Row], analysis: Dict, question: str = '', token_budget: int = LIBRARY_CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Encode library rows as a compact table for the prompt.
+
+    Only the columns the question needs are included. Rows are ranked by
+    relevance and the table is cut off once it would exceed the token budget,
+    noting how many books were left out.
+    """
+    rows = rank_rows(rows, analysis, question)
+
+    # A question about one book only needs that book when it can be found
+    if analysis.get("query_type") == "single_book":
+        matches = [row for row in rows if title_matches(row[0], analysis.get("book_title"))]
+        if matches:
+            rows = matches
+    elif analysis.get("query_type") == "reading_progress":
+        # Books never opened add nothing to a progress question
+        rows = [row for row in rows if row[1] is not None] or rows
+
+    fields = fields_for(analysis)
+    lines = [' | '.join(fields)]
+    used = estimate_tokens(lines[0])
+    included = 0
+    for book, progress in rows:
+        line = ' | '.join(format_cell(COLUMNS[name](book, progress)) for name in fields)
+        cost = estimate_tokens(line) + 1
+        if used + cost > token_budget:
+            break
+        lines.append(line)
+        used += cost
+        included += 1
+
+    if included < len(rows):
+        lines.append(f"({len(rows) - included} more books not shown)")
+    return '\n'.join(lines)
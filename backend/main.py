@@ -1,5 +1,6 @@
 import asyncio
 import base64
+import hashlib
 import json
 import logging
 import os
@@ -10,11 +11,14 @@ import re
 from google.cloud.sql.connector import Connector, IPTypes
 import pymysql
 import sqlalchemy
+from sqlalchemy import and_, func, or_
 from datetime import datetime, timedelta
 import time
 
 from fastapi import FastAPI, File, HTTPException, UploadFile, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.staticfiles import StaticFiles
 
 from google.cloud import texttospeech
@@ -22,16 +26,27 @@ from google import genai
 from google.genai import types
 
 from sqlmodel import SQLModel, Session, create_engine, select
-from typing import Dict, List, Union, Optional
+from typing import Awaitable, Dict, List, Set, Tuple, Union, Optional
 from dotenv import load_dotenv
 from models import Book, AUDIOBOOKS_DIR, EBOOKS_DIR, ReadingProgress
-from PyPDF2 import PdfReader
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
 
-from google.cloud import storage
-from auth import get_current_user
+from cloud_storage import (
+    DEFAULT_BUCKET, STORAGE_URL_PREFIX, UPLOAD_CHUNK_SIZE, HashingReader, blob_from_url, get_bucket, hash_blob,
+    parse_storage_url, signed_url_cache, storage_url, upload_stream
+)
+from auth import close_http_client, get_current_user, get_user_info, token_cache_stats
+from content_cache import ContentCache, ContentEntry, file_fingerprint
+from extraction import ExtractionPool, ExtractionQueueFull, extract_to_files, iter_ebook_sections
+from gemini import GEMINI_MODEL, GeminiClient, estimate_tokens
+from chat_sessions import ChatSessionManager, last_exchange_digest, record_exchange
+from answer_cache import AnswerCache
+from search_index import SearchIndex
+from library_context import build_library_context, closest_title
+from routing import QuestionRouter
+from progress_buffer import ProgressBuffer, progress_state
+from jobs import JobQueue, JobRun
+from file_store import StoredFiles, content_filename, sha256_from_filename
+from transcripts import TranscriptIndex, parse_transcription, write_transcript
 
 # Load environment variables first, before setting any variables that depend on them
 load_dotenv()
@@ -107,6 +122,19 @@ os.makedirs(EBOOKS_DIR, exist_ok=True)
 os.makedirs(AUDIOBOOKS_DIR, exist_ok=True)
 os.makedirs(TRANSCRIPTIONS_DIR, exist_ok=True)
 
+# Cache of extracted ebook text, keyed by book id and file fingerprint
+CONTENT_CACHE_DIR = os.getenv('CONTENT_CACHE_DIR', os.path.join(BASE_DIR, "content_cache"))
+CONTENT_CACHE_MAX_MB = int(os.getenv('CONTENT_CACHE_MAX_MB', '256'))
+content_cache = ContentCache(CONTENT_CACHE_DIR, CONTENT_CACHE_MAX_MB * 1024 * 1024)
+
+# Worker processes for ebook text extraction, so parsing never blocks the event loop
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', str(min(os.cpu_count() or 1, 2))))
+EXTRACTION_MAX_CONCURRENT = int(os.getenv('EXTRACTION_MAX_CONCURRENT', str(EXTRACTION_WORKERS)))
+EXTRACTION_MAX_QUEUE = int(os.getenv('EXTRACTION_MAX_QUEUE', '8'))
+extraction_pool = ExtractionPool(EXTRACTION_WORKERS, EXTRACTION_MAX_CONCURRENT, EXTRACTION_MAX_QUEUE)
+# Forked here, before the database connector, HTTP clients and thread pools start their threads
+extraction_pool.start()
+
 # Montar los directorios estáticos
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 app.mount("/static/ebooks", StaticFiles(directory=EBOOKS_DIR), name="ebooks")
@@ -115,6 +143,8 @@ app.mount("/static/transcriptions", StaticFiles(directory=TRANSCRIPTIONS_DIR), n
 
 # Configurar Gemini
 client = genai.Client(api_key=os.getenv('GOOGLE_API_KEY'))
+# All requests go through the shared rate limiter
+gemini = GeminiClient(client)
 
 # Database setup based on DEBUG_MODE
 def get_database_engine():
@@ -212,12 +242,60 @@ def check_and_update_schema():
             # Some other database error, re-raise it
             raise e
 
+def create_missing_indexes():
+    """create_all only creates indexes with new tables, so add any declared later to existing ones"""
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except Exception as e:
+                logger.error(f"Could not create index {index.name}: {e}")
+
+def dedupe_reading_progress():
+    """
+    Keep only the most recent progress row of each book, so the unique index
+    on book_id can be created on databases from before it existed.
+    """
+    with engine.begin() as connection:
+        duplicated = connection.execute(
+            select(ReadingProgress.book_id)
+            .group_by(ReadingProgress.book_id)
+            .having(func.count() > 1)
+        ).scalars().all()
+        if not duplicated:
+            return
+        
+        rows = connection.execute(
+            select(ReadingProgress.id, ReadingProgress.book_id)
+            .where(ReadingProgress.book_id.in_(duplicated))
+            .order_by(ReadingProgress.book_id, ReadingProgress.last_read_date.desc(), ReadingProgress.id.desc())
+        ).all()
+        kept = set()
+        stale_ids = []
+        for row in rows:
+            if row.book_id in kept:
+                stale_ids.append(row.id)
+            else:
+                kept.add(row.book_id)
+        connection.execute(sqlalchemy.delete(ReadingProgress).where(ReadingProgress.id.in_(stale_ids)))
+        logger.warning(f"Removed {len(stale_ids)} duplicate progress rows of {len(duplicated)} books")
+
 # Create tables on startup
 create_db_and_tables()
 
 # Check and update schema if needed
 check_and_update_schema()
 
+# One-off cleanup before the unique index on ReadingProgress.book_id is created
+dedupe_reading_progress()
+
+# Indexes used to filter and sort the library
+create_missing_indexes()
+
+# Full-text index over book contents; raw DDL since it uses FTS5/FULLTEXT
+search_index = SearchIndex(engine)
+search_index.create_schema()
+
 # Define system instructions for different functions
 DORIAN_BASE_INSTRUCTION = """You are Dorian, an AI assistant specialized exclusively in books and literature. You must:
 1. Only respond to questions about books, reading, and literature
@@ -229,7 +307,7 @@ DORIAN_BASE_INSTRUCTION = """You are Dorian, an AI assistant specialized exclusi
 7. Maintain a warm, bookish personality"""
 
 ANALYSIS_INSTRUCTION = """You are a precise analyzer focused only on determining if questions require accessing the book database of the person who is asking the question. You must:
-1. Return only a valid JSON object
+1. Fill in every field of the response schema
 2. Set "needs_db" to true ONLY for questions about:
    - User's personal book collection
    - Reading progress
@@ -242,128 +320,159 @@ ANALYSIS_INSTRUCTION = """You are a precise analyzer focused only on determining
    - "single_book" for specific book queries
    - "all_books" for collection queries
    - "reading_progress" for progress queries
-5. Return {"needs_db": false, "required_data": [], "query_type": null} for non-library questions"""
+5. Set book_title to the title of the specific book the question is about, exactly as written in the question, or null if no specific book is mentioned. Set it even when needs_db is false, e.g. for questions about a book's characters or themes
+6. Return {"needs_db": false, "required_data": [], "query_type": null, "book_title": null} for questions that are neither about the library nor about a specific book"""
+
+# Structured output for analyze_question, so routing and title extraction take a single call
+ANALYSIS_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "needs_db": types.Schema(type=types.Type.BOOLEAN),
+        "required_data": types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(type=types.Type.STRING, enum=["books", "reading_progress"])
+        ),
+        "query_type": types.Schema(
+            type=types.Type.STRING,
+            enum=["single_book", "all_books", "reading_progress"],
+            nullable=True
+        ),
+        "book_title": types.Schema(type=types.Type.STRING, nullable=True)
+    },
+    required=["needs_db", "required_data", "query_type", "book_title"],
+    property_ordering=["needs_db", "required_data", "query_type", "book_title"]
+)
+
+NO_DB_ANALYSIS = {"needs_db": False, "required_data": [], "query_type": None, "book_title": None}
+
+# Ask the model how to answer a question. Raises if the call or its parsing fails
+async def route_question_with_model(question: str) -> Dict[str, Union[bool, List[str], str, None]]:
+    response = await gemini.generate_content(
+        config=types.GenerateContentConfig(
+            system_instruction=ANALYSIS_INSTRUCTION,
+            response_mime_type="application/json",
+            response_schema=ANALYSIS_SCHEMA
+        ),
+        contents=f"Analyze this question: {question}"
+    )
+    logger.debug("Got response from Gemini")
+    
+    try:
+        # The response schema guarantees a bare JSON object
+        result = json.loads(response.text)
+        book_title = result.get("book_title")
+        return {
+            "needs_db": bool(result.get("needs_db", False)),
+            "required_data": list(result.get("required_data") or []),
+            "query_type": result.get("query_type"),
+            "book_title": book_title.strip() if isinstance(book_title, str) and book_title.strip() else None
+        }
+    except (json.JSONDecodeError, AttributeError, TypeError) as e:
+        logger.error(f"Failed to parse text: {response.text}")
+        raise ValueError(f"Invalid routing response: {e}")
+
+# Obvious questions are routed locally, repeated ones from cache
+question_router = QuestionRouter(route_question_with_model)
+
+# Answers to repeated questions, invalidated by any library change
+answer_cache = AnswerCache()
+
+# Progress updates are merged in memory and written in batches. Cached answers
+# don't need invalidating: progress is part of the context they are keyed by
+progress_buffer = ProgressBuffer(engine)
 
 # Función para analizar si la pregunta necesita datos de la BD
-async def analyze_question(question: str) -> Dict[str, Union[bool, List[str]]]:
+async def analyze_question(question: str) -> Dict[str, Union[bool, List[str], str, None]]:
     try:
-        logger.debug("Starting analyze_question")
-        
-        try:
-            response = client.models.generate_content(
-                model="gemini-2.0-flash",
-                config=types.GenerateContentConfig(
-                    system_instruction=ANALYSIS_INSTRUCTION
-                ),
-                contents=f"Analyze this question: {question}"
-            )
-            logger.debug("Got response from Gemini")
-        except Exception as e:
-            if "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
-                logger.warning("Rate limit hit, waiting 2 seconds...")
-                await asyncio.sleep(2)
-                response = client.models.generate_content(
-                    model="gemini-2.0-flash",
-                    config=types.GenerateContentConfig(
-                        system_instruction=ANALYSIS_INSTRUCTION
-                    ),
-                    contents=f"Analyze this question: {question}"
-                )
-            else:
-                raise e
-        
-        # Clean and parse the response
-        text = response.text.strip()
-        #logger.debug(f"Raw response text: {text}")
-        
-        try:
-            # Remove last line and first line of the text
-            text = text.replace('```json', '').replace('```', '')
-            text = text.split('\n')[1:-1]
-            text = ''.join(text)
-            # Remove trailing and leading whitespace
-            text = text.strip()
-
-            # Parse JSON and ensure required fields
-            result = json.loads(text)
-            result = {
-                "needs_db": bool(result.get("needs_db", False)),
-                "required_data": list(result.get("required_data", [])),
-                "query_type": result.get("query_type")
-            }
-            
-            logger.debug(f"Parsed and validated JSON: {result}")
-            return result
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON parsing error: {e}")
-            logger.error(f"Failed to parse text: {text}")
-            return {"needs_db": False, "required_data": [], "query_type": None}
-            
+        result = await question_router.route(question)
+        logger.debug(f"Parsed and validated JSON: {result}")
+        return result
     except Exception as e:
         logger.error(f"Error in analyze_question: {e}", exc_info=True)
-        return {"needs_db": False, "required_data": [], "query_type": None}
+        return dict(NO_DB_ANALYSIS)
 
 # Función para obtener datos relevantes de la BD
-async def get_relevant_data(analysis: Dict) -> str:
+def get_relevant_data(analysis: Dict, question: str = "") -> str:
     with Session(engine) as session:
-        context_data = []
-        
-        if "books" in analysis.get("required_data", []):
-            if analysis.get("query_type") == "single_book":
-                book_title = extract_book_title(analysis.get("question", ""))
-                books = session.exec(
-                    select(Book).where(Book.title.contains(book_title))
-                ).all()
-            else:
-                books = session.exec(select(Book)).all()
-            context_data.extend([{
-                "title": book.title,
-                "author": book.author,
-                "publish_year": book.publish_year,
-                "status": book.status,
-                "start_date": str(book.start_date) if book.start_date else None,
-                "finish_date": str(book.finish_date) if book.finish_date else None
-            } for book in books])
-        
-        if "reading_progress" in analysis.get("required_data", []):
-            progress_data = session.exec(select(ReadingProgress)).all()
-            context_data.extend([{
-                "book_id": prog.book_id,
-                "book_title": prog.book.title,
-                "current_page": prog.current_page,
-                "total_pages": prog.total_pages,
-                "current_chapter": prog.current_chapter,
-                "audiobook_position": prog.audiobook_position,
-                "scroll_position": prog.scroll_position,
-                "progress_percentage": prog.progress_percentage,
-                "last_read_date": str(prog.last_read_date),
-                "notes": prog.notes
-            } for prog in progress_data])
-        
-        return json.dumps(context_data, indent=2)
-
-# Add a chat session manager
-class ChatSessionManager:
-    def __init__(self):
-        self.chats: Dict[str, any] = {}
-    
-    def get_or_create_chat(self, session_id: str) -> any:
-        if session_id not in self.chats:
-            self.chats[session_id] = client.chats.create(
-                model="gemini-2.0-flash",
-                config=types.GenerateContentConfig(
-                    system_instruction=DORIAN_BASE_INSTRUCTION
-                )
-            )
-        return self.chats[session_id]
+        # Books and their progress in a single query
+        rows = session.exec(
+            select(Book, ReadingProgress).outerjoin(ReadingProgress, ReadingProgress.book_id == Book.id)
+        ).all()
+        return build_library_context(rows, analysis, question)
 
 # Initialize the chat manager
-chat_manager = ChatSessionManager()
+chat_manager = ChatSessionManager(gemini, engine, GEMINI_MODEL, DORIAN_BASE_INSTRUCTION)
+
+# Passages attached to questions about a specific book
+PASSAGE_TOP_K = int(os.getenv('PASSAGE_TOP_K', '8'))
+PASSAGE_TOKEN_BUDGET = int(os.getenv('PASSAGE_TOKEN_BUDGET', '1500'))
+
+# Find the library book a title refers to, if any
+def find_library_book(book_title: str) -> Optional[tuple]:
+    with Session(engine) as session:
+        books = session.exec(select(Book.id, Book.title)).all()
+    return closest_title(books, book_title)
+
+# Passages of a book relevant to a question, within the passage token budget
+async def get_book_passages(book_id: int, question: str) -> Optional[str]:
+    if await asyncio.to_thread(search_index.indexed_fingerprint, book_id) is None:
+        # Don't make the reader wait for extraction; the next question will have it
+        schedule_indexing(book_id)
+        return None
+    
+    passages = await asyncio.to_thread(search_index.passages, question, book_id, PASSAGE_TOP_K)
+    lines, used = [], 0
+    for passage in passages:
+        text = ' '.join(passage["text"].split())
+        cost = estimate_tokens(text)
+        if used + cost > PASSAGE_TOKEN_BUDGET:
+            continue
+        lines.append(f"[offset {passage['offset']}] {text}")
+        used += cost
+    return '\n\n'.join(lines) or None
+
+# Build the chat message for a question, adding library data and book passages when it needs them.
+# Returns the message and the context included in it, if any
+async def build_chat_message(question: str) -> tuple:
+    # Analyze the question first
+    analysis = await analyze_question(question)
+    logger.debug(f"Question analysis: {analysis}")
+    
+    sections = []
+    if analysis.get("needs_db", False):
+        # Get context data
+        context_data = await asyncio.to_thread(get_relevant_data, analysis, question)
+        logger.debug(f"Retrieved context data: {context_data}")
+        sections.append(f"Based on this library data of the user who is asking the question:\n{context_data}")
+    
+    # Questions about a book in the library are answered from its own text
+    book = await asyncio.to_thread(find_library_book, analysis["book_title"]) if analysis.get("book_title") else None
+    if book:
+        passages = await get_book_passages(book[0], question)
+        if passages:
+            logger.debug(f"Attached passages from book {book[0]}")
+            sections.append(f"Relevant passages from the user's copy of \"{book[1]}\":\n{passages}")
+    
+    if not sections:
+        # Send question directly
+        return question, None
+    
+    context = '\n\n'.join(sections)
+    return f"{context}\n\nAnswer this question: {question}", context
+
+# Return a cached answer and its cache key, or None if there is none or the cache is bypassed
+def lookup_answer(question: str, context_data: Optional[str], chat, no_cache: bool) -> tuple:
+    """Cached answer and cache key for a question at the current point of a chat"""
+    if no_cache or not answer_cache.enabled:
+        return None, None
+    # Questions answered from library data carry their own context and are reused in any
+    # conversation; anything else may be a follow-up to what was said just before
+    key = answer_cache.key(question, context_data, '' if context_data else last_exchange_digest(chat))
+    return answer_cache.get(key), key
 
 # Modify the ask_gemini endpoint
 @app.get("/api/ask-gemini")
-async def ask_gemini(question: str, session_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+async def ask_gemini(question: str, session_id: Optional[str] = None, no_cache: bool = False, current_user: dict = Depends(get_current_user)):
     try:
         logger.debug(f"Received question: {question}")
         
@@ -371,52 +480,23 @@ async def ask_gemini(question: str, session_id: Optional[str] = None, current_us
         if not session_id:
             session_id = "default"  # You might want to generate unique IDs
         
-        chat = chat_manager.get_or_create_chat(session_id)
-        
-        # Analyze the question first
-        analysis = await analyze_question(question)
-        logger.debug(f"Question analysis: {analysis}")
+        message, context_data = await build_chat_message(question)
         
-        await asyncio.sleep(1)
-        
-        try:
-            if analysis.get("needs_db", False):
-                # Get context data
-                context_data = await get_relevant_data(analysis)
-                logger.debug(f"Retrieved context data: {context_data}")
-                
-                # Send context and question
-                response = chat.send_message(
-                    f"""Based on this library data of the user who is asking the question:
-                    {context_data}
-                    
-                    Answer this question: {question}"""
-                )
+        # Only the bare question stays in the history, and it's saved once the turn completes
+        async with chat_manager.turn(session_id, question) as chat:
+            answer, cache_key = lookup_answer(question, context_data, chat, no_cache)
+            if answer is not None:
+                # Keep the conversation coherent for follow-up questions
+                record_exchange(chat, question, answer)
             else:
-                # Send question directly
-                response = chat.send_message(question)
-                
-        except Exception as e:
-            if "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e):
-                logger.warning("Rate limit hit, waiting 2 seconds...")
-                await asyncio.sleep(2)
-                
-                # Retry with the same logic
-                if analysis.get("needs_db", False):
-                    context_data = await get_relevant_data(analysis)
-                    response = chat.send_message(
-                        f"""Based on this library data of the user who is asking the question:
-                        {context_data}
-                        
-                        Answer this question: {question}"""
-                    )
-                else:
-                    response = chat.send_message(question)
-            else:
-                raise e
+                # Rate limiting and retries are handled by the shared Gemini client
+                response = await gemini.send_message(chat, message)
+                answer = response.text
+                if cache_key:
+                    answer_cache.put(cache_key, answer)
 
         return {
-            "response": response.text,
+            "response": answer,
             "session_id": session_id
         }
     except Exception as e:
@@ -429,24 +509,54 @@ async def ask_gemini(question: str, session_id: Optional[str] = None, current_us
             }
         }
 
-def extract_book_title(question: str) -> str:
-    TITLE_EXTRACTION_INSTRUCTION = """You are a precise book title extractor. You must:
-1. Return ONLY the book title mentioned in the question
-2. Return "None" if no specific book is mentioned
-3. Include both original title and translation if the book is mentioned in another language
-4. Do not include any additional text or explanation"""
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/api/ask-gemini/stream")
+async def ask_gemini_stream(question: str, session_id: Optional[str] = None, no_cache: bool = False, current_user: dict = Depends(get_current_user)):
+    """
+    Same as /api/ask-gemini, but streams the answer as server-sent events.
+
+    Each text chunk is sent as a `data: {"text": ...}` event as soon as the
+    model produces it. The stream ends with an `event: done` carrying the
+    session_id, or an `event: error` if the answer could not be generated.
+    """
+    logger.debug(f"Received streaming question: {question}")
     
-    try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            config=types.GenerateContentConfig(
-                system_instruction=TITLE_EXTRACTION_INSTRUCTION
-            ),
-            contents=question
-        )
-        return response.text.strip()
-    except:
-        return "None"
+    if not session_id:
+        session_id = "default"
+    
+    async def generate():
+        try:
+            message, context_data = await build_chat_message(question)
+            async with chat_manager.turn(session_id, question) as chat:
+                answer, cache_key = lookup_answer(question, context_data, chat, no_cache)
+                if answer is not None:
+                    record_exchange(chat, question, answer)
+                    yield sse_event({"text": answer})
+                else:
+                    parts = []
+                    async for chunk in gemini.stream_message(chat, message):
+                        if chunk.text:
+                            parts.append(chunk.text)
+                            yield sse_event({"text": chunk.text})
+                    if cache_key:
+                        answer_cache.put(cache_key, ''.join(parts))
+            # Sent once the turn is saved, so a client closing the stream on it can't cut the save short
+            yield sse_event({"session_id": session_id}, event="done")
+        except Exception as e:
+            logger.exception("Error in ask_gemini_stream endpoint")
+            yield sse_event({"error": str(e), "session_id": session_id}, event="error")
+    
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
 
 @app.post("/api/transcribe-audio")
 async def transcribe_audio(audio: UploadFile = File(...)):
@@ -463,10 +573,9 @@ async def transcribe_audio(audio: UploadFile = File(...)):
             buffer.write(content)
         
         # Procesar con Gemini
-        myfile = client.files.upload(file=temp_path)
+        myfile = await gemini.upload_file(temp_path)
         
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
+        response = await gemini.generate_content(
             config=types.GenerateContentConfig(
                 system_instruction=DORIAN_BASE_INSTRUCTION
             ),
@@ -475,7 +584,7 @@ async def transcribe_audio(audio: UploadFile = File(...)):
         
         # Limpiar archivo temporal
         os.remove(temp_path)
-        client.files.delete(name=myfile.name)
+        await gemini.delete_file(myfile.name)
 
         # Set the text input to be synthesized
         synthesis_input = texttospeech.SynthesisInput(text=response.text)
@@ -549,16 +658,13 @@ def rename_transcription_file_in_cloud(old_url: str, new_filename: str) -> str:
             return old_url  # Not a cloud storage URL
         
         # Parse the old URL
-        parts = old_url.replace("https://storage.cloud.google.com/", "").split("/", 1)
-        bucket_name = parts[0]
-        old_blob_path = parts[1] if len(parts) > 1 else ""
+        bucket_name, old_blob_path = parse_storage_url(old_url)
         
         # Create new blob path
         new_blob_path = f"transcriptions/{new_filename}"
         
-        # Initialize storage client
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
+        # Shared storage client
+        bucket = get_bucket(bucket_name)
         
         # Copy the blob to new location
         old_blob = bucket.blob(old_blob_path)
@@ -568,7 +674,7 @@ def rename_transcription_file_in_cloud(old_url: str, new_filename: str) -> str:
         old_blob.delete()
         
         # Return new URL
-        new_url = f"https://storage.cloud.google.com/{bucket_name}/{new_blob_path}"
+        new_url = storage_url(bucket_name, new_blob_path)
         logger.info(f"Renamed transcription file from {old_url} to {new_url}")
         return new_url
         
@@ -577,22 +683,20 @@ def rename_transcription_file_in_cloud(old_url: str, new_filename: str) -> str:
         # Return old URL if renaming fails
         return old_url
 
-# Upload a book to Cloud Storage from local file path
-def upload_book_to_cloud_storage(source_file_name, book_type, filename=None):
+# Upload a book to Cloud Storage from a file object
+def upload_book_to_cloud_storage(source, book_type, filename, size=None):
     """
-    Uploads a book file to Google Cloud Storage bucket.
+    Uploads a book file to Google Cloud Storage bucket, streaming it in chunks.
     
     Args:
-        source_file_name: Local path to the file
+        source: Binary file object to read the file from
         book_type: Either 'ebook', 'audiobook', or 'transcription'
-        filename: Optional custom filename to use in the cloud
+        filename: Filename to use in the cloud
+        size: Size of the file in bytes, if known
     
     Returns:
         Public URL of the uploaded file
     """
-    if filename is None:
-        filename = os.path.basename(source_file_name)
-    
     # Truncate filename if too long to prevent database column overflow
     max_filename_length = 80  # Conservative limit to ensure full URL fits in DB
     name, ext = os.path.splitext(filename)
@@ -602,7 +706,7 @@ def upload_book_to_cloud_storage(source_file_name, book_type, filename=None):
         filename = name + ext
         logger.info(f"Truncated long filename to: {filename}")
     
-    bucket_name = "intellibook_static"
+    bucket_name = DEFAULT_BUCKET
     if book_type == 'ebook':
         folder = "ebooks"
     elif book_type == 'audiobook':
@@ -618,11 +722,8 @@ def upload_book_to_cloud_storage(source_file_name, book_type, filename=None):
         from google.cloud.storage import retry
         from google.api_core import retry as api_retry
         
-        # Create storage client with custom retry configuration
-        storage_client = storage.Client()
-        
-        # Get bucket
-        bucket = storage_client.bucket(bucket_name)
+        # Get bucket from the shared storage client
+        bucket = get_bucket(bucket_name)
         
         # Create blob with explicit retry settings
         blob = bucket.blob(destination_blob_name)
@@ -636,17 +737,19 @@ def upload_book_to_cloud_storage(source_file_name, book_type, filename=None):
             predicate=api_retry.if_transient_error
         )
         
-        # Upload with retry and longer timeout
-        blob.upload_from_filename(
-            source_file_name,
+        # Upload with retry and longer timeout, one chunk in memory at a time
+        upload_stream(
+            blob,
+            source,
+            size,
             retry=retry_config,
             timeout=300,
         )
         
-        logger.info(f"File {source_file_name} uploaded to gs://{bucket_name}/{destination_blob_name}")
+        logger.info(f"File {filename} uploaded to gs://{bucket_name}/{destination_blob_name}")
         
         # Return the public URL
-        return f"https://storage.cloud.google.com/{bucket_name}/{destination_blob_name}"
+        return storage_url(bucket_name, destination_blob_name)
     
     except Exception as e:
         logger.error(f"Error uploading to cloud storage: {str(e)}")
@@ -655,19 +758,14 @@ def upload_book_to_cloud_storage(source_file_name, book_type, filename=None):
         logger.error(traceback.format_exc())
         raise e
 
-def copy_file_to_storage(source_path: str, book_type: str, custom_filename: str = None) -> str:
+def copy_file_to_storage(source, book_type: str, filename: str, size: Optional[int] = None) -> str:
     """
-    Copy a file to the appropriate storage location and return the new path.
+    Copy a file object to the appropriate storage location and return the new path.
     In DEBUG_MODE, files are stored locally.
     In production, files are uploaded to Google Cloud Storage.
+    The file is copied in chunks and never read into memory as a whole.
     """
     if DEBUG_MODE:
-        # Get filename (use custom filename if provided, especially for transcriptions)
-        if custom_filename:
-            filename = custom_filename
-        else:
-            filename = os.path.basename(source_path)
-
         if book_type == 'ebook':
             relative_web_path = f"ebooks/{filename}"
             base_dir = EBOOKS_DIR            
@@ -683,9 +781,8 @@ def copy_file_to_storage(source_path: str, book_type: str, custom_filename: str
         # Create target path (absolute for file operations)
         absolute_target_path = os.path.join(base_dir, filename)
         
-        # Copy file if it exists
-        if os.path.exists(source_path):
-            shutil.copy2(source_path, absolute_target_path)
+        with open(absolute_target_path, "wb") as target:
+            shutil.copyfileobj(source, target, UPLOAD_CHUNK_SIZE)
         
         logger.debug(f"DEBUG MODE: File copied locally to {absolute_target_path}")
         logger.debug(f"Returning web-accessible relative path: {relative_web_path}")
@@ -695,9 +792,7 @@ def copy_file_to_storage(source_path: str, book_type: str, custom_filename: str
     else:
         # Production mode - use Google Cloud Storage
         try:
-            # Use custom filename if provided
-            upload_filename = custom_filename if custom_filename else None
-            cloud_url = upload_book_to_cloud_storage(source_path, book_type, upload_filename)
+            cloud_url = upload_book_to_cloud_storage(source, book_type, filename, size)
             logger.info(f"PRODUCTION MODE: File uploaded to cloud: {cloud_url}")
             return cloud_url
         except Exception as e:
@@ -707,6 +802,252 @@ def copy_file_to_storage(source_path: str, book_type: str, custom_filename: str
                 detail=f"Failed to upload file to cloud storage: {str(e)}"
             )
 
+# Larger files have to go through a direct upload URL
+MAX_API_UPLOAD_BYTES = 30 * 1024 * 1024
+
+def check_upload_size(upload: UploadFile, what: str = "File"):
+    if upload.size is not None and upload.size > MAX_API_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"{what} too large for API upload. Use direct upload for files larger than 30MB."
+        )
+
+# Ebooks and audiobooks are stored under the SHA-256 of their content, so each file is stored once
+CONTENT_ADDRESSED_TYPES = ("ebook", "audiobook")
+STORAGE_FOLDERS = {"ebook": "ebooks", "audiobook": "audiobooks", "transcription": "transcriptions"}
+LOCAL_STORAGE_DIRS = {"ebooks": EBOOKS_DIR, "audiobooks": AUDIOBOOKS_DIR, "transcriptions": TRANSCRIPTIONS_DIR}
+stored_files = StoredFiles(engine)
+
+def storage_location(book_type: str, filename: str) -> str:
+    """The path or URL copy_file_to_storage stores a file at"""
+    blob_name = f"{STORAGE_FOLDERS[book_type]}/{filename}"
+    return blob_name if DEBUG_MODE else storage_url(DEFAULT_BUCKET, blob_name)
+
+def store_file(source, book_type: str, filename: str, size: Optional[int] = None) -> Tuple[str, str]:
+    """
+    Stream a file object to storage, hashing it on the way.
+    Ebooks and audiobooks are named after their SHA-256, which is computed
+    first, and aren't uploaded again if that content is already stored.
+    Returns (path or URL, SHA-256 of the file).
+    """
+    reader = HashingReader(source)
+    if book_type not in CONTENT_ADDRESSED_TYPES:
+        result_path = copy_file_to_storage(reader, book_type, filename, size)
+        logger.info(f"Stored {book_type} {filename}: {reader.size} bytes, sha256 {reader.hexdigest()}")
+        return result_path, reader.hexdigest()
+    
+    while reader.read(UPLOAD_CHUNK_SIZE):
+        pass
+    sha256 = reader.hexdigest()
+    location = storage_location(book_type, content_filename(sha256, filename))
+    if stored_files.reserve(location):
+        logger.info(f"{book_type} {filename} is already stored as {location}, not uploading it again")
+        return location, sha256
+    
+    reader.seek(0)
+    result_path = copy_file_to_storage(source, book_type, content_filename(sha256, filename), size)
+    stored_files.register(result_path, sha256, reader.size)
+    logger.info(f"Stored {book_type} {filename}: {reader.size} bytes, sha256 {sha256}")
+    return result_path, sha256
+
+def store_upload(upload: UploadFile, book_type: str, filename: Optional[str] = None) -> Tuple[str, str]:
+    """Stream an uploaded file to storage; returns what store_file returns"""
+    upload.file.seek(0)
+    return store_file(upload.file, book_type, filename or upload.filename, upload.size)
+
+async def store_uploads(uploads: Dict[str, Tuple[UploadFile, Optional[str]]]) -> Dict[str, Tuple[str, str]]:
+    """
+    Store the files of a book at the same time.
+    uploads maps a book_type to (uploaded file, filename or None for its own);
+    the result maps it to what store_upload returned.
+    """
+    results = await asyncio.gather(*[
+        asyncio.to_thread(store_upload, upload, book_type, filename)
+        for book_type, (upload, filename) in uploads.items()
+    ])
+    return dict(zip(uploads, results))
+
+def storage_fields(book_type: str, result_path: str) -> Dict[str, Optional[str]]:
+    """Book fields pointing at a stored file: a local path in DEBUG_MODE, a URL otherwise"""
+    if DEBUG_MODE:
+        return {f"{book_type}_path": result_path, f"{book_type}_url": None}
+    return {f"{book_type}_url": result_path, f"{book_type}_path": None}
+
+def file_locations(book: Book) -> Dict[str, str]:
+    """Content-addressed files a book points at, by book_type"""
+    locations = {}
+    for book_type in CONTENT_ADDRESSED_TYPES:
+        location = getattr(book, f"{book_type}_path") or getattr(book, f"{book_type}_url")
+        if location:
+            locations[book_type] = location
+    return locations
+
+def update_file_refs(session: Session, before: Dict[str, str], after: Dict[str, str]):
+    """
+    Count references to the files a book started or stopped pointing at, in the
+    session saving the book. Files left unused are deleted by collect_stored_files
+    once the session commits.
+    """
+    added = [location for book_type, location in after.items() if before.get(book_type) != location]
+    removed = [location for book_type, location in before.items() if after.get(book_type) != location]
+    stored_files.change_refs(session, added, removed)
+
+def delete_stored_file(location: str) -> bool:
+    try:
+        if location.startswith(STORAGE_URL_PREFIX):
+            blob = blob_from_url(location)
+            if blob.exists():
+                blob.delete()
+            signed_url_cache.invalidate(location)
+        else:
+            folder = os.path.dirname(location)
+            file_path = os.path.join(LOCAL_STORAGE_DIRS[folder], os.path.basename(location))
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        logger.info(f"Deleted {location}, no book uses it any more")
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting stored file {location}: {str(e)}")
+        return False
+
+def collect_stored_files():
+    """Delete stored files no book uses any more"""
+    stored_files.collect(delete_stored_file)
+
+def direct_uploads(book: Book) -> Dict[str, str]:
+    """Ebooks and audiobooks the browser uploaded straight to Cloud Storage that aren't stored by content yet"""
+    return {
+        book_type: url for book_type in CONTENT_ADDRESSED_TYPES
+        if (url := getattr(book, f"{book_type}_url")) and url.startswith(STORAGE_URL_PREFIX) and not sha256_from_filename(url)
+    }
+
+def adopt_direct_upload(book_type: str, url: str) -> str:
+    """
+    Copy a direct upload to the name of its content. The SHA-256 is computed
+    here from the stored bytes: the one the browser sends only decides whether
+    the upload can be skipped, so it never names a file. Returns the new URL.
+    """
+    blob = blob_from_url(url)
+    sha256, size = hash_blob(blob)
+    bucket_name, blob_path = parse_storage_url(url)
+    blob_name = f"{STORAGE_FOLDERS[book_type]}/{content_filename(sha256, blob_path)}"
+    location = storage_url(bucket_name, blob_name)
+    if stored_files.reserve(location):
+        logger.info(f"Direct upload {url} is already stored as {location}")
+    else:
+        bucket = get_bucket(bucket_name)
+        bucket.copy_blob(blob, bucket, blob_name)
+        stored_files.register(location, sha256, size)
+        logger.info(f"Stored direct upload {url} as {location}: {size} bytes")
+    return location
+
+def store_direct_uploads(book_id: int):
+    """Move the direct uploads of a book to content-addressed storage and point the book at them"""
+    book = get_book_or_none(book_id)
+    for book_type, url in (direct_uploads(book) if book else {}).items():
+        if not blob_from_url(url).exists():
+            logger.warning(f"Direct upload {url} of book {book_id} not found in storage")
+            continue
+        location = adopt_direct_upload(book_type, url)
+        
+        with Session(engine) as session:
+            book = session.get(Book, book_id)
+            # The book may have been deleted or given another file meanwhile
+            if book is not None and getattr(book, f"{book_type}_url") == url:
+                previous_files = file_locations(book)
+                setattr(book, f"{book_type}_url", location)
+                update_file_refs(session, previous_files, file_locations(book))
+                session.add(book)
+                session.commit()
+        
+        # Nothing points at the uploaded copy any more
+        blob_from_url(url).delete()
+        signed_url_cache.invalidate(url)
+
+def get_book_or_none(book_id: int) -> Optional[Book]:
+    with Session(engine) as session:
+        return session.get(Book, book_id)
+
+def probe_book_metadata(book_id: int, entry: Optional[ContentEntry]):
+    """Fill in metadata left empty: file formats from their names and the page count of PDFs"""
+    with Session(engine) as session:
+        book = session.get(Book, book_id)
+        if not book:
+            return
+        
+        changed = False
+        for book_type in ("ebook", "audiobook"):
+            location = getattr(book, f"{book_type}_path") or getattr(book, f"{book_type}_url")
+            extension = os.path.splitext(location or "")[1].lstrip(".").lower()
+            if extension and not getattr(book, f"{book_type}_format"):
+                setattr(book, f"{book_type}_format", extension)
+                changed = True
+        
+        if entry is not None and not book.pages and entry.manifest['kind'] == 'page':
+            book.pages = len(entry.manifest['sections'])
+            changed = True
+        
+        if changed:
+            session.add(book)
+            session.commit()
+
+async def ingest_step(book_id: int, stage: str, step: Awaitable):
+    """
+    Run a stage of ingestion that may fail on a bad file: the failure is logged
+    and the other stages go on, and the work is tried again when the book is
+    opened. Only a busy extraction pool fails the attempt, so the job retries later.
+    """
+    try:
+        return await step
+    except HTTPException as e:
+        if e.status_code == 503:
+            raise
+        logger.error(f"Ingestion of book {book_id}: {stage} failed, skipping it: {e.detail}")
+    except Exception as e:
+        logger.error(f"Ingestion of book {book_id}: {stage} failed, skipping it: {str(e)}")
+    return None
+
+async def ingest_book(run: JobRun):
+    """
+    Ingestion job of a new book: store its direct uploads by content, parse its transcription,
+    extract its text, fill in metadata and index it.
+    The files are already stored by create_book, so nothing is lost if the job never runs.
+    """
+    book_id = run.book_id
+    book = await asyncio.to_thread(get_book_or_none, book_id)
+    if book is None:
+        logger.info(f"Book {book_id} was deleted before it was ingested")
+        return
+    
+    # Files uploaded by the browser are hashed and renamed before anything reads them
+    if direct_uploads(book):
+        await run.stage("store")
+        await asyncio.to_thread(store_direct_uploads, book_id)
+        book = await asyncio.to_thread(get_book_or_none, book_id)
+        if book is None:
+            return
+    
+    # Parse the transcription first, so the player's first lookup by time doesn't wait for it
+    if book.transcription_path if DEBUG_MODE else book.transcription_url:
+        await run.stage("transcript")
+        await ingest_step(book_id, "transcript", load_transcript(book_id))
+    
+    entry = None
+    if book.ebook_path or book.ebook_url:
+        await run.stage("extract")
+        entry = await ingest_step(book_id, "extract", load_book_content(book_id))
+    
+    await run.stage("probe")
+    await asyncio.to_thread(probe_book_metadata, book_id, entry)
+    
+    if entry is not None:
+        await run.stage("index")
+        await ingest_step(book_id, "index", ensure_book_indexed(book_id))
+
+# Background work with retries, stored in the Job table
+job_queue = JobQueue(engine)
+job_queue.register("ingest_book", ingest_book)
+
 @app.post("/api/books/")
 async def create_book(
     request: Request,
@@ -728,40 +1069,17 @@ async def create_book(
         # Create Book model
         book = Book(**book_data)
         
+        # Files sent with the request, stored below all at once
+        uploads = {}
+        
         # Handle ebook file if provided
         if ebook_file:
             # Check file size - reject if too large for API upload
-            if hasattr(ebook_file, 'size') and ebook_file.size > 30 * 1024 * 1024:  # 30MB limit
-                raise HTTPException(
-                    status_code=413,
-                    detail="File too large for API upload. Use direct upload for files larger than 30MB."
-                )
-            
-            # Save to temporary location first
-            temp_dir = os.path.join(BASE_DIR, "temp_files")
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_path = os.path.join(temp_dir, ebook_file.filename)
-            
-            with open(temp_path, "wb") as buffer:
-                content = await ebook_file.read()
-                buffer.write(content)
-            
-            # Use copy_file_to_storage to save to appropriate location
-            result_path = copy_file_to_storage(temp_path, 'ebook')
-            
-            # Set appropriate fields based on DEBUG_MODE
-            if DEBUG_MODE:
-                book.ebook_path = result_path
-                book.ebook_url = None
-            else:
-                book.ebook_url = result_path
-                book.ebook_path = None
+            check_upload_size(ebook_file)
+            uploads['ebook'] = (ebook_file, None)
             
             # Set format
             book.ebook_format = form.get('ebook_format')
-            
-            # Clean up temp file
-            os.remove(temp_path)
         
         # Handle direct ebook upload URL (for large files)
         elif form.get('ebook_direct_url'):
@@ -774,37 +1092,11 @@ async def create_book(
         # Handle audiobook file if provided
         if audiobook_file:
             # Check file size - reject if too large for API upload
-            if hasattr(audiobook_file, 'size') and audiobook_file.size > 30 * 1024 * 1024:  # 30MB limit
-                raise HTTPException(
-                    status_code=413,
-                    detail="File too large for API upload. Use direct upload for files larger than 30MB."
-                )
-            
-            # Save to temporary location first
-            temp_dir = os.path.join(BASE_DIR, "temp_files")
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_path = os.path.join(temp_dir, audiobook_file.filename)
-            
-            with open(temp_path, "wb") as buffer:
-                content = await audiobook_file.read()
-                buffer.write(content)
-            
-            # Use copy_file_to_storage to save to appropriate location
-            result_path = copy_file_to_storage(temp_path, 'audiobook')
-            
-            # Set appropriate fields based on DEBUG_MODE
-            if DEBUG_MODE:
-                book.audiobook_path = result_path
-                book.audiobook_url = None
-            else:
-                book.audiobook_url = result_path
-                book.audiobook_path = None
+            check_upload_size(audiobook_file)
+            uploads['audiobook'] = (audiobook_file, None)
             
             # Set format
             book.audiobook_format = form.get('audiobook_format')
-            
-            # Clean up temp file
-            os.remove(temp_path)
         
         # Handle direct audiobook upload URL (for large files)
         elif form.get('audiobook_direct_url'):
@@ -817,40 +1109,14 @@ async def create_book(
         # Handle transcription file if provided
         if transcription_file:
             # Check file size - reject if too large for API upload
-            if hasattr(transcription_file, 'size') and transcription_file.size > 30 * 1024 * 1024:  # 30MB limit
-                raise HTTPException(
-                    status_code=413,
-                    detail="Transcription file too large for API upload. Use direct upload for files larger than 30MB."
-                )
-            
-            # Save to temporary location first
-            temp_dir = os.path.join(BASE_DIR, "temp_files")
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_path = os.path.join(temp_dir, transcription_file.filename)
-            
-            with open(temp_path, "wb") as buffer:
-                content = await transcription_file.read()
-                buffer.write(content)
+            check_upload_size(transcription_file, "Transcription file")
             
             # Generate custom filename based on book information
             custom_filename = generate_transcription_filename(
                 book_data.get('title', 'unknown'),
                 book_data.get('author', 'unknown')
             )
-            
-            # Use copy_file_to_storage to save to appropriate location with custom filename
-            result_path = copy_file_to_storage(temp_path, 'transcription', custom_filename)
-            
-            # Set appropriate fields based on DEBUG_MODE
-            if DEBUG_MODE:
-                book.transcription_path = result_path
-                book.transcription_url = None
-            else:
-                book.transcription_url = result_path
-                book.transcription_path = None
-            
-            # Clean up temp file
-            os.remove(temp_path)
+            uploads['transcription'] = (transcription_file, custom_filename)
         
         # Handle direct transcription upload URL (for large files)
         elif form.get('transcription_direct_url'):
@@ -859,43 +1125,42 @@ async def create_book(
             book.transcription_url = form.get('transcription_direct_url')
             book.transcription_path = None
         
+        # Stream the files to storage concurrently; the request only succeeds once they're stored
+        stored = await store_uploads(uploads)
+        for book_type, (result_path, _) in stored.items():
+            for key, value in storage_fields(book_type, result_path).items():
+                setattr(book, key, value)
+        
         # Save book to database
         with Session(engine) as session:
             session.add(book)
+            update_file_refs(session, {}, file_locations(book))
             session.commit()
             session.refresh(book)
             
             # After saving, if there's a transcription from direct upload, rename it with book ID
             if book.transcription_url and 'temp_' in book.transcription_url:
                 try:
-                    # Generate final filename with book ID
-                    final_filename = generate_transcription_filename(
-                        book.title,
-                        book.author,
-                        book.id
-                    )
-                    
-                    # Rename the file in cloud storage
-                    new_url = rename_transcription_file_in_cloud(book.transcription_url, final_filename)
-                    
-                    # Update the book record with new URL
-                    book.transcription_url = new_url
+                    final_filename = generate_transcription_filename(book.title, book.author, book.id)
+                    book.transcription_url = rename_transcription_file_in_cloud(book.transcription_url, final_filename)
                     session.add(book)
                     session.commit()
                     session.refresh(book)
-                    
                     logger.info(f"Renamed transcription file for book {book.id}: {final_filename}")
-                    
                 except Exception as e:
                     logger.error(f"Failed to rename transcription file for book {book.id}: {str(e)}")
                     # Don't fail the entire operation if renaming fails
             
-            logger.debug(f"Book created: ID={book.id}, DEBUG={DEBUG_MODE}, " +
-                         f"ebook_path={book.ebook_path}, ebook_url={book.ebook_url}, " +
-                         f"audiobook_path={book.audiobook_path}, audiobook_url={book.audiobook_url}, " +
-                         f"transcription_path={book.transcription_path}, transcription_url={book.transcription_url}")
-            
-            return book
+        # Extraction, metadata and indexing continue in the background
+        job = await job_queue.enqueue("ingest_book", book.id)
+        answer_cache.bump_library_version()
+        
+        logger.debug(f"Book created: ID={book.id}, job={job.id}, DEBUG={DEBUG_MODE}, " +
+                     f"ebook_path={book.ebook_path}, ebook_url={book.ebook_url}, " +
+                     f"audiobook_path={book.audiobook_path}, audiobook_url={book.audiobook_url}, " +
+                     f"transcription_path={book.transcription_path}, transcription_url={book.transcription_url}")
+        
+        return {**book.model_dump(), "job_id": job.id}
             
     except Exception as e:
         logger.error(f"Error creating book: {str(e)}")
@@ -903,6 +1168,25 @@ async def create_book(
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: int, current_user: dict = Depends(get_current_user)):
+    """Status of a background job, e.g. the ingestion of a new book"""
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "book_id": job.book_id,
+        "status": job.status,
+        "stage": job.stage,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "error": job.error,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at
+    }
+
 # Update an existing book
 @app.put("/api/books/{book_id}")
 async def update_book(
@@ -929,37 +1213,14 @@ async def update_book(
             if not book:
                 raise HTTPException(status_code=404, detail="Book not found")
             
+            # Files sent with the request, stored below all at once
+            uploads = {}
+            
             # Handle ebook file if provided
             if ebook_file:
                 # Check file size - reject if too large for API upload
-                if hasattr(ebook_file, 'size') and ebook_file.size > 30 * 1024 * 1024:  # 30MB limit
-                    raise HTTPException(
-                        status_code=413,
-                        detail="File too large for API upload. Use direct upload for files larger than 30MB."
-                    )
-                
-                # Save to temporary location first
-                temp_dir = os.path.join(BASE_DIR, "temp_files")
-                os.makedirs(temp_dir, exist_ok=True)
-                temp_path = os.path.join(temp_dir, ebook_file.filename)
-                
-                with open(temp_path, "wb") as buffer:
-                    content = await ebook_file.read()
-                    buffer.write(content)
-                
-                # Use copy_file_to_storage to save to appropriate location
-                result_path = copy_file_to_storage(temp_path, 'ebook')
-                
-                # Set appropriate fields based on DEBUG_MODE
-                if DEBUG_MODE:
-                    book_data['ebook_path'] = result_path
-                    book_data['ebook_url'] = None
-                else:
-                    book_data['ebook_url'] = result_path
-                    book_data['ebook_path'] = None
-                
-                # Clean up temp file
-                os.remove(temp_path)
+                check_upload_size(ebook_file)
+                uploads['ebook'] = (ebook_file, None)
             
             # Handle direct ebook upload URL (for large files)
             elif form.get('ebook_direct_url'):
@@ -972,34 +1233,8 @@ async def update_book(
             # Handle audiobook file if provided
             if audiobook_file:
                 # Check file size - reject if too large for API upload
-                if hasattr(audiobook_file, 'size') and audiobook_file.size > 30 * 1024 * 1024:  # 30MB limit
-                    raise HTTPException(
-                        status_code=413,
-                        detail="File too large for API upload. Use direct upload for files larger than 30MB."
-                    )
-                
-                # Save to temporary location first
-                temp_dir = os.path.join(BASE_DIR, "temp_files")
-                os.makedirs(temp_dir, exist_ok=True)
-                temp_path = os.path.join(temp_dir, audiobook_file.filename)
-                
-                with open(temp_path, "wb") as buffer:
-                    content = await audiobook_file.read()
-                    buffer.write(content)
-                
-                # Use copy_file_to_storage to save to appropriate location
-                result_path = copy_file_to_storage(temp_path, 'audiobook')
-                
-                # Set appropriate fields based on DEBUG_MODE
-                if DEBUG_MODE:
-                    book_data['audiobook_path'] = result_path
-                    book_data['audiobook_url'] = None
-                else:
-                    book_data['audiobook_url'] = result_path
-                    book_data['audiobook_path'] = None
-                
-                # Clean up temp file
-                os.remove(temp_path)
+                check_upload_size(audiobook_file)
+                uploads['audiobook'] = (audiobook_file, None)
             
             # Handle direct audiobook upload URL (for large files)
             elif form.get('audiobook_direct_url'):
@@ -1012,20 +1247,7 @@ async def update_book(
             # Handle transcription file if provided
             if transcription_file:
                 # Check file size - reject if too large for API upload
-                if hasattr(transcription_file, 'size') and transcription_file.size > 30 * 1024 * 1024:  # 30MB limit
-                    raise HTTPException(
-                        status_code=413,
-                        detail="Transcription file too large for API upload. Use direct upload for files larger than 30MB."
-                    )
-                
-                # Save to temporary location first
-                temp_dir = os.path.join(BASE_DIR, "temp_files")
-                os.makedirs(temp_dir, exist_ok=True)
-                temp_path = os.path.join(temp_dir, transcription_file.filename)
-                
-                with open(temp_path, "wb") as buffer:
-                    content = await transcription_file.read()
-                    buffer.write(content)
+                check_upload_size(transcription_file, "Transcription file")
                 
                 # Generate custom filename based on book information
                 custom_filename = generate_transcription_filename(
@@ -1033,20 +1255,7 @@ async def update_book(
                     book_data.get('author', book.author),
                     book.id
                 )
-                
-                # Use copy_file_to_storage to save to appropriate location with custom filename
-                result_path = copy_file_to_storage(temp_path, 'transcription', custom_filename)
-                
-                # Set appropriate fields based on DEBUG_MODE
-                if DEBUG_MODE:
-                    book_data['transcription_path'] = result_path
-                    book_data['transcription_url'] = None
-                else:
-                    book_data['transcription_url'] = result_path
-                    book_data['transcription_path'] = None
-                
-                # Clean up temp file
-                os.remove(temp_path)
+                uploads['transcription'] = (transcription_file, custom_filename)
             
             # Handle direct transcription upload URL (for large files)
             elif form.get('transcription_direct_url'):
@@ -1072,15 +1281,46 @@ async def update_book(
                 
                 book_data['transcription_path'] = None
             
+            # Stream the files to storage concurrently
+            stored = await store_uploads(uploads)
+            for book_type, (result_path, _) in stored.items():
+                book_data.update(storage_fields(book_type, result_path))
+            
+            previous_audiobook_url = book.audiobook_url
+            previous_files = file_locations(book)
+            
             # Update book attributes
             for key, value in book_data.items():
                 if hasattr(book, key):
                     setattr(book, key, value)
             
+            # Drop extracted text of the previous ebook
+            if 'ebook_path' in book_data or 'ebook_url' in book_data:
+                content_cache.invalidate(book_id)
+            
+            # Stop handing out signed URLs for the previous audiobook
+            if book.audiobook_url != previous_audiobook_url:
+                signed_url_cache.invalidate(previous_audiobook_url)
+            
+            # Files the book no longer points at are deleted once nothing else uses them
+            update_file_refs(session, previous_files, file_locations(book))
+            
             # Save changes
             session.add(book)
             session.commit()
             session.refresh(book)
+            await asyncio.to_thread(collect_stored_files)
+            answer_cache.bump_library_version()
+            
+            # Re-index the new ebook; results from the old one go away right now
+            if 'ebook_path' in book_data or 'ebook_url' in book_data:
+                search_index.remove_book(book_id)
+            
+            # Direct uploads are stored by content before the new ebook is indexed
+            if direct_uploads(book):
+                await job_queue.enqueue("ingest_book", book_id)
+            elif ('ebook_path' in book_data or 'ebook_url' in book_data) and (book.ebook_path or book.ebook_url):
+                schedule_indexing(book_id)
             
             logger.debug(f"Book updated: ID={book.id}, DEBUG={DEBUG_MODE}, " +
                          f"ebook_path={book.ebook_path}, ebook_url={book.ebook_url}, " +
@@ -1095,86 +1335,206 @@ async def update_book(
         raise HTTPException(status_code=500, detail=str(e))
     
 
+# Sort keys of /api/books/ and their default direction
+BOOK_SORT_KEYS = {"id": "asc", "title": "asc", "created_at": "desc", "last_read_date": "desc"}
+
+def encode_book_cursor(value, book_id: int) -> str:
+    data = json.dumps([json_value(value), book_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+def decode_book_cursor(cursor: str, sort: str):
+    """Return the (sort value, book id) of the last book of the previous page"""
+    try:
+        value, book_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if value is not None and sort == "created_at":
+            value = datetime.fromisoformat(value).date()
+        elif value is not None and sort == "last_read_date":
+            value = datetime.fromisoformat(value)
+        return value, int(book_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def after_cursor(column, value, book_id: int, descending: bool):
+    """
+    Condition for rows after (value, book_id) in an ORDER BY column, id.
+    NULL sorts first both in SQLite and MySQL, i.e. as the smallest value.
+    """
+    if descending:
+        if value is None:
+            return and_(column.is_(None), Book.id < book_id)
+        return or_(column < value, and_(column == value, Book.id < book_id), column.is_(None))
+    if value is None:
+        return or_(column.is_not(None), Book.id > book_id)
+    return or_(column > value, and_(column == value, Book.id > book_id))
+
 @app.get("/api/books/", response_model=List[Book])
-def get_books(current_user: dict = Depends(get_current_user)):
+def get_books(
+    response: Response,
+    status: Optional[str] = None,
+    author: Optional[str] = None,
+    format: Optional[str] = None,
+    has_audiobook: Optional[bool] = None,
+    has_ebook: Optional[bool] = None,
+    sort: str = "id",
+    order: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    List books, optionally filtered and sorted.
+    - status, author: exact match
+    - format: ebook or audiobook format, e.g. epub or mp3
+    - has_audiobook / has_ebook: whether the book has that file
+    - sort: id, title, created_at or last_read_date; order: asc or desc
+    - limit/cursor: keyset paging; the cursor for the next page comes in the X-Next-Cursor header
+    """
+    if sort not in BOOK_SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of: {', '.join(BOOK_SORT_KEYS)}")
+    order = order or BOOK_SORT_KEYS[sort]
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be asc or desc")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    descending = order == "desc"
+    
+    if sort == "last_read_date":
+        # A book has at most one progress row; books never opened sort as NULL
+        query = select(Book, ReadingProgress.last_read_date).outerjoin(ReadingProgress, ReadingProgress.book_id == Book.id)
+        sort_column = ReadingProgress.last_read_date
+    else:
+        query = select(Book)
+        sort_column = getattr(Book, sort)
+    
+    if status is not None:
+        query = query.where(Book.status == status)
+    if author is not None:
+        query = query.where(Book.author == author)
+    if format is not None:
+        query = query.where(or_(Book.ebook_format == format.lower(), Book.audiobook_format == format.lower()))
+    if has_audiobook is not None:
+        has_file = or_(Book.audiobook_url.is_not(None), Book.audiobook_path.is_not(None))
+        query = query.where(has_file if has_audiobook else ~has_file)
+    if has_ebook is not None:
+        has_file = or_(Book.ebook_url.is_not(None), Book.ebook_path.is_not(None))
+        query = query.where(has_file if has_ebook else ~has_file)
+    if cursor is not None:
+        value, last_id = decode_book_cursor(cursor, sort)
+        query = query.where(after_cursor(sort_column, value, last_id, descending))
+    
+    # The id breaks ties so every page starts exactly where the previous one ended
+    if descending:
+        query = query.order_by(sort_column.desc(), Book.id.desc())
+    else:
+        query = query.order_by(sort_column, Book.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    
     with Session(engine) as session:
-        books = session.exec(select(Book)).all()
-        return books
+        rows = session.exec(query).all()
+    
+    if sort == "last_read_date":
+        books, sort_values = [row[0] for row in rows], [row[1] for row in rows]
+    else:
+        books = list(rows)
+        sort_values = [getattr(book, sort) for book in books]
+    
+    if limit is not None and len(books) > limit:
+        books = books[:limit]
+        response.headers["X-Next-Cursor"] = encode_book_cursor(sort_values[limit - 1], books[-1].id)
+    return books
+
+# Fields of /api/books/with-progress; "progress" is always included
+BOOK_LIST_FIELDS = [
+    "id", "title", "author", "cover_url", "isbn", "publisher", "publish_year", "pages",
+    "language", "description", "status", "start_date", "finish_date", "notes", "created_at",
+    "ebook_url", "ebook_path", "ebook_format", "audiobook_url", "audiobook_path", "audiobook_format"
+]
+# What a book card and the statistics page need, without long text like description and notes
+BOOK_CARD_FIELDS = [
+    "id", "title", "author", "cover_url", "publish_year", "pages", "status", "start_date", "finish_date",
+    "created_at", "ebook_url", "ebook_path", "ebook_format", "audiobook_url", "audiobook_path", "audiobook_format"
+]
+
+def parse_book_fields(fields: Optional[str]) -> List[str]:
+    if not fields:
+        return BOOK_CARD_FIELDS
+    if fields == "all":
+        return BOOK_LIST_FIELDS
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in BOOK_LIST_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    # The id is needed to page and to open a book
+    return ["id"] + [field for field in requested if field != "id"]
+
+def json_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
 
 @app.get("/api/books/with-progress")
-def get_books_with_progress(current_user: dict = Depends(get_current_user)):
+def get_books_with_progress(
+    request: Request,
+    fields: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[int] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    List books with their reading progress.
+    - fields: comma-separated book fields, or "all"; defaults to a card-sized summary
+    - limit/cursor: optional paging; the cursor for the next page comes in the X-Next-Cursor header
+    The response has an ETag, and If-None-Match with the same value returns 304.
+    """
+    book_fields = parse_book_fields(fields)
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    
     with Session(engine) as session:
         try:
-            # Obtener todos los libros
-            books = session.exec(select(Book)).all()
-            logger.debug(f"Found {len(books)} books")
-            
-            # Crear un diccionario para almacenar el progreso por book_id
-            progress_by_book_id = {}
-            
-            # Obtener todos los registros de progreso
-            progress_records = session.exec(select(ReadingProgress)).all()
-            logger.debug(f"Found {len(progress_records)} progress records")
+            progress_columns = [
+                ReadingProgress.last_read_date,
+                ReadingProgress.progress_percentage,
+                ReadingProgress.audiobook_position,
+                ReadingProgress.scroll_position
+            ]
+            
+            # Libros y su progreso en una sola consulta; cada libro tiene como mucho un registro de progreso
+            query = (
+                select(*[getattr(Book, field) for field in book_fields], *progress_columns)
+                .select_from(Book)
+                .outerjoin(ReadingProgress, ReadingProgress.book_id == Book.id)
+                .order_by(Book.id)
+            )
+            if cursor is not None:
+                query = query.where(Book.id > cursor)
+            if limit is not None:
+                query = query.limit(limit + 1)
+            rows = session.exec(query).all()
             
-            # Organizar los registros de progreso por book_id
-            for progress in progress_records:
-                progress_by_book_id[progress.book_id] = {
-                    "last_read_date": progress.last_read_date.isoformat() if progress.last_read_date else None,
-                    "progress_percentage": progress.progress_percentage or 0,
-                    "audiobook_position": progress.audiobook_position,
-                    "scroll_position": progress.scroll_position or 0
+            result = []
+            for row in rows:
+                values = row._mapping
+                book_dict = {field: json_value(values[field]) for field in book_fields}
+                book_dict["progress"] = {
+                    "last_read_date": json_value(values["last_read_date"]),
+                    "progress_percentage": values["progress_percentage"] or 0,
+                    "audiobook_position": values["audiobook_position"],
+                    "scroll_position": values["scroll_position"] or 0
                 }
+                result.append(book_dict)
             
-            # Combinar la información de libros y progreso
-            result = []
-            for book in books:
-                try:
-                    # Convertir manualmente a diccionario para evitar problemas de serialización
-                    book_dict = {
-                        "id": book.id,
-                        "title": book.title,
-                        "author": book.author,
-                        "cover_url": book.cover_url,
-                        "isbn": book.isbn,
-                        "publisher": book.publisher,
-                        "publish_year": book.publish_year,
-                        "pages": book.pages,
-                        "language": book.language,
-                        "description": book.description,
-                        "status": book.status,
-                        "start_date": book.start_date.isoformat() if book.start_date else None,
-                        "finish_date": book.finish_date.isoformat() if book.finish_date else None,
-                        "notes": book.notes,
-                        "created_at": book.created_at.isoformat() if book.created_at else None,
-                        "ebook_url": book.ebook_url,
-                        "ebook_path": book.ebook_path,
-                        "ebook_format": book.ebook_format,
-                        "audiobook_url": book.audiobook_url,
-                        "audiobook_path": book.audiobook_path,
-                        "audiobook_format": book.audiobook_format
-                    }
-                    
-                    # Añadir información de progreso (siempre guaranteed to exist)
-                    book_progress = progress_by_book_id.get(book.id)
-                    if not book_progress:
-                        # Create default progress if it doesn't exist
-                        logger.debug(f"No progress found for book {book.id} ({book.title}), using defaults")
-                        book_progress = {
-                            "last_read_date": None,
-                            "progress_percentage": 0,
-                            "audiobook_position": None,
-                            "scroll_position": 0
-                        }
-                    
-                    book_dict["progress"] = book_progress
-                    result.append(book_dict)
-                    
-                except Exception as e:
-                    logger.error(f"Error processing book {book.id}: {str(e)}")
-                    continue
+            for book_dict in result:
+                # Progress not written to the database yet
+                buffered = progress_buffer.get(book_dict["id"])
+                if buffered:
+                    book_dict["progress"] = {field: json_value(buffered[field]) for field in book_dict["progress"]}
+            
+            headers = {"Cache-Control": "private, no-cache"}
+            if limit is not None and len(result) > limit:
+                result = result[:limit]
+                headers["X-Next-Cursor"] = str(result[-1]["id"])
             
             logger.debug(f"Returning {len(result)} books with progress")
-            return result
             
         except Exception as e:
             logger.error(f"Error in get_books_with_progress: {str(e)}")
@@ -1184,6 +1544,13 @@ def get_books_with_progress(current_user: dict = Depends(get_current_user)):
                 status_code=500,
                 detail=f"Error retrieving books with progress: {str(e)}"
             )
+    
+    body = json.dumps(result, separators=(",", ":")).encode("utf-8")
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers["ETag"] = etag
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/api/books/{book_id}", response_model=Book)
 def get_book(book_id: int, current_user: dict = Depends(get_current_user)):
@@ -1195,6 +1562,7 @@ def get_book(book_id: int, current_user: dict = Depends(get_current_user)):
 
 @app.delete("/api/books/{book_id}")
 def delete_book(book_id: int, current_user: dict = Depends(get_current_user)):
+    progress_buffer.discard(book_id)
     with Session(engine) as session:
         try:
             # Primero eliminar los registros de progreso asociados
@@ -1211,19 +1579,27 @@ def delete_book(book_id: int, current_user: dict = Depends(get_current_user)):
             if not book:
                 raise HTTPException(status_code=404, detail="Book not found")
 
-            # Eliminar archivos asociados si existen
-            if book.ebook_path:
+            # Los archivos guardados por contenido solo se eliminan si ningún otro libro los usa
+            update_file_refs(session, file_locations(book), {})
+
+            # Eliminar archivos asociados si existen (guardados antes del almacenamiento por contenido)
+            if book.ebook_path and not sha256_from_filename(book.ebook_path):
                 file_path = os.path.join(EBOOKS_DIR, os.path.basename(book.ebook_path))
                 if os.path.exists(file_path):
                     os.remove(file_path)
 
-            if book.audiobook_path:
+            if book.audiobook_path and not sha256_from_filename(book.audiobook_path):
                 file_path = os.path.join(AUDIOBOOKS_DIR, os.path.basename(book.audiobook_path))
                 if os.path.exists(file_path):
                     os.remove(file_path)
 
             session.delete(book)
             session.commit()
+            collect_stored_files()
+            content_cache.invalidate(book_id)
+            signed_url_cache.invalidate(book.audiobook_url)
+            search_index.remove_book(book_id)
+            answer_cache.bump_library_version()
             return {"message": "Book deleted successfully"}
 
         except Exception as e:
@@ -1236,37 +1612,19 @@ def delete_book(book_id: int, current_user: dict = Depends(get_current_user)):
 # Get progress for a book
 @app.get("/api/books/{book_id}/progress", response_model=ReadingProgress)
 def get_book_progress(book_id: int, current_user: dict = Depends(get_current_user)):
+    buffered = progress_buffer.get(book_id)
+    if buffered:
+        return buffered
+    
     with Session(engine) as session:
         progress = session.exec(
             select(ReadingProgress).where(ReadingProgress.book_id == book_id)
         ).first()
-        
-        if not progress:
-            # Si no existe, crear un nuevo progreso con valores por defecto
-            progress = ReadingProgress(
-                book_id=book_id,
-                scroll_position=0,
-                progress_percentage=0,
-                current_page=None,
-                total_pages=None,
-                current_chapter=None,
-                audiobook_position=None,
-                last_read_date=datetime.now()
-            )
-            session.add(progress)
-            session.commit()
-        
-        return {
-            "book_id": progress.book_id,
-            "scroll_position": progress.scroll_position,
-            "progress_percentage": progress.progress_percentage,
-            "current_page": progress.current_page,
-            "total_pages": progress.total_pages,
-            "current_chapter": progress.current_chapter,
-            "audiobook_position": progress.audiobook_position,
-            "last_read_date": progress.last_read_date,
-            "notes": progress.notes
-        }
+    
+    if not progress:
+        # Si no existe, crear un nuevo progreso con valores por defecto (sin duplicarlo si otra petición ya lo creó)
+        progress_buffer.ensure_row(book_id)
+    return progress_state(book_id, progress)
 
 # Update or create progress
 @app.put("/api/books/{book_id}/progress")
@@ -1275,157 +1633,373 @@ async def update_book_progress(
     progress_data: dict,
     current_user: dict = Depends(get_current_user)
 ):
+    # Only the latest state of each book is kept and written in the next batch
+    try:
+        return await asyncio.to_thread(progress_buffer.update, book_id, progress_data)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+# Slice size for ranged content requests without an explicit length
+CONTENT_RANGE_DEFAULT_LENGTH = 20000
+
+def resolve_book_content(book_id: int):
+    """
+    Look up a book's ebook and its content fingerprint.
+    Returns (book, fingerprint, blob, cached entry or None); blob is None in DEBUG_MODE.
+    Raises HTTPException if the book or its file can't be found.
+    """
     with Session(engine) as session:
-        progress = session.exec(
-            select(ReadingProgress).where(ReadingProgress.book_id == book_id)
-        ).first()
+        book = session.get(Book, book_id)
+        logger.debug(f"Book found: {book}")
         
-        if progress:
-            # Update existing progress
-            if 'scroll_position' in progress_data:
-                progress.scroll_position = progress_data['scroll_position']
-            if 'progress_percentage' in progress_data:
-                progress.progress_percentage = progress_data['progress_percentage']
-            if 'current_page' in progress_data:
-                progress.current_page = progress_data['current_page']
-            if 'total_pages' in progress_data:
-                progress.total_pages = progress_data['total_pages']
-            if 'current_chapter' in progress_data:
-                progress.current_chapter = progress_data['current_chapter']
-            if 'audiobook_position' in progress_data:
-                progress.audiobook_position = progress_data['audiobook_position']
-            
-        else:
-            # Create new progress
-            progress = ReadingProgress(
-                book_id=book_id,
-                scroll_position=progress_data.get('scroll_position', 0),
-                progress_percentage=progress_data.get('progress_percentage', 0),
-                current_page=progress_data.get('current_page'),
-                total_pages=progress_data.get('total_pages'),
-                current_chapter=progress_data.get('current_chapter'),
-                audiobook_position=progress_data.get('audiobook_position')
-            )
+    if not book:
+        logger.warning("Book not found in database")
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    blob = None
+    if DEBUG_MODE:
+        # Local file mode - use ebook_path
+        if not book.ebook_path:
+            logger.warning("Book has no associated file path")
+            raise HTTPException(status_code=404, detail="Book has no associated file")
+        
+        file_path = os.path.join(EBOOKS_DIR, os.path.basename(book.ebook_path))
+        if not os.path.exists(file_path):
+            logger.warning(f"Ebook file missing: {file_path}")
+            raise HTTPException(status_code=404, detail="Book file not found")
+        fingerprint = file_fingerprint(file_path)
+        
+    else:
+        # Cloud storage mode - use ebook_url
+        if not book.ebook_url:
+            logger.warning("Book has no associated URL")
+            raise HTTPException(status_code=404, detail="Book has no associated URL")
+        
+        logger.debug(f"Ebook URL: {book.ebook_url}")
+        
+        # Parse URL to get bucket and blob path
+        bucket_name, blob_path = parse_storage_url(book.ebook_url)
+        
+        # Fetch only the blob metadata; the generation changes whenever the object is replaced
+        try:
+            blob = get_bucket(bucket_name).get_blob(blob_path)
+        except Exception as e:
+            logger.error(f"Error reading blob metadata: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Failed to access book file: {str(e)}")
+        if blob is None:
+            logger.warning(f"Blob not found: gs://{bucket_name}/{blob_path}")
+            raise HTTPException(status_code=404, detail="Book file not found in storage")
+        fingerprint = str(blob.generation or blob.etag)
+    
+    entry = content_cache.get(book_id, fingerprint)
+    if entry is not None:
+        logger.debug(f"Content cache hit for book {book_id}, length: {entry.total_length}")
+    return book, fingerprint, blob, entry
+
+def fetch_ebook_file(book: Book, blob) -> tuple:
+    """
+    Make the ebook available as a local file.
+    Returns (file_path, temp_file); temp_file is set when the file was downloaded and must be removed by the caller.
+    """
+    if DEBUG_MODE:
+        return os.path.join(EBOOKS_DIR, os.path.basename(book.ebook_path)), None
+    
+    # Create temp directory if it doesn't exist
+    temp_dir = os.path.join(BASE_DIR, "temp_files")
+    os.makedirs(temp_dir, exist_ok=True)
+    
+    extension = book.ebook_format  # Remove the dot
+    # Set up the temp file path
+    temp_file = os.path.join(temp_dir, f"temp_{book.id}_{uuid.uuid4().hex}.{extension}")
+    
+    logger.debug(f"Downloading from URL: {book.ebook_url}")
+    
+    try:
+        logger.debug("Attempting download with GCS client")
+        blob.download_to_filename(temp_file)
+        logger.debug(f"Successfully downloaded with GCS client")
+        return temp_file, temp_file
+        
+    except Exception as gcs_error:
+        logger.error(f"GCS client download failed: {str(gcs_error)}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to download file: {str(gcs_error)}"
+        )
+
+# Extractions in progress, so concurrent opens of the same book share one worker
+inflight_extractions: Dict[tuple, asyncio.Future] = {}
+
+def extraction_busy_error() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Too many books are being opened right now, please try again shortly",
+        headers={"Retry-After": "5"}
+    )
+
+async def extract_book_content(book: Book, fingerprint: str, blob) -> ContentEntry:
+    """Download and extract a book in the extraction pool, then register it in the content cache"""
+    try:
+        async with extraction_pool.slot():
+            file_path, temp_file = await asyncio.to_thread(fetch_ebook_file, book, blob)
+            try:
+                text_path, manifest_path = content_cache.entry_paths(book.id, fingerprint)
+                length = await extraction_pool.run(extract_to_files, file_path, text_path, manifest_path)
+                logger.debug(f"Content extracted successfully, length: {length}")
+                return content_cache.register(book.id, fingerprint)
+            finally:
+                # Clean up temp file; the extracted text now lives in the content cache
+                if temp_file and os.path.exists(temp_file):
+                    os.remove(temp_file)
+    except ExtractionQueueFull:
+        logger.warning(f"Extraction queue full, rejecting book {book.id}")
+        raise extraction_busy_error()
+
+async def load_book_content(book_id: int) -> ContentEntry:
+    """
+    Return the extracted text of a book, extracting and caching it on a miss.
+    Raises HTTPException if the book or its file can't be found.
+    """
+    _, entry = await load_book_content_with_fingerprint(book_id)
+    return entry
+
+async def load_book_content_with_fingerprint(book_id: int) -> tuple:
+    """Same as load_book_content, but returns (fingerprint of the ebook file, entry)"""
+    book, fingerprint, blob, entry = await asyncio.to_thread(resolve_book_content, book_id)
+    if entry is not None:
+        return fingerprint, entry
+    
+    key = (book_id, fingerprint)
+    task = inflight_extractions.get(key)
+    if task is None:
+        task = asyncio.ensure_future(extract_book_content(book, fingerprint, blob))
+        inflight_extractions[key] = task
+        
+        def on_done(finished):
+            inflight_extractions.pop(key, None)
+            if not finished.cancelled():
+                finished.exception()  # Mark as retrieved even if every waiter went away
+        task.add_done_callback(on_done)
+    
+    try:
+        # Shield so a disconnecting client doesn't cancel the extraction for the others
+        return fingerprint, await asyncio.shield(task)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error extracting text: {str(e)}")
+        import traceback
+        logger.error(traceback.format_exc())
         
-        progress.last_read_date = datetime.now()
-        session.add(progress)
-        session.commit()
-        return progress
-
-def extract_text_from_epub(epub_path):
-    book = epub.read_epub(epub_path)
-    chapters = []
-    for item in book.get_items():
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            chapters.append(BeautifulSoup(item.get_content(), 'html.parser').get_text())
-    return '\n\n'.join(chapters)
-
-def extract_text_from_pdf(pdf_path):
-    reader = PdfReader(pdf_path)
-    text = []
-    for page in reader.pages:
-        text.append(page.extract_text())
-    return '\n\n'.join(text)
+        raise HTTPException(
+            status_code=500, 
+            detail=f"Error extracting text: {str(e)}"
+        )
 
 @app.get("/api/books/{book_id}/content")
-async def get_book_content(book_id: int, current_user: dict = Depends(get_current_user)):
+async def get_book_content(
+    book_id: int,
+    manifest: bool = False,
+    chapter: Optional[int] = None,
+    offset: Optional[int] = None,
+    length: Optional[int] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Get the text of a book.
+    - manifest=true returns the page/chapter boundaries instead of the text
+    - chapter=N returns a single section from the manifest
+    - offset/length return a slice of the full text by character offsets
+    Without any of these, the whole text is returned as before.
+    """
     logger.debug(f"Attempting to get content for book ID: {book_id}")
     
-    with Session(engine) as session:
-        book = session.get(Book, book_id)
-        logger.debug(f"Book found: {book}")
-        
-        if not book:
-            logger.warning("Book not found in database")
-            raise HTTPException(status_code=404, detail="Book not found")
-        
+    entry = await load_book_content(book_id)
+    
+    if manifest:
+        return {"book_id": book_id, **entry.public_manifest()}
+    
+    if chapter is not None:
+        sections = entry.manifest['sections']
+        if chapter < 0 or chapter >= len(sections):
+            raise HTTPException(status_code=404, detail=f"Chapter {chapter} not found")
+        section = sections[chapter]
+        return {
+            "chapter": chapter,
+            "title": section.get('title'),
+            "offset": section['offset'],
+            "length": section['length'],
+            "total_length": entry.total_length,
+            "content": entry.read_section(chapter)
+        }
+    
+    if offset is not None or length is not None:
+        offset = offset or 0
+        length = CONTENT_RANGE_DEFAULT_LENGTH if length is None else length
+        if offset < 0 or length < 0:
+            raise HTTPException(status_code=400, detail="offset and length must be non-negative")
+        content = entry.read_range(offset, length)
+        return {
+            "offset": min(offset, entry.total_length),
+            "length": len(content),
+            "total_length": entry.total_length,
+            "content": content
+        }
+    
+    return {"content": entry.read_all()}
+
+@app.get("/api/books/{book_id}/content/stream")
+async def stream_book_content(book_id: int, current_user: dict = Depends(get_current_user)):
+    """
+    Stream the text of a book as NDJSON, one line per page or chapter.
+    Each line is {"index", "title", "offset", "text"} and the last one is
+    {"done": true, "total_length", "sections"}. On a cache miss each section
+    is sent as soon as it is extracted and written to the cache on the way.
+    Extraction then runs in a server thread rather than the process pool,
+    but still holds an extraction slot for the length of the stream.
+    """
+    logger.debug(f"Attempting to stream content for book ID: {book_id}")
+    
+    book, fingerprint, blob, entry = await asyncio.to_thread(resolve_book_content, book_id)
+    
+    if entry is None:
+        try:
+            await extraction_pool.acquire()
+        except ExtractionQueueFull:
+            logger.warning(f"Extraction queue full, rejecting stream for book {book_id}")
+            raise extraction_busy_error()
+        
+        loop = asyncio.get_running_loop()
+        released = False
+        
+        def release_slot():
+            # Called from the stream thread when the generator finishes or the client goes away
+            nonlocal released
+            if not released:
+                released = True
+                loop.call_soon_threadsafe(extraction_pool.release)
+    
+    def section_line(section: dict, text: str) -> str:
+        return json.dumps({
+            "index": section['index'],
+            "title": section.get('title'),
+            "offset": section['offset'],
+            "text": text
+        }) + "\n"
+    
+    def done_line(total_length: int, section_count: int) -> str:
+        return json.dumps({"done": True, "total_length": total_length, "sections": section_count}) + "\n"
+    
+    def stream_cached():
+        sections = entry.manifest['sections']
+        for index, text in entry.iter_sections():
+            yield section_line(sections[index], text)
+        yield done_line(entry.total_length, len(sections))
+    
+    def stream_extracted():
         temp_file = None
+        writer = None
         try:
-            if DEBUG_MODE:
-                # Local file mode - use ebook_path
-                if not book.ebook_path:
-                    logger.warning("Book has no associated file path")
-                    raise HTTPException(status_code=404, detail="Book has no associated file")
-                
-                # Use the path directly
-                file_path = os.path.join(EBOOKS_DIR, os.path.basename(book.ebook_path))
-                
-            else:
-                # Cloud storage mode - use ebook_url
-                if not book.ebook_url:
-                    logger.warning("Book has no associated URL")
-                    raise HTTPException(status_code=404, detail="Book has no associated URL")
-                
-                logger.debug(f"Ebook URL: {book.ebook_url}")
-                
-                # Create temp directory if it doesn't exist
-                temp_dir = os.path.join(BASE_DIR, "temp_files")
-                os.makedirs(temp_dir, exist_ok=True)
-                
-                extension = book.ebook_format  # Remove the dot
-                # Set up the temp file path
-                temp_file = os.path.join(temp_dir, f"temp_{book_id}_{int(time.time())}.{extension}")
-                
-                logger.debug(f"Downloading from URL: {book.ebook_url}")
-                
-                # Try alternative method using GCS client if HTTP download fails
-                try:
-                    logger.debug("Attempting download with GCS client")
-                    from google.cloud import storage
-                    
-                    # Parse URL to get bucket and blob path
-                    parts = book.ebook_url.replace("https://storage.cloud.google.com/", "").split("/", 1)
-                    bucket_name = parts[0]
-                    blob_path = parts[1] if len(parts) > 1 else ""
-                    
-                    # Initialize the storage client
-                    storage_client = storage.Client()
-                    bucket = storage_client.bucket(bucket_name)
-                    blob = bucket.blob(blob_path)
-                    
-                    # Download the file
-                    blob.download_to_filename(temp_file)
-                    file_path = temp_file
-                    logger.debug(f"Successfully downloaded with GCS client")
-                    
-                except Exception as gcs_error:
-                    logger.error(f"GCS client download also failed: {str(gcs_error)}")
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Failed to download file: {str(e)}"
-                    )
-            
-            # Process file based on extension
-            extension = os.path.splitext(file_path)[1].lower()[1:]  # Remove the dot
-            
-            if extension == 'pdf':
-                logger.debug("Extracting text from PDF")
-                content = extract_text_from_pdf(file_path)
-            elif extension == 'epub':
-                logger.debug("Extracting text from EPUB")
-                content = extract_text_from_epub(file_path)
-            else:
-                logger.debug("Reading plain text file")
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-            
-            logger.debug(f"Content extracted successfully, length: {len(content)}")
-            return {"content": content}
-            
+            file_path, temp_file = fetch_ebook_file(book, blob)
+            kind, sections = iter_ebook_sections(file_path)
+            writer = content_cache.writer(book_id, fingerprint, kind)
+            count = 0
+            for title, text in sections:
+                section = writer.write(title, text)
+                count += 1
+                yield section_line(section, text)
+            total_length = writer.total_length
+            writer.commit()
+            writer = None
+            yield done_line(total_length, count)
         except Exception as e:
-            logger.error(f"Error extracting text: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
-            
-            raise HTTPException(
-                status_code=500, 
-                detail=f"Error extracting text: {str(e)}"
-            )
+            # Headers are already sent, so report the failure in-band
+            detail = e.detail if isinstance(e, HTTPException) else f"Error extracting text: {str(e)}"
+            logger.error(f"Error streaming text for book {book_id}: {str(e)}")
+            yield json.dumps({"error": detail}) + "\n"
         finally:
-            # Clean up temp file if it was created
+            if writer is not None:
+                writer.abort()
             if temp_file and os.path.exists(temp_file):
-                #os.remove(temp_file)
-                pass
+                os.remove(temp_file)
+            release_slot()
+    
+    if entry is not None:
+        return StreamingResponse(stream_cached(), media_type="application/x-ndjson")
+    return StreamingResponse(
+        stream_extracted(),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(release_slot)
+    )
+
+inflight_indexing: Dict[tuple, asyncio.Future] = {}
+
+async def ensure_book_indexed(book_id: int):
+    """Index a book's text for search unless it's already indexed for its current file"""
+    fingerprint, entry = await load_book_content_with_fingerprint(book_id)
+    if await asyncio.to_thread(search_index.indexed_fingerprint, book_id) == fingerprint:
+        return
+    
+    key = (book_id, fingerprint)
+    task = inflight_indexing.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(search_index.index_book, book_id, fingerprint, entry))
+        inflight_indexing[key] = task
+        task.add_done_callback(lambda finished: inflight_indexing.pop(key, None))
+    await asyncio.shield(task)
+
+# Background indexing tasks; the event loop only keeps weak references to tasks
+background_indexing: Set[asyncio.Future] = set()
+
+def schedule_indexing(book_id: int):
+    """Extract and index a book in the background after it's created or its ebook changes"""
+    async def run():
+        try:
+            await ensure_book_indexed(book_id)
+        except Exception as e:
+            logger.error(f"Failed to index book {book_id}: {str(e)}")
+    task = asyncio.ensure_future(run())
+    background_indexing.add(task)
+    task.add_done_callback(background_indexing.discard)
+
+def search_results_with_books(results: List[dict]) -> List[dict]:
+    """Add title and author to search hits with a single query"""
+    book_ids = {result["book_id"] for result in results}
+    if not book_ids:
+        return results
+    with Session(engine) as session:
+        books = {
+            book_id: (title, author)
+            for book_id, title, author in session.exec(
+                select(Book.id, Book.title, Book.author).where(Book.id.in_(book_ids))
+            ).all()
+        }
+    return [
+        dict(result, title=books[result["book_id"]][0], author=books[result["book_id"]][1])
+        for result in results if result["book_id"] in books
+    ]
+
+@app.get("/api/search")
+async def search_library(q: str, limit: int = 20, current_user: dict = Depends(get_current_user)):
+    """
+    Search inside every indexed book.
+    Returns ranked passages with a snippet and the character offset of the match,
+    which can be passed to /api/books/{id}/content?offset= to jump there.
+    """
+    limit = max(1, min(limit, 100))
+    results = await asyncio.to_thread(search_index.search, q, None, limit)
+    results = await asyncio.to_thread(search_results_with_books, results)
+    return {"query": q, "results": results}
+
+@app.get("/api/books/{book_id}/search")
+async def search_book(book_id: int, q: str, limit: int = 20, current_user: dict = Depends(get_current_user)):
+    """Search inside one book, indexing it first if needed"""
+    limit = max(1, min(limit, 100))
+    await ensure_book_indexed(book_id)
+    results = await asyncio.to_thread(search_index.search, q, book_id, limit)
+    return {"query": q, "book_id": book_id, "results": results}
 
 @app.get("/api/signed-url/{book_id}")
 async def get_signed_url(book_id: int, current_user: dict = Depends(get_current_user)):
@@ -1436,22 +2010,15 @@ async def get_signed_url(book_id: int, current_user: dict = Depends(get_current_
         
         try:
             if "storage.cloud.google.com" in book.audiobook_url:
-                parts = book.audiobook_url.replace("https://storage.cloud.google.com/", "").split("/", 1)
-                bucket_name = parts[0]
-                blob_path = parts[1] if len(parts) > 1 else ""
+                blob = blob_from_url(book.audiobook_url)
                 
-                storage_client = storage.Client()
-                bucket = storage_client.bucket(bucket_name)
-                blob = bucket.blob(blob_path)
+                # URL válida por 3 horas, reused until it gets close to expiring
+                url, expires_at = signed_url_cache.get_url(blob, timedelta(hours=3))
                 
-                # URL válida por 3 horas - usando timedelta correctamente
-                url = blob.generate_signed_url(
-                    version="v4",
-                    expiration=timedelta(hours=3),
-                    method="GET"
-                )
-                
-                return {"signed_url": url}
+                return {
+                    "signed_url": url,
+                    "expires_at": datetime.fromtimestamp(expires_at).isoformat()
+                }
             else:
                 return {"url": book.audiobook_url}
         except Exception as e:
@@ -1469,8 +2036,9 @@ async def generate_upload_url(
         filename = body.get('filename')
         file_type = body.get('file_type')  # 'ebook' or 'audiobook'
         content_type = body.get('content_type', 'application/octet-stream')
+        sha256 = (body.get('sha256') or '').lower() or None  # Optional, names the file by its content
         
-        logger.debug(f"Generate upload URL - filename: {filename}, file_type: {file_type}, content_type: {content_type}")
+        logger.debug(f"Generate upload URL - filename: {filename}, file_type: {file_type}, content_type: {content_type}, sha256: {sha256}")
         
         if not filename or not file_type:
             raise HTTPException(
@@ -1485,6 +2053,26 @@ async def generate_upload_url(
                 detail="file_type must be 'ebook', 'audiobook', or 'transcription'"
             )
         
+        if sha256 and not sha256_from_filename(sha256):
+            raise HTTPException(
+                status_code=400,
+                detail="sha256 must be 64 hexadecimal characters"
+            )
+        
+        bucket_name = DEFAULT_BUCKET
+        if sha256 and file_type in CONTENT_ADDRESSED_TYPES:
+            # Content already stored doesn't have to be uploaded again. Uploads are
+            # hashed again on our side before they are stored by content
+            stored_url = storage_url(bucket_name, f"{STORAGE_FOLDERS[file_type]}/{content_filename(sha256, filename)}")
+            if await asyncio.to_thread(stored_files.reserve, stored_url):
+                logger.info(f"{file_type} {filename} is already stored as {stored_url}, no upload needed")
+                return {
+                    "exists": True,
+                    "signed_url": None,
+                    "final_url": stored_url,
+                    "blob_name": parse_storage_url(stored_url)[1]
+                }
+        
         # Generate unique filename to avoid conflicts
         import uuid
         if file_type == 'transcription':
@@ -1494,7 +2082,6 @@ async def generate_upload_url(
         else:
             unique_filename = f"{uuid.uuid4()}_{filename}"
         
-        bucket_name = "intellibook_static"
         if file_type == 'ebook':
             folder = "ebooks"
         elif file_type == 'audiobook':
@@ -1503,11 +2090,10 @@ async def generate_upload_url(
             folder = "transcriptions"
         
         blob_name = f"{folder}/{unique_filename}"
+        final_url = storage_url(bucket_name, blob_name)
         
-        # Create storage client
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
+        # Shared storage client
+        blob = get_bucket(bucket_name).blob(blob_name)
         
         # Generate signed URL for PUT operation (upload)
         signed_url = blob.generate_signed_url(
@@ -1518,9 +2104,8 @@ async def generate_upload_url(
         )
         
         # Return the signed URL and the final cloud storage URL
-        final_url = f"https://storage.cloud.google.com/{bucket_name}/{blob_name}"
-        
         return {
+            "exists": False,
             "signed_url": signed_url,
             "final_url": final_url,
             "blob_name": blob_name
@@ -1548,19 +2133,10 @@ async def check_auth_status(request: Request):
         
         access_token = auth_header.split(" ")[1]
         
-        # Use the access token to get user info from Google's userinfo API
-        import httpx
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://www.googleapis.com/oauth2/v2/userinfo",
-                headers={"Authorization": f"Bearer {access_token}"}
-            )
-            
-            if response.status_code != 200:
-                return {"authenticated": False, "user": None, "error": "Invalid token"}
-            
-            user_info = response.json()
+        # Same cached, pooled verification path as authenticated endpoints
+        user_info = await get_user_info(access_token)
+        if user_info is None:
+            return {"authenticated": False, "user": None, "error": "Invalid token"}
         
         # Check if the email matches the allowed email
         allowed_email = os.getenv('ALLOWED_EMAIL')
@@ -1589,11 +2165,162 @@ async def auth_status(current_user: dict = Depends(get_current_user)):
         }
     }
 
+@app.get("/api/metrics")
+async def get_metrics(current_user: dict = Depends(get_current_user)):
+    """Report cache and performance counters"""
+    # These read the database, so they run off the event loop
+    search_stats, job_stats, stored_file_stats = await asyncio.gather(
+        asyncio.to_thread(search_index.stats),
+        asyncio.to_thread(job_queue.stats),
+        asyncio.to_thread(stored_files.stats)
+    )
+    return {
+        "content_cache": content_cache.stats(),
+        "extraction_pool": extraction_pool.stats(),
+        "auth_cache": token_cache_stats(),
+        "signed_url_cache": signed_url_cache.stats(),
+        "gemini": gemini.stats(),
+        "chat_sessions": chat_manager.stats(),
+        "routing": question_router.stats(),
+        "answer_cache": answer_cache.stats(),
+        "search_index": search_stats,
+        "progress_buffer": progress_buffer.stats(),
+        "jobs": job_stats,
+        "stored_files": stored_file_stats
+    }
+
+# Most transcription lines returned around a position on each side
+TRANSCRIPT_WINDOW_MAX_CUES = 200
+
+def resolve_transcript(book_id: int):
+    """
+    Look up a book's transcription and its content fingerprint.
+    Returns (book, fingerprint, blob, cached entry or None); blob is None in DEBUG_MODE.
+    Raises HTTPException if the book or its transcription can't be found.
+    """
+    with Session(engine) as session:
+        book = session.get(Book, book_id)
+    
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    blob = None
+    if DEBUG_MODE:
+        if not book.transcription_path:
+            raise HTTPException(status_code=404, detail="No transcription available for this book")
+        file_path = os.path.join(TRANSCRIPTIONS_DIR, os.path.basename(book.transcription_path))
+        if not os.path.exists(file_path):
+            logger.warning(f"Transcription file missing: {file_path}")
+            raise HTTPException(status_code=404, detail="Transcription file not found")
+        fingerprint = file_fingerprint(file_path)
+    else:
+        if not book.transcription_url:
+            raise HTTPException(status_code=404, detail="No transcription available for this book")
+        bucket_name, blob_path = parse_storage_url(book.transcription_url)
+        try:
+            blob = get_bucket(bucket_name).get_blob(blob_path)
+        except Exception as e:
+            logger.error(f"Error reading transcription metadata: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Failed to access transcription file: {str(e)}")
+        if blob is None:
+            raise HTTPException(status_code=404, detail="Transcription file not found in storage")
+        fingerprint = str(blob.generation or blob.etag)
+    
+    # Kept next to the extracted ebook text, under a key of its own
+    fingerprint = f"transcript{fingerprint}"
+    return book, fingerprint, blob, content_cache.get(book_id, fingerprint)
+
+def build_transcript(book: Book, fingerprint: str, blob) -> ContentEntry:
+    """Parse a transcription into the content cache with its time index"""
+    temp_file = None
+    if DEBUG_MODE:
+        file_path = os.path.join(TRANSCRIPTIONS_DIR, os.path.basename(book.transcription_path))
+    else:
+        temp_dir = os.path.join(BASE_DIR, "temp_files")
+        os.makedirs(temp_dir, exist_ok=True)
+        temp_file = os.path.join(temp_dir, f"temp_transcription_{book.id}_{uuid.uuid4().hex}.txt")
+        blob.download_to_filename(temp_file)
+        file_path = temp_file
+    
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            cues, untimed = parse_transcription(f)
+        logger.info(f"Parsed transcription of book {book.id}: {len(cues)} timed lines, {len(untimed)} untimed")
+        return write_transcript(content_cache.writer(book.id, fingerprint, 'transcript'), cues, untimed)
+    finally:
+        if temp_file and os.path.exists(temp_file):
+            os.remove(temp_file)
+
+async def load_transcript(book_id: int) -> TranscriptIndex:
+    """
+    Return the parsed transcription of a book, parsing and caching it on a miss.
+    Raises HTTPException if the book or its transcription can't be found.
+    """
+    book, fingerprint, blob, entry = await asyncio.to_thread(resolve_transcript, book_id)
+    if entry is None:
+        try:
+            entry = await asyncio.to_thread(build_transcript, book, fingerprint, blob)
+        except Exception as e:
+            logger.error(f"Error parsing transcription: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Error reading transcription: {str(e)}")
+    return TranscriptIndex(entry)
+
+def saved_audiobook_position(book_id: int) -> float:
+    buffered = progress_buffer.get(book_id)
+    if buffered:
+        return buffered["audiobook_position"] or 0
+    with Session(engine) as session:
+        position = session.exec(
+            select(ReadingProgress.audiobook_position).where(ReadingProgress.book_id == book_id)
+        ).first()
+    return position or 0
+
+@app.get("/api/books/{book_id}/transcription/window")
+async def get_transcription_window(
+    book_id: int,
+    position: Optional[float] = None,
+    before: int = 2,
+    after: int = 10,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Transcription lines around a position of the audiobook, in seconds:
+    the line playing then, `before` lines before it and `after` lines after it.
+    Without a position, the saved audiobook_position of the book is used.
+    """
+    if before < 0 or after < 0:
+        raise HTTPException(status_code=400, detail="before and after must be non-negative")
+    
+    transcript = await load_transcript(book_id)
+    if not transcript.timed:
+        raise HTTPException(status_code=404, detail="Transcription has no timestamps")
+    
+    if position is None:
+        position = await asyncio.to_thread(saved_audiobook_position, book_id)
+    return {
+        "book_id": book_id,
+        **transcript.window(
+            max(position, 0),
+            min(before, TRANSCRIPT_WINDOW_MAX_CUES),
+            min(after, TRANSCRIPT_WINDOW_MAX_CUES)
+        )
+    }
+
 @app.get("/api/books/{book_id}/transcription")
-async def get_book_transcription(book_id: int, current_user: dict = Depends(get_current_user)):
-    """Get transcription content for a book"""
+async def get_book_transcription(book_id: int, page: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    """
+    Get transcription content for a book.
+    - page=N returns one page of it, with the start and end of each line
+    Without it, the whole file is returned as before.
+    """
     logger.debug(f"Attempting to get transcription for book ID: {book_id}")
     
+    if page is not None:
+        transcript = await load_transcript(book_id)
+        if page < 0 or page >= transcript.pages:
+            raise HTTPException(status_code=404, detail=f"Page {page} not found")
+        return {"book_id": book_id, **transcript.page(page)}
+    
     with Session(engine) as session:
         book = session.get(Book, book_id)
         logger.debug(f"Book found: {book}")
@@ -1638,17 +2365,7 @@ async def get_book_transcription(book_id: int, current_user: dict = Depends(get_
                 # Download transcription from cloud storage
                 try:
                     logger.debug("Attempting download with GCS client")
-                    from google.cloud import storage
-                    
-                    # Parse URL to get bucket and blob path
-                    parts = book.transcription_url.replace("https://storage.cloud.google.com/", "").split("/", 1)
-                    bucket_name = parts[0]
-                    blob_path = parts[1] if len(parts) > 1 else ""
-                    
-                    # Initialize the storage client
-                    storage_client = storage.Client()
-                    bucket = storage_client.bucket(bucket_name)
-                    blob = bucket.blob(blob_path)
+                    blob = blob_from_url(book.transcription_url)
                     
                     # Download the file
                     blob.download_to_filename(temp_file)
@@ -1687,6 +2404,20 @@ async def get_book_transcription(book_id: int, current_user: dict = Depends(get_
                 except:
                     pass
 
+@app.on_event("startup")
+async def startup_event():
+    progress_buffer.start()
+    await job_queue.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Unfinished jobs go back to the queue
+    await job_queue.stop()
+    # Write progress still in memory before the instance goes away
+    await progress_buffer.stop()
+    extraction_pool.shutdown()
+    await close_http_client()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
@@ -1,4 +1,6 @@
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Column, Text
+from sqlalchemy.dialects.mysql import LONGTEXT
 from typing import Optional
 from datetime import date, datetime
 import os
@@ -14,14 +16,14 @@ os.makedirs(AUDIOBOOKS_DIR, exist_ok=True)
 
 class ReadingProgress(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    book_id: int = Field(foreign_key="book.id")
+    book_id: int = Field(foreign_key="book.id", unique=True, index=True)  # One row per book
     current_page: Optional[int] = None
     total_pages: Optional[int] = None
     current_chapter: Optional[str] = None
     audiobook_position: Optional[int] = None  # Position in seconds
     scroll_position: float = Field(default=0)  # Para el scroll del texto
     progress_percentage: float = Field(default=0)  # Porcentaje general de progreso
-    last_read_date: datetime = Field(default_factory=datetime.now)
+    last_read_date: datetime = Field(default_factory=datetime.now, index=True)
     notes: Optional[str] = None
     
     # Add relationship to Book
@@ -29,8 +31,8 @@ class ReadingProgress(SQLModel, table=True):
 
 class Book(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    title: str
-    author: str
+    title: str = Field(index=True)
+    author: str = Field(index=True)
     cover_url: Optional[str] = None
     isbn: Optional[str] = None
     publisher: Optional[str] = None
@@ -38,7 +40,7 @@ class Book(SQLModel, table=True):
     pages: Optional[int] = None
     language: Optional[str] = None
     description: Optional[str] = None
-    status: str = Field(default="Por leer")  # Por leer, Leyendo, Leído
+    status: str = Field(default="Por leer", index=True)  # Por leer, Leyendo, Leído
     start_date: Optional[date] = None
     finish_date: Optional[date] = None
     notes: Optional[str] = None
@@ -60,4 +62,35 @@ class Book(SQLModel, table=True):
     audiobook_format: Optional[str] = None  # mp3, m4b, etc.
     
     transcription_url: Optional[str] = None  # For cloud storage URLs
-    transcription_path: Optional[str] = None  # For local files 
\ No newline at end of file
+    transcription_path: Optional[str] = None  # For local files 
+
+class ChatSession(SQLModel, table=True):
+    """Persisted history of a Dorian chat, so any instance can continue it"""
+    session_id: str = Field(primary_key=True, max_length=255)
+    history: str = Field(sa_column=Column(Text().with_variant(LONGTEXT(), "mysql"), nullable=False))  # JSON list of contents
+    version: int = Field(default=0)  # Incremented on every saved turn
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+class Job(SQLModel, table=True):
+    """Background work, such as ingesting a new book, run by the worker pool in jobs.py"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str = Field(max_length=50)
+    book_id: Optional[int] = Field(default=None, index=True)  # No foreign key, a job outlives a deleted book
+    status: str = Field(default="queued", index=True)  # queued, running, done, failed
+    stage: Optional[str] = None  # Stage being run, or the one that failed
+    attempts: int = Field(default=0)
+    max_attempts: int = Field(default=3)
+    payload: str = Field(default="{}", sa_column=Column(Text, nullable=False))  # JSON, kept up to date between stages
+    error: Optional[str] = Field(default=None, sa_column=Column(Text))
+    run_after: datetime = Field(default_factory=datetime.now)  # Retries wait until then
+    created_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+class StoredFile(SQLModel, table=True):
+    """A file stored under its SHA-256, with the number of book fields pointing at it"""
+    location: str = Field(primary_key=True, max_length=255)  # Local path or storage URL, as saved on books
+    sha256: str = Field(max_length=64, index=True)
+    size: Optional[int] = None
+    refcount: int = Field(default=0)
+    reserved_until: Optional[datetime] = None  # Kept until then for a book about to point at it
+    created_at: datetime = Field(default_factory=datetime.now)
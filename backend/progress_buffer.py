@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy.dialects import mysql, sqlite
+from sqlmodel import Session, select
+
+from models import Book, ReadingProgress
+
+logger = logging.getLogger(__name__)
+
+# Seconds between writes of buffered progress; 0 writes every update straight through
+PROGRESS_FLUSH_INTERVAL = float(os.getenv('PROGRESS_FLUSH_INTERVAL', '10'))
+
+# Attempts at writing a book's progress before it is dropped
+PROGRESS_MAX_ATTEMPTS = int(os.getenv('PROGRESS_MAX_ATTEMPTS', '5'))
+
+# Fields a progress update may change, with their type
+UPDATABLE_FIELDS = {
+    "scroll_position": float,
+    "progress_percentage": float,
+    "current_page": int,
+    "total_pages": int,
+    "current_chapter": str,
+    "audiobook_position": int
+}
+# Columns that can't be NULL
+REQUIRED_FIELDS = ("scroll_position", "progress_percentage")
+
+
+def clean_progress(data: Dict) -> Dict:
+    """
+    The updatable fields of a progress update, converted to their column types.
+    Raises ValueError for a value that doesn't fit, so a bad update fails its
+    own request instead of the batch it would be written in.
+    """
+    cleaned = {}
+    for field, kind in UPDATABLE_FIELDS.items():
+        if field not in data:
+            continue
+        value = data[field]
+        if value is None:
+            if field in REQUIRED_FIELDS:
+                raise ValueError(f"{field} can't be null")
+            cleaned[field] = None
+        elif kind is str:
+            if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+                raise ValueError(f"{field} must be a string")
+            cleaned[field] = str(value)
+        else:
+            if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+                raise ValueError(f"{field} must be a number")
+            try:
+                number = float(value)
+            except ValueError:
+                raise ValueError(f"{field} must be a number")
+            if not math.isfinite(number):
+                raise ValueError(f"{field} must be a finite number")
+            # The audio player reports fractions of a second
+            cleaned[field] = round(number) if kind is int else number
+    return cleaned
+
+
+def progress_state(book_id: int, progress: Optional[ReadingProgress]) -> Dict:
+    """The progress of a book as returned by the API, with defaults if it has none yet"""
+    if progress is None:
+        return {
+            "id": None,
+            "book_id": book_id,
+            "scroll_position": 0,
+            "progress_percentage": 0,
+            "current_page": None,
+            "total_pages": None,
+            "current_chapter": None,
+            "audiobook_position": None,
+            "last_read_date": datetime.now(),
+            "notes": None
+        }
+    return {
+        "id": progress.id,
+        "book_id": progress.book_id,
+        "scroll_position": progress.scroll_position,
+        "progress_percentage": progress.progress_percentage,
+        "current_page": progress.current_page,
+        "total_pages": progress.total_pages,
+        "current_chapter": progress.current_chapter,
+        "audiobook_position": progress.audiobook_position,
+        "last_read_date": progress.last_read_date,
+        "notes": progress.notes
+    }
+
+
+def upsert_statement(dialect: str, fields: Iterable[str]):
+    """
+    Insert a book's progress, or update `fields` if the book already has a row.
+    One statement thanks to the unique index on book_id; with no fields an
+    existing row is left as it is.
+    """
+    fields = [field for field in fields if field != "book_id"]
+    if dialect == 'mysql':
+        statement = mysql.insert(ReadingProgress)
+        if not fields:
+            return statement.prefix_with('IGNORE')
+        return statement.on_duplicate_key_update({field: statement.inserted[field] for field in fields})
+    statement = sqlite.insert(ReadingProgress)
+    if not fields:
+        return statement.on_conflict_do_nothing(index_elements=["book_id"])
+    return statement.on_conflict_do_update(
+        index_elements=["book_id"],
+        set_={field: statement.excluded[field] for field in fields}
+    )
+
+
+class PendingProgress:
+    def __init__(self, state: Dict):
+        self.state = state
+        self.changed = set()  # Fields to write on the next flush
+        self.attempts = 0  # Failed writes so far
+
+
+class ProgressBuffer:
+    """
+    Write-behind buffer for reading and listening progress.
+
+    The reader and the audio player report progress every few seconds and
+    each report replaces the previous one, so updates are merged in memory,
+    keeping only the latest state of each book, and written in one
+    transaction every `flush_interval` seconds and at shutdown. Only the
+    fields that were updated are written, so a stale copy can't overwrite
+    other fields. get() returns the buffered state of a book, so reads see
+    updates that haven't been written yet.
+    """
+
+    def __init__(self, engine, flush_interval: float = PROGRESS_FLUSH_INTERVAL):
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self._pending: Dict[int, PendingProgress] = {}
+        self._flushing: Dict[int, PendingProgress] = {}  # Being written right now, still visible to get()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # One flush at a time, so writes can't land out of order
+        self._task: Optional[asyncio.Task] = None
+        self.updates = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+
+    def _load_state(self, book_id: int) -> Dict:
+        with Session(self.engine) as session:
+            progress = session.exec(
+                select(ReadingProgress).where(ReadingProgress.book_id == book_id)
+            ).first()
+            return progress_state(book_id, progress)
+
+    def update(self, book_id: int, data: Dict) -> Dict:
+        """
+        Merge a progress update into the buffer and return the book's resulting progress.
+        Raises ValueError if a field has a value of the wrong type.
+        """
+        data = clean_progress(data)
+        state = None
+        while True:
+            with self._lock:
+                entry = self._pending.get(book_id)
+                if entry is None and book_id in self._flushing:
+                    # Newer than the database until the flush in progress commits
+                    state = dict(self._flushing[book_id].state)
+                if entry is None and state is not None:
+                    entry = self._pending[book_id] = PendingProgress(state)
+                if entry is not None:
+                    # Applied under the lock, so a flush can't take the entry halfway
+                    for field, value in data.items():
+                        entry.state[field] = value
+                        entry.changed.add(field)
+                    entry.state["last_read_date"] = datetime.now()
+                    entry.changed.add("last_read_date")
+                    self.updates += 1
+                    result = dict(entry.state)
+                    break
+            # The stored progress is only read once per flush interval, not on every update
+            state = self._load_state(book_id)
+
+        if self.flush_interval <= 0:
+            self.flush()
+        return result
+
+    def get(self, book_id: int) -> Optional[Dict]:
+        """The buffered progress of a book, or None if it has no unwritten updates"""
+        with self._lock:
+            entry = self._pending.get(book_id) or self._flushing.get(book_id)
+            return dict(entry.state) if entry is not None else None
+
+    def ensure_row(self, book_id: int):
+        """Create an empty progress row for a book unless it already has one"""
+        with self.engine.begin() as connection:
+            connection.execute(upsert_statement(self.engine.dialect.name, ()), [{"book_id": book_id}])
+
+    def discard(self, book_id: int):
+        """Drop unwritten updates, e.g. for a book being deleted"""
+        with self._lock:
+            self._pending.pop(book_id, None)
+
+    def flush(self) -> int:
+        """
+        Write all buffered progress in one transaction; returns the number of books written.
+        If the transaction fails each book is written on its own, so one that can't
+        be written doesn't hold back the others.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+            if not pending:
+                return 0
+
+            try:
+                written = self._write(pending)
+            except Exception as e:
+                logger.error(f"Error writing buffered progress, writing one book at a time: {e}")
+                written = self._write_each(pending)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+        self.flushes += 1
+        self.rows_written += written
+        logger.debug(f"Wrote buffered progress of {written} books")
+        return written
+
+    def _write(self, pending: Dict[int, PendingProgress]) -> int:
+        with self.engine.begin() as connection:
+            # Books deleted since their progress was buffered are skipped
+            existing_books = set(connection.execute(select(Book.id).where(Book.id.in_(list(pending)))).scalars())
+
+            # One upsert per set of updated fields, usually just one
+            batches: Dict[frozenset, list] = {}
+            for book_id, entry in pending.items():
+                if book_id in existing_books:
+                    row = {field: entry.state[field] for field in entry.changed}
+                    row["book_id"] = book_id
+                    batches.setdefault(frozenset(entry.changed), []).append(row)
+            for fields, rows in batches.items():
+                connection.execute(upsert_statement(self.engine.dialect.name, fields), rows)
+            return sum(len(rows) for rows in batches.values())
+
+    def _write_each(self, pending: Dict[int, PendingProgress]) -> int:
+        """Write each book in its own transaction; failed ones are retried on the next flush, then dropped"""
+        written = 0
+        failed = {}
+        for book_id, entry in pending.items():
+            try:
+                written += self._write({book_id: entry})
+            except Exception as e:
+                self.failures += 1
+                entry.attempts += 1
+                if entry.attempts >= PROGRESS_MAX_ATTEMPTS:
+                    logger.error(f"Dropping progress of book {book_id} after {entry.attempts} failed writes: {e}")
+                else:
+                    logger.error(f"Error writing progress of book {book_id}, will retry: {e}")
+                    failed[book_id] = entry
+        self._requeue(failed)
+        return written
+
+    def _requeue(self, pending: Dict[int, PendingProgress]):
+        """Put back updates that couldn't be written, without overwriting newer ones"""
+        with self._lock:
+            for book_id, entry in pending.items():
+                newer = self._pending.get(book_id)
+                if newer is None:
+                    self._pending[book_id] = entry
+                    continue
+                for field in entry.changed - newer.changed:
+                    newer.state[field] = entry.state[field]
+                newer.changed |= entry.changed
+                newer.attempts = entry.attempts
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.to_thread(self.flush)
+
+    def start(self):
+        if self.flush_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the periodic flush and write whatever is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.flush)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "flush_interval": self.flush_interval,
+            "updates": self.updates,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "failures": self.failures
+        }
@@ -0,0 +1,125 @@
+import logging
+import os
+import re
+import unicodedata
+from typing import Awaitable, Callable, Dict, Optional
+
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+ROUTING_CACHE_TTL = int(os.getenv('ROUTING_CACHE_TTL', '86400'))
+ROUTING_CACHE_SIZE = int(os.getenv('ROUTING_CACHE_SIZE', '1024'))
+
+# Questions longer than this are left to the model, rules get unreliable
+MAX_LOCAL_WORDS = 14
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase, strip accents and punctuation and collapse whitespace"""
+    decomposed = unicodedata.normalize('NFKD', question.lower())
+    text = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'\w+', text))
+
+
+def analysis(needs_db: bool, required_data=(), query_type: Optional[str] = None) -> Dict:
+    return {
+        "needs_db": needs_db,
+        "required_data": list(required_data),
+        "query_type": query_type,
+        "book_title": None
+    }
+
+
+# (pattern over the normalized question, routing result), checked in order.
+# Patterns only cover questions about the library as a whole, since a
+# specific book title can't be extracted reliably without the model.
+LIBRARY_RULES = [
+    (re.compile(r'\b(que|cual|cuales) (libros? )?(estoy leyendo|leo ahora)\b|\bwhat (book |books )?am i (currently )?reading\b|\bcurrently reading\b'),
+     analysis(True, ["books", "reading_progress"], "reading_progress")),
+    (re.compile(r'\b(mi|mis) progreso\b|\bmy (reading )?progress\b|\bdonde me quede\b|\bwhere did i (leave off|stop)\b'),
+     analysis(True, ["reading_progress"], "reading_progress")),
+    # Only first-person and possessive forms: "how many books are in the series" is a general question
+    (re.compile(r'\b(mis|my) libros?\b|\bmy books?\b|\b(mi|my) (biblioteca|library|coleccion|collection)\b'
+                r'|\bcuantos libros (tengo|he leido|me quedan|llevo)\b|\bhow many books (do i|did i|have i|i have|i ve)\b'
+                r'|\b(tengo|me quedan?|me falta[n]?) (\w+ )?por leer\b|\bmy (to read|tbr)( list| pile)?\b'
+                r'|\b(do i have|have i got|i have) (left )?to read\b|\b(he|have i) (leido|read)\b'
+                r'|\b(termine de leer|he terminado de leer|did i finish|have i finished)\b'),
+     analysis(True, ["books"], "all_books")),
+]
+
+SMALL_TALK = re.compile(r'^(hola|hi|hello|hey|buenas|buenos dias|buenas tardes|buenas noches|gracias|muchas gracias|thanks|thank you|ok|vale|adios|bye)( dorian)?$')
+
+
+def looks_like_specific_book(question: str) -> bool:
+    """Quoted text or capitalized words after the first one usually name a book"""
+    if re.search(r'["“”«»]|(^|\s)\'[^\']+\'', question):
+        return True
+    tokens = question.split()
+    return any(token[:1].isupper() for token in tokens[1:] if token.lower() not in ('i', "i'm"))
+
+
+def classify_question(question: str) -> Optional[Dict]:
+    """
+    Route obvious questions without calling the model.
+    Returns None when the rules aren't confident and the model should decide.
+    """
+    normalized = normalize_question(question)
+    if not normalized:
+        return None
+    if SMALL_TALK.match(normalized):
+        return analysis(False)
+    if len(normalized.split()) > MAX_LOCAL_WORDS or looks_like_specific_book(question):
+        return None
+    for pattern, result in LIBRARY_RULES:
+        if pattern.search(normalized):
+            return dict(result, required_data=list(result["required_data"]))
+    return None
+
+
+class QuestionRouter:
+    """
+    Decides how to answer a question: local rules first, then a cache of
+    earlier model answers keyed by the normalized question, then the model.
+    """
+
+    def __init__(
+        self,
+        route_with_model: Callable[[str], Awaitable[Dict]],
+        ttl: int = ROUTING_CACHE_TTL,
+        maxsize: int = ROUTING_CACHE_SIZE
+    ):
+        self.route_with_model = route_with_model
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.local_hits = 0
+        self.cache_hits = 0
+        self.model_calls = 0
+
+    async def route(self, question: str) -> Dict:
+        """Raises whatever route_with_model raises; failures are not cached"""
+        local = classify_question(question)
+        if local is not None:
+            self.local_hits += 1
+            logger.debug(f"Routed locally: {local}")
+            return local
+
+        key = normalize_question(question)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self.cache_hits += 1
+            return dict(cached, required_data=list(cached["required_data"]))
+
+        self.model_calls += 1
+        result = await self.route_with_model(question)
+        self._cache[key] = result
+        return dict(result, required_data=list(result["required_data"]))
+
+    def stats(self) -> dict:
+        total = self.local_hits + self.cache_hits + self.model_calls
+        return {
+            "entries": len(self._cache),
+            "local_hits": self.local_hits,
+            "cache_hits": self.cache_hits,
+            "model_calls": self.model_calls,
+            "hit_rate": (self.local_hits + self.cache_hits) / total if total else 0.0
+        }
@@ -0,0 +1,244 @@
+import logging
+import os
+import re
+import unicodedata
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from content_cache import ContentEntry
+
+logger = logging.getLogger(__name__)
+
+# Passages are indexed separately so hits can point at a place in the book
+SEARCH_CHUNK_CHARS = int(os.getenv('SEARCH_CHUNK_CHARS', '1500'))
+SNIPPET_CHARS = 200
+
+# Words that say nothing about which passage a question is about (accents already removed)
+STOP_WORDS = set("""
+the and for with that this what which who whom whose why how when where does did are was were has have had
+about from into book books novel chapter tell explain mean means meaning
+que quien quienes cual cuales como cuando donde por para con una uno unos unas los las del al
+sobre este esta estos estas ese esa eso libro libros novela capitulo dime explica significa significado
+hay son fue era tiene
+""".split())
+
+SQLITE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS book_search_state (
+        book_id INTEGER PRIMARY KEY,
+        fingerprint VARCHAR(64) NOT NULL,
+        chunks INTEGER NOT NULL,
+        indexed_at TIMESTAMP NOT NULL
+    )""",
+    # remove_diacritics so "anos" finds "años"
+    """CREATE VIRTUAL TABLE IF NOT EXISTS book_chunk_fts USING fts5(
+        text,
+        book_id UNINDEXED,
+        section UNINDEXED,
+        start UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+]
+
+MYSQL_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS book_search_state (
+        book_id INT PRIMARY KEY,
+        fingerprint VARCHAR(64) NOT NULL,
+        chunks INT NOT NULL,
+        indexed_at DATETIME NOT NULL
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+    """CREATE TABLE IF NOT EXISTS book_chunk (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        book_id INT NOT NULL,
+        section INT NOT NULL,
+        start INT NOT NULL,
+        text MEDIUMTEXT NOT NULL,
+        INDEX ix_book_chunk_book_id (book_id),
+        FULLTEXT INDEX ft_book_chunk_text (text)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+]
+
+
+def fold_char(c: str) -> str:
+    lower = c.lower()
+    if len(lower) != 1:
+        return c
+    decomposed = unicodedata.normalize('NFKD', lower)
+    return decomposed[0] if all(unicodedata.combining(mark) for mark in decomposed[1:]) else lower
+
+
+def fold(value: str) -> str:
+    """Lowercase and strip accents, keeping one character per input character so offsets still line up"""
+    return ''.join(fold_char(c) for c in value)
+
+
+def query_terms(query: str) -> List[str]:
+    return re.findall(r'\w+', fold(query))
+
+
+def iter_chunks(entry: ContentEntry, size: int = SEARCH_CHUNK_CHARS) -> Iterator[Tuple[int, int, str]]:
+    """Yield (section index, character offset, text) passages, split at whitespace"""
+    for section in entry.manifest['sections']:
+        start = 0
+        section_text = entry.read_section(section['index'])
+        while start < len(section_text):
+            end = min(start + size, len(section_text))
+            if end < len(section_text):
+                space = section_text.rfind(' ', start + size // 2, end)
+                if space > start:
+                    end = space + 1
+            chunk = section_text[start:end]
+            if chunk.strip():
+                yield section['index'], section['offset'] + start, chunk
+            start = end
+
+
+def make_snippet(chunk: str, terms: List[str], width: int = SNIPPET_CHARS) -> Tuple[int, str]:
+    """Return (offset of the first matching term in the chunk, text around it)"""
+    folded = fold(chunk)
+    positions = [m.start() for term in terms for m in [re.search(r'\b' + re.escape(term), folded)] if m]
+    position = min(positions) if positions else 0
+    start = max(0, position - width // 3)
+    if start > 0:
+        # Don't cut the first word in half
+        space = chunk.find(' ', start, position)
+        start = space + 1 if space != -1 else start
+    end = min(len(chunk), start + width)
+    snippet = ' '.join(chunk[start:end].split())
+    return position, ('…' if start > 0 else '') + snippet + ('…' if end < len(chunk) else '')
+
+
+class SearchIndex:
+    """
+    Full-text index over extracted book text.
+
+    Uses an FTS5 table on SQLite and a FULLTEXT index on MySQL. Each book is
+    indexed as passages carrying their character offset in the full text,
+    together with the fingerprint of the file they came from, so a book is
+    only indexed again when its file changes.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+
+    def create_schema(self):
+        statements = MYSQL_SCHEMA if self.dialect == 'mysql' else SQLITE_SCHEMA
+        with self.engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+
+    @property
+    def _chunk_table(self) -> str:
+        return 'book_chunk' if self.dialect == 'mysql' else 'book_chunk_fts'
+
+    def indexed_fingerprint(self, book_id: int) -> Optional[str]:
+        with self.engine.connect() as connection:
+            return connection.execute(
+                text("SELECT fingerprint FROM book_search_state WHERE book_id = :book_id"),
+                {"book_id": book_id}
+            ).scalar()
+
+    def index_book(self, book_id: int, fingerprint: str, entry: ContentEntry) -> int:
+        """Replace the indexed passages of a book; returns the number of passages"""
+        rows = [
+            {"book_id": book_id, "section": section, "start": start, "text": chunk}
+            for section, start, chunk in iter_chunks(entry)
+        ]
+        with self.engine.begin() as connection:
+            self._delete(connection, book_id)
+            if rows:
+                connection.execute(
+                    text(f"INSERT INTO {self._chunk_table} (book_id, section, start, text) VALUES (:book_id, :section, :start, :text)"),
+                    rows
+                )
+            connection.execute(
+                text("INSERT INTO book_search_state (book_id, fingerprint, chunks, indexed_at) VALUES (:book_id, :fingerprint, :chunks, :indexed_at)"),
+                {"book_id": book_id, "fingerprint": fingerprint, "chunks": len(rows), "indexed_at": datetime.now()}
+            )
+        logger.info(f"Indexed book {book_id}: {len(rows)} passages")
+        return len(rows)
+
+    def remove_book(self, book_id: int):
+        with self.engine.begin() as connection:
+            self._delete(connection, book_id)
+
+    def _delete(self, connection, book_id: int):
+        connection.execute(text(f"DELETE FROM {self._chunk_table} WHERE book_id = :book_id"), {"book_id": book_id})
+        connection.execute(text("DELETE FROM book_search_state WHERE book_id = :book_id"), {"book_id": book_id})
+
+    def _match(self, terms: List[str], book_id: Optional[int], limit: int, match_any: bool) -> list:
+        """Rows (book_id, section, start, text, score) matching the terms, best first"""
+        params = {"limit": limit}
+        book_filter = ""
+        if book_id is not None:
+            book_filter = "AND book_id = :book_id"
+            params["book_id"] = book_id
+
+        if self.dialect == 'mysql':
+            # Natural language mode ranks passages matching any of the words
+            params["query"] = ' '.join(terms)
+            sql = f"""SELECT book_id, section, start, text, MATCH(text) AGAINST (:query IN NATURAL LANGUAGE MODE) AS score
+                      FROM book_chunk
+                      WHERE MATCH(text) AGAINST (:query IN NATURAL LANGUAGE MODE) {book_filter}
+                      ORDER BY score DESC LIMIT :limit"""
+        else:
+            # Quote every term so user input can't inject FTS5 query syntax
+            params["query"] = (' OR ' if match_any else ' ').join(f'"{term}"' for term in terms)
+            sql = f"""SELECT book_id, section, start, text, -bm25(book_chunk_fts) AS score
+                      FROM book_chunk_fts
+                      WHERE book_chunk_fts MATCH :query {book_filter}
+                      ORDER BY bm25(book_chunk_fts) LIMIT :limit"""
+
+        with self.engine.connect() as connection:
+            return connection.execute(text(sql), params).all()
+
+    def search(self, query: str, book_id: Optional[int] = None, limit: int = 20) -> List[Dict]:
+        """
+        Return the best matching passages, best first, as dicts with book_id,
+        section, offset (of the match in the full text), snippet and score.
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+
+        results = []
+        for row in self._match(terms, book_id, limit, match_any=False):
+            position, snippet = make_snippet(row.text, terms)
+            results.append({
+                "book_id": int(row.book_id),
+                "section": int(row.section),
+                "offset": int(row.start) + position,
+                "snippet": snippet,
+                "score": float(row.score)
+            })
+        return results
+
+    def passages(self, question: str, book_id: int, limit: int = 8) -> List[Dict]:
+        """
+        Return whole passages of a book relevant to a natural language question,
+        best first, as dicts with section, offset (of the passage), text and score.
+
+        Unlike search(), a passage only needs to contain some of the question's
+        words; stop words are ignored and BM25 ranking sorts out the rest.
+        """
+        terms = [term for term in dict.fromkeys(query_terms(question)) if term not in STOP_WORDS and len(term) > 2]
+        if not terms:
+            return []
+        return [
+            {
+                "section": int(row.section),
+                "offset": int(row.start),
+                "text": row.text,
+                "score": float(row.score)
+            }
+            for row in self._match(terms, book_id, limit, match_any=True)
+        ]
+
+    def stats(self) -> dict:
+        with self.engine.connect() as connection:
+            books, chunks = connection.execute(
+                text("SELECT COUNT(*), COALESCE(SUM(chunks), 0) FROM book_search_state")
+            ).one()
+        return {"indexed_books": int(books), "passages": int(chunks)}
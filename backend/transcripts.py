@@ -0,0 +1,220 @@
+import os
+import re
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from content_cache import ContentEntry, ContentWriter
+
+# Transcription lines are grouped into pages of about this many characters
+TRANSCRIPT_PAGE_CHARS = int(os.getenv('TRANSCRIPT_PAGE_CHARS', '4000'))
+
+# Separator between the lines of a page
+LINE_SEPARATOR = '\n'
+
+TIME = r'(?:(\d+):)?(\d{1,2}):(\d{2})(?:[.,](\d{1,3}))?'
+# 00:01:02,500 --> 00:01:05,000 (SRT) or 01:02.500 --> 01:05.000 (WebVTT)
+RANGE_RE = re.compile(rf'^{TIME}\s*-->\s*{TIME}')
+# [12.5s -> 17.0s] text, as written by /api/transcribe-audio
+SECONDS_RE = re.compile(r'^\[(\d+\.?\d*)s\s*->\s*(\d+\.?\d*)s\]\s*(.*)$')
+# [00:01:02] text or 00:01:02 text
+STAMP_RE = re.compile(rf'^\[?{TIME}\]?\s+(.*)$')
+TAG_RE = re.compile(r'<[^>]+>')
+
+
+class Cue(NamedTuple):
+    start: float  # Seconds
+    end: Optional[float]
+    text: str
+
+
+def to_seconds(hours: Optional[str], minutes: str, seconds: str, fraction: Optional[str]) -> float:
+    value = int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds)
+    return float(value) + (int(fraction.ljust(3, "0")) / 1000 if fraction else 0)
+
+
+def parse_transcription(lines: Iterable[str]) -> Tuple[List[Cue], List[str]]:
+    """
+    Parse a transcription in SRT, WebVTT or timestamped-text form.
+
+    Returns (cues sorted by start, untimed lines). Lines without a
+    timestamp continue the previous timestamped line, and those before the
+    first one come back as untimed lines. Text where fewer than half the
+    lines start with a time, such as prose with a line like "12:30 we met",
+    comes back as untimed lines only.
+    """
+    cues: List[Cue] = []
+    untimed: List[str] = []
+    lines_read: List[str] = []  # Lines outside SRT/WebVTT cues, in case the text isn't timed after all
+    stamped_lines = 0
+    has_blocks = False
+    block = None  # [start, end, lines] of the SRT/WebVTT cue being read
+    stamped = False  # The last cue came from a timestamped line, so it can continue
+
+    def close_block():
+        if block is not None and block[2]:
+            cues.append(Cue(block[0], block[1], ' '.join(block[2])))
+
+    for line in lines:
+        line = line.strip().lstrip('\ufeff')
+        match = RANGE_RE.match(line)
+        if match:
+            close_block()
+            groups = match.groups()
+            block = [to_seconds(*groups[:4]), to_seconds(*groups[4:]), []]
+            has_blocks = True
+            stamped = False
+            continue
+        if block is not None:
+            if line:
+                block[2].append(TAG_RE.sub('', line))
+            else:
+                close_block()
+                block = None
+            continue
+        if not line:
+            continue
+        lines_read.append(line)
+
+        match = SECONDS_RE.match(line)
+        if match:
+            cues.append(Cue(float(match.group(1)), float(match.group(2)), match.group(3).strip()))
+            stamped = True
+            stamped_lines += 1
+            continue
+        match = STAMP_RE.match(line)
+        if match:
+            groups = match.groups()
+            cues.append(Cue(to_seconds(*groups[:4]), None, groups[4].strip()))
+            stamped = True
+            stamped_lines += 1
+            continue
+
+        if stamped:
+            cues[-1] = cues[-1]._replace(text=f"{cues[-1].text} {line}")
+        elif not cues:
+            untimed.append(line)
+    close_block()
+
+    if not has_blocks and stamped_lines * 2 < len(lines_read):
+        return [], lines_read
+    if has_blocks:
+        # Only SRT numbers and WebVTT headers come before the first cue
+        untimed = []
+
+    cues.sort(key=lambda cue: cue.start)
+    # A line without an end lasts until the next one starts
+    for i, cue in enumerate(cues):
+        if cue.end is None:
+            cues[i] = cue._replace(end=cues[i + 1].start if i + 1 < len(cues) else cue.start)
+    return cues, untimed
+
+
+def write_transcript(writer: ContentWriter, cues: List[Cue], untimed: List[str],
+                     page_chars: int = TRANSCRIPT_PAGE_CHARS) -> ContentEntry:
+    """
+    Write a parsed transcription to a content cache entry, one section per page:
+    untimed lines first, then the cues. The manifest gets a time index of the
+    cues: start and end in milliseconds and character offset and length in the
+    text, sorted by start.
+    """
+    index = {"start": [], "end": [], "offset": [], "length": []}
+    units = [(line, None) for line in untimed] + [(cue.text, cue) for cue in cues]
+
+    page: List[str] = []
+    page_cues: List[Tuple[int, Cue]] = []  # (offset in the page, cue)
+    page_length = 0
+
+    def write_page():
+        if not page:
+            return
+        section = writer.write(None, LINE_SEPARATOR.join(page))
+        for offset, cue in page_cues:
+            index["start"].append(round(cue.start * 1000))
+            index["end"].append(round(cue.end * 1000))
+            index["offset"].append(section['offset'] + offset)
+            index["length"].append(len(cue.text))
+
+    try:
+        for text, cue in units:
+            if page and page_length + len(text) > page_chars:
+                write_page()
+                page, page_cues, page_length = [], [], 0
+            if page:
+                page_length += len(LINE_SEPARATOR)
+            if cue is not None:
+                page_cues.append((page_length, cue))
+            page.append(text)
+            page_length += len(text)
+        write_page()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit(cues=index)
+
+
+class TranscriptIndex:
+    """A parsed transcription in the content cache, with its cues found by time through binary search"""
+
+    def __init__(self, entry: ContentEntry):
+        self.entry = entry
+        cues = entry.manifest.get('cues') or {}
+        self.starts: List[int] = cues.get('start', [])
+        self.ends: List[int] = cues.get('end', [])
+        self.offsets: List[int] = cues.get('offset', [])
+        self.lengths: List[int] = cues.get('length', [])
+
+    @property
+    def timed(self) -> bool:
+        return bool(self.starts)
+
+    @property
+    def pages(self) -> int:
+        return len(self.entry.manifest['sections'])
+
+    def find(self, position: float) -> int:
+        """Index of the last cue starting at or before a position in seconds, -1 before the first one"""
+        return bisect_right(self.starts, round(position * 1000)) - 1
+
+    def cues(self, first: int, last: int) -> List[dict]:
+        """Cues first..last inclusive, with their text read in one go"""
+        if first > last:
+            return []
+        base = self.offsets[first]
+        text = self.entry.read_range(base, self.offsets[last] + self.lengths[last] - base)
+        return [
+            {
+                "index": i,
+                "start": self.starts[i] / 1000,
+                "end": self.ends[i] / 1000,
+                "text": text[self.offsets[i] - base:self.offsets[i] - base + self.lengths[i]]
+            }
+            for i in range(first, last + 1)
+        ]
+
+    def window(self, position: float, before: int, after: int) -> dict:
+        """The cue playing at a position together with `before` cues before it and `after` after it"""
+        current = self.find(position)
+        anchor = max(current, 0)
+        first = max(anchor - before, 0)
+        last = min(anchor + after, len(self.starts) - 1)
+        return {
+            "position": position,
+            "current": current if current >= 0 else None,
+            "cue_count": len(self.starts),
+            "has_previous": first > 0,
+            "has_next": last < len(self.starts) - 1,
+            "cues": self.cues(first, last)
+        }
+
+    def page(self, number: int) -> dict:
+        section = self.entry.manifest['sections'][number]
+        first = bisect_left(self.offsets, section['offset'])
+        last = bisect_left(self.offsets, section['offset'] + section['length']) - 1
+        return {
+            "page": number,
+            "pages": self.pages,
+            "start": self.starts[first] / 1000 if first <= last else None,
+            "end": self.ends[last] / 1000 if first <= last else None,
+            "content": self.entry.read_section(number),
+            "cues": self.cues(first, last)
+        }
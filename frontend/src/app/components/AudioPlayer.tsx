@@ -20,6 +20,10 @@ interface AudioPlayerProps {
   onClose: () => void;
 }
 
+// Lines requested after the current one, and how close to the last of them the next ones are loaded
+const TRANSCRIPTION_WINDOW_LINES = 30;
+const TRANSCRIPTION_PREFETCH_LINES = 5;
+
 export default function AudioPlayer({ 
   audioUrl, 
   bookTitle,
@@ -44,7 +48,8 @@ export default function AudioPlayer({
   const [startY, setStartY] = useState(0);
   const [isPositionSet, setIsPositionSet] = useState(false);
   const [showTranscription, setShowTranscription] = useState(false);
-  const [transcriptionData, setTranscriptionData] = useState<string>('');
+  const [transcriptionLoaded, setTranscriptionLoaded] = useState(false);
+  const [transcriptionWindow, setTranscriptionWindow] = useState({ hasPrevious: false, hasNext: false });
   const [transcriptionLines, setTranscriptionLines] = useState<Array<{start: number, end: number, text: string}>>([]);
   const [currentLineIndex, setCurrentLineIndex] = useState(0);
   const [previousLineIndex, setPreviousLineIndex] = useState(-1);
@@ -52,83 +57,64 @@ export default function AudioPlayer({
   const [isScrolling, setIsScrolling] = useState(false);
   const audioRef = useRef<HTMLAudioElement>(null);
   const transcriptionContainerRef = useRef<HTMLDivElement>(null);
+  const isFetchingWindowRef = useRef(false);
   const { refreshAuth, signOut } = useAuth();
 
-  // Function to fetch transcription data
-  const fetchTranscription = async () => {
+  // Fetch the transcription lines around a position; the server finds them by time
+  const fetchTranscription = async (position: number) => {
+    if (isFetchingWindowRef.current) return;
+    isFetchingWindowRef.current = true;
     try {
-      const response = await api.books.getTranscription(parseInt(bookId));
+      const response = await api.books.getTranscriptionWindow(parseInt(bookId), position, 2, TRANSCRIPTION_WINDOW_LINES);
+      if (!response.ok) {
+        throw new Error('Failed to fetch transcription');
+      }
       const data = await response.json();
-      const transcriptionText = data.transcription;
-      setTranscriptionData(transcriptionText);
-      parseTranscription(transcriptionText);
+      setTranscriptionLines(data.cues.map(({ start, end, text }: { start: number, end: number, text: string }) => ({ start, end, text })));
+      setTranscriptionWindow({ hasPrevious: data.has_previous, hasNext: data.has_next });
     } catch (error) {
       console.error('Error fetching transcription:', error);
-      setTranscriptionData('');
       setTranscriptionLines([]);
+    } finally {
+      setTranscriptionLoaded(true);
+      isFetchingWindowRef.current = false;
     }
   };
 
-  // Function to parse transcription text into time-stamped lines
-  const parseTranscription = (text: string) => {
-    const lines: Array<{start: number, end: number, text: string}> = [];
-    
-    // Split by lines and process each line
-    const textLines = text.split('\n');
-    
-    for (const line of textLines) {
-      // Match pattern: [start_time -> end_time] text
-      const match = line.match(/^\[(\d+\.?\d*)s\s*->\s*(\d+\.?\d*)s\]\s*(.+)$/);
-      
-      if (match) {
-        const start = parseFloat(match[1]);
-        const end = parseFloat(match[2]);
-        const text = match[3].trim();
-        
-        lines.push({ start, end, text });
-      }
-    }
-    
-    setTranscriptionLines(lines);
-  };
-
-  // Optimized function to find current line based on audio time
-  // Since lines are chronologically ordered and approximately every 5 seconds
+  // Binary search for the last line starting at or before the current time
   const findCurrentLine = (currentTime: number) => {
-    if (transcriptionLines.length === 0) return -1;
-    
-    // Estimate starting position based on ~5 seconds per line
-    const estimatedIndex = Math.floor(currentTime / 5);
-    const startSearchIndex = Math.max(0, Math.min(estimatedIndex - 2, transcriptionLines.length - 1));
-    
-    // Search forward from estimated position
-    for (let i = startSearchIndex; i < transcriptionLines.length; i++) {
-      const line = transcriptionLines[i];
-      if (currentTime >= line.start && currentTime <= line.end) {
-        return i;
-      }
-      // If we've passed the current time, no line is active
-      if (currentTime < line.start) {
-        break;
+    let low = 0;
+    let high = transcriptionLines.length - 1;
+    let found = -1;
+    while (low <= high) {
+      const middle = (low + high) >> 1;
+      if (transcriptionLines[middle].start <= currentTime) {
+        found = middle;
+        low = middle + 1;
+      } else {
+        high = middle - 1;
       }
     }
-    
-    // If not found in forward search, check a few lines backward
-    for (let i = startSearchIndex - 1; i >= Math.max(0, startSearchIndex - 5); i--) {
-      const line = transcriptionLines[i];
-      if (currentTime >= line.start && currentTime <= line.end) {
-        return i;
-      }
+    if (found === -1 || currentTime > transcriptionLines[found].end) {
+      return -1;
     }
-    
-    return -1;
+    return found;
+  };
+
+  // True when the current time has left the loaded lines, or is close to their end
+  const needsNewWindow = (currentTime: number) => {
+    if (transcriptionLines.length === 0) return false;
+    const first = transcriptionLines[0];
+    const nearEnd = transcriptionLines[Math.max(transcriptionLines.length - TRANSCRIPTION_PREFETCH_LINES, 0)];
+    return (transcriptionWindow.hasPrevious && currentTime < first.start) ||
+      (transcriptionWindow.hasNext && currentTime >= nearEnd.start);
   };
 
   // Function to toggle transcription mode
   const toggleTranscription = async () => {
-    if (!showTranscription && transcriptionData === '') {
-      // First time opening transcription, fetch data
-      await fetchTranscription();
+    if (!showTranscription && !transcriptionLoaded) {
+      // First time opening transcription, fetch the lines around the current time
+      await fetchTranscription(currentTime);
     }
     setShowTranscription(!showTranscription);
   };
@@ -442,6 +428,10 @@ export default function AudioPlayer({
       }
       
       updateLineIndexRef.current = window.setTimeout(() => {
+        // Seeking or playing past the loaded lines loads the ones around the new time
+        if (needsNewWindow(currentTime)) {
+          fetchTranscription(currentTime);
+        }
         const lineIndex = findCurrentLine(currentTime);
         if (lineIndex !== -1 && lineIndex !== currentLineIndex) {
           // Update the index - the CSS transitions will create the smooth scroll effect
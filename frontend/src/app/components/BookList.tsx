@@ -9,6 +9,7 @@ import { BiPlus, BiSort, BiFilter, BiEdit, BiDotsVerticalRounded } from 'react-i
 import { BsGrid3X3Gap, BsList, BsCheckCircleFill, BsBookmarkFill, BsEyeFill } from 'react-icons/bs';
 import { MdDelete } from 'react-icons/md';
 import { api } from '../services/api';
+import { hashFile } from '../utils/sha256';
 
 // Tipos para los filtros y ordenación
 type SortOption = 'last_read' | 'title';
@@ -25,6 +26,34 @@ interface BookWithProgress extends Book {
   };
 }
 
+// Espera a que termine un trabajo en segundo plano (p. ej. la ingesta de un libro nuevo)
+const waitForJob = async (jobId: number, intervalMs = 2000, maxAttempts = 150) => {
+  for (let attempt = 0; attempt < maxAttempts; attempt++) {
+    const response = await api.jobs.get(jobId);
+    const job = await response.json();
+    if (job.status === 'done' || job.status === 'failed') {
+      return job;
+    }
+    await new Promise(resolve => setTimeout(resolve, intervalMs));
+  }
+  return null;
+};
+
+// Metadatos que la ingesta rellena si faltan: formatos de archivo y número de páginas de los PDF
+const awaitsMetadata = (book: Partial<Book>) =>
+  (Boolean(book.ebook_path || book.ebook_url) && (!book.ebook_format || (book.ebook_format === 'pdf' && !book.pages))) ||
+  (Boolean(book.audiobook_path || book.audiobook_url) && !book.audiobook_format);
+
+// SHA-256 de un archivo, o null si no se puede calcular (el archivo se sube igualmente)
+const hashFileOrNull = async (file: File): Promise<string | null> => {
+  try {
+    return await hashFile(file);
+  } catch (error) {
+    console.warn('Could not hash file, uploading it anyway:', error);
+    return null;
+  }
+};
+
 export default function BookList() {
   const [books, setBooks] = useState<BookWithProgress[]>([]);
   const [filteredBooks, setFilteredBooks] = useState<BookWithProgress[]>([]);
@@ -62,6 +91,9 @@ export default function BookList() {
     try {
       console.log(`Starting direct upload for ${fileType}: ${file.name} (${file.size} bytes)`);
       
+      // Ebooks and audiobooks are stored by content, so a file already in storage isn't sent again
+      const sha256 = fileType === 'transcription' ? null : await hashFileOrNull(file);
+
       // Get signed URL from backend
       const response = await api.request('/api/generate-upload-url', {
         method: 'POST',
@@ -71,7 +103,8 @@ export default function BookList() {
         body: JSON.stringify({
           filename: file.name,
           file_type: fileType,
-          content_type: file.type || 'application/octet-stream'
+          content_type: file.type || 'application/octet-stream',
+          sha256
         })
       });
 
@@ -79,7 +112,11 @@ export default function BookList() {
         throw new Error('Failed to generate upload URL');
       }
 
-      const { signed_url, final_url } = await response.json();
+      const { signed_url, final_url, exists } = await response.json();
+      if (exists) {
+        console.log(`${fileType} already stored, skipping upload: ${final_url}`);
+        return final_url;
+      }
       console.log(`Got signed URL for ${fileType}: ${final_url}`);
 
       // Upload file directly to Cloud Storage
@@ -369,6 +406,7 @@ export default function BookList() {
       const response = await api.books.create(formData);
       
       if (response.ok) {
+        const created = await response.json();
         setNewBook({});
         setIsAdding(false);
         setEbookFile(null);
@@ -380,6 +418,18 @@ export default function BookList() {
         if (transcriptionInputRef.current) transcriptionInputRef.current.value = '';
         
         fetchBooks(); // Refresh the book list
+        
+        // The files are already stored; only refresh again for metadata the ingestion job fills in
+        if (created.job_id && awaitsMetadata(created)) {
+          waitForJob(created.job_id)
+            .then(job => {
+              if (job?.status === 'failed') {
+                console.error('Error processing book files:', job.error);
+              }
+              fetchBooks();
+            })
+            .catch(error => console.error('Error checking book job:', error));
+        }
       } else {
         throw new Error('Error adding book');
       }
@@ -515,10 +565,22 @@ export default function BookList() {
     }
   };
 
-  const startEditing = (book: Book) => {
+  const startEditing = async (book: Book) => {
     setEditingId(book.id || null);
     setNewBook(book);
     setIsAdding(true);
+    
+    // The library list only carries card fields; load the rest for the form
+    if (book.id) {
+      try {
+        const response = await api.books.getById(book.id);
+        if (response.ok) {
+          setNewBook(await response.json());
+        }
+      } catch (error) {
+        console.error('Error loading book details:', error);
+      }
+    }
   };
 
   const cancelEditing = () => {
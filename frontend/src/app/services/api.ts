@@ -77,7 +77,10 @@ export const api = {
   
   // Books endpoints
   books: {
-    getAll: () => apiRequest('/api/books/'),
+    getAll: (params?: Record<string, string>) => {
+      const query = params ? `?${new URLSearchParams(params)}` : '';
+      return apiRequest(`/api/books/${query}`);
+    },
     getAllWithProgress: () => apiRequest('/api/books/with-progress'),
     getById: (id: number) => apiRequest(`/api/books/${id}`),
     create: (formData: FormData) => apiRequest('/api/books/', {
@@ -93,9 +96,16 @@ export const api = {
     }),
     getContent: (id: number) => apiRequest(`/api/books/${id}/content`),
     getTranscription: (id: number) => apiRequest(`/api/books/${id}/transcription`),
+    getTranscriptionWindow: (id: number, position: number, before = 2, after = 30) =>
+      apiRequest(`/api/books/${id}/transcription/window?position=${position}&before=${before}&after=${after}`),
     getSignedUrl: (id: number) => apiRequest(`/api/signed-url/${id}`),
   },
   
+  // Background jobs, e.g. the ingestion of a new book
+  jobs: {
+    get: (id: number) => apiRequest(`/api/jobs/${id}`),
+  },
+  
   // Reading progress endpoints
   progress: {
     get: (bookId: number) => apiRequest(`/api/books/${bookId}/progress`),